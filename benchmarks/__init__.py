@@ -0,0 +1,9 @@
+"""
+Benchmarks of the hot paths of numerauto on synthetic Numerai datasets.
+
+Run the benchmarks from the root of the repository with:
+    python -m benchmarks.run --scale small --output results.json
+
+See benchmarks.synthetic for the dataset generator and benchmarks.suite for
+the benchmarks.
+"""
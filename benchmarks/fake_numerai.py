@@ -0,0 +1,466 @@
+"""
+Local stand-in for the Numerai API, for offline end-to-end tests of the
+Numerauto daemon.
+
+FakeNumerai runs an HTTP server in a background thread that answers the
+GraphQL queries Numerauto makes (tournaments, round details, dataset URL,
+submission upload authorization and submission creation), serves dataset zip
+files with range requests and ETags, and accepts prediction uploads. Rounds
+are scripted with add_round, and follow a clock (e.g. an AcceleratedClock
+shared with the daemon), so round transitions happen at simulated times.
+Latency and failures can be injected into every request.
+
+Point Numerauto at the stand-in with:
+    Numerauto(api_url=fake.api_url)
+"""
+
+import os
+import re
+import json
+import time
+import uuid
+import random
+import hashlib
+import datetime
+import threading
+import logging
+import email.utils
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from numerauto.scheduler import SystemClock
+
+
+logger = logging.getLogger(__name__)
+
+
+# Tournaments that are reported by default, by id
+DEFAULT_TOURNAMENTS = {8: 'bernie'}
+
+# Buffer size used to serve files
+SERVE_BUFFER_SIZE = 1024 * 1024
+
+RANGE_HEADER = re.compile(r'^bytes=(\d+)-(\d*)$')
+
+
+class FakeRound:
+    """
+    A scripted round.
+
+    Attributes:
+        number: Round number
+        open_time: Timezone-aware datetime at which the round opens
+        close_time: Timezone-aware datetime at which the round closes
+        dataset: Filename of the dataset zip file of the round
+        dataset_time: Time from which the dataset is served (until then, the
+                      dataset of the previous round is served)
+    """
+
+    def __init__(self, number, open_time, close_time, dataset, dataset_time):
+        self.number = number
+        self.open_time = open_time
+        self.close_time = close_time
+        self.dataset = os.path.abspath(str(dataset))
+        self.dataset_time = dataset_time
+
+
+class FakeSubmission:
+    """
+    A prediction upload that was completed with create_submission.
+
+    Attributes:
+        id: Submission id
+        round_number: Number of the round that was open at the time of the upload
+        tournament: Tournament id
+        filename: Filename of the uploaded file
+        size: Size of the uploaded file in bytes
+        time: Time of the clock at which the submission was created
+        latency: Seconds (of the clock) from the opening of the round to the submission
+    """
+
+    def __init__(self, id, round_number, tournament, filename, size, time, latency):
+        self.id = id
+        self.round_number = round_number
+        self.tournament = tournament
+        self.filename = filename
+        self.size = size
+        self.time = time
+        self.latency = latency
+
+    def to_dict(self):
+        return {'id': self.id,
+                'round': self.round_number,
+                'tournament': self.tournament,
+                'filename': self.filename,
+                'size': self.size,
+                'time': self.time.isoformat(),
+                'latency': self.latency}
+
+
+class FakeNumerai:
+    """
+    Local stand-in for the Numerai API.
+
+    Attributes:
+        clock: Clock that determines the current round
+        tournaments: Dictionary of tournament id to name
+        latency: Seconds of (real) delay added to every request, or a
+                 function of the request path that returns the delay
+        failure_rate: Probability that a request fails with HTTP 500
+        upload_directory: Directory uploads are saved to (None to discard them)
+        rounds: List of FakeRound, in order of opening time
+        submissions: List of FakeSubmission
+        requests: Dictionary of request kind to number of requests
+    """
+
+    def __init__(self, clock=None, tournaments=None, host='127.0.0.1', port=0, latency=0, failure_rate=0,
+                 seed=0, upload_directory=None):
+        """
+        Creates a new FakeNumerai server. The server starts with start (or
+        when used as a context manager).
+
+        Args:
+            clock: Clock that determines the current round, shared with the
+                   daemon (default: None, i.e. the system clock)
+            tournaments: Dictionary of tournament id to name (default:
+                         DEFAULT_TOURNAMENTS)
+            host: Host to listen on (default: 127.0.0.1)
+            port: Port to listen on (default: 0, i.e. any free port)
+            latency: Seconds of (real) delay added to every request, or a
+                     function of the request path that returns the delay
+                     (default: 0)
+            failure_rate: Probability that a request fails with HTTP 500
+                          (default: 0)
+            seed: Seed of the random failures (default: 0)
+            upload_directory: Directory uploads are saved to (default: None,
+                              i.e. only their size is recorded)
+        """
+
+        self.clock = clock if clock is not None else SystemClock()
+        self.tournaments = dict(tournaments) if tournaments is not None else dict(DEFAULT_TOURNAMENTS)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.upload_directory = upload_directory
+        self.rounds = []
+        self.submissions = []
+        self.requests = {}
+        self.uploads = {}
+        self.failures = []
+        self.etags = {}
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+        self.server = ThreadingHTTPServer((host, port), FakeNumeraiHandler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    @property
+    def api_url(self):
+        """ URL of the GraphQL API, see the api_url argument of Numerauto """
+        return self.base_url + '/graphql'
+
+    def start(self):
+        """ Start serving in a background thread """
+
+        logger.info('FakeNumerai: Serving on %s', self.base_url)
+        self.thread = threading.Thread(target=self.server.serve_forever, name='fake-numerai', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        """ Stop serving """
+
+        self.server.shutdown()
+        self.server.server_close()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def add_round(self, number, open_time, close_time, dataset, dataset_delay=0):
+        """
+        Script a round.
+
+        Args:
+            number: Round number
+            open_time: Timezone-aware datetime at which the round opens
+            close_time: Timezone-aware datetime at which the round closes
+            dataset: Filename of the dataset zip file of the round
+            dataset_delay: Seconds after the opening of the round until its
+                           dataset is served (default: 0)
+
+        Returns:
+            FakeRound
+        """
+
+        fake_round = FakeRound(number, open_time, close_time, dataset,
+                               open_time + datetime.timedelta(seconds=dataset_delay))
+        with self.lock:
+            self.rounds.append(fake_round)
+            self.rounds.sort(key=lambda r: r.open_time)
+        return fake_round
+
+    def fail_next(self, count=1, kind=None):
+        """
+        Make the next requests fail with HTTP 500.
+
+        Args:
+            count: Number of requests that fail (default: 1)
+            kind: Kind of requests that fail: 'graphql', 'dataset' or
+                  'upload' (default: None, i.e. any request)
+        """
+
+        with self.lock:
+            self.failures.extend([kind] * count)
+
+    def get_current_round(self):
+        """ Get the round that is open at the current time of the clock, or None """
+
+        now = self.clock.now()
+        with self.lock:
+            opened = [r for r in self.rounds if r.open_time <= now]
+        return opened[-1] if opened else None
+
+    def get_current_dataset_round(self):
+        """ Get the round of which the dataset is served at the current time of the clock, or None """
+
+        now = self.clock.now()
+        with self.lock:
+            available = [r for r in self.rounds if r.dataset_time <= now]
+        return available[-1] if available else None
+
+    def get_round(self, number):
+        with self.lock:
+            for r in self.rounds:
+                if r.number == number:
+                    return r
+        return None
+
+    def get_etag(self, filename):
+        """ Get the ETag (quoted MD5 checksum) of a file """
+
+        stat = os.stat(filename)
+        key = (filename, stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            if key in self.etags:
+                return self.etags[key]
+
+        md5 = hashlib.md5()
+        with open(filename, 'rb') as fp:
+            for block in iter(lambda: fp.read(SERVE_BUFFER_SIZE), b''):
+                md5.update(block)
+        etag = '"{}"'.format(md5.hexdigest())
+
+        with self.lock:
+            self.etags[key] = etag
+        return etag
+
+    def before_request(self, kind, path):
+        """
+        Count a request and apply the injected latency and failures.
+
+        Returns:
+            True if the request must fail, False otherwise.
+        """
+
+        latency = self.latency(path) if callable(self.latency) else self.latency
+        if latency:
+            time.sleep(latency)
+
+        with self.lock:
+            self.requests[kind] = self.requests.get(kind, 0) + 1
+
+            for i, failure_kind in enumerate(self.failures):
+                if failure_kind is None or failure_kind == kind:
+                    del self.failures[i]
+                    return True
+
+            return self.random.random() < self.failure_rate
+
+    def graphql(self, query, variables, authorized):
+        """
+        Answer a GraphQL query. Queries are recognized by the fields that
+        Numerauto requests, not parsed.
+
+        Returns:
+            Response dictionary, with 'data' or 'errors'
+        """
+
+        variables = variables or {}
+
+        if 'submission_upload_auth' in query or 'create_submission' in query:
+            if not authorized:
+                return {'errors': [{'message': 'You must be authenticated to perform this action.'}]}
+
+        if 'submission_upload_auth' in query:
+            key = uuid.uuid4().hex
+            with self.lock:
+                self.uploads[key] = {'filename': variables['filename'], 'tournament': variables['tournament'],
+                                     'size': None}
+            return {'data': {'submission_upload_auth': {'filename': key,
+                                                        'url': '{}/uploads/{}'.format(self.base_url, key)}}}
+
+        if 'create_submission' in query:
+            return self.create_submission(variables['filename'], variables['tournament'])
+
+        if 'tournaments' in query:
+            return {'data': {'tournaments': [{'id': str(number), 'name': name, 'tournament': number, 'active': True}
+                                             for number, name in sorted(self.tournaments.items())]}}
+
+        if 'dataset' in query:
+            dataset_round = self.get_current_dataset_round()
+            if dataset_round is None:
+                return {'errors': [{'message': 'No dataset available'}]}
+            return {'data': {'dataset': '{}/datasets/numerai_dataset_{}.zip'.format(self.base_url,
+                                                                                   dataset_round.number)}}
+
+        if 'rounds' in query:
+            current = self.get_current_round()
+            if current is None:
+                return {'errors': [{'message': 'No round is open'}]}
+            return {'data': {'rounds': [{'number': current.number,
+                                         'openTime': current.open_time.isoformat(),
+                                         'closeTime': current.close_time.isoformat(),
+                                         'resolveTime': current.close_time.isoformat()}]}}
+
+        return {'errors': [{'message': 'Unknown query'}]}
+
+    def create_submission(self, key, tournament):
+        """ Complete an upload """
+
+        with self.lock:
+            upload = self.uploads.pop(key, None)
+        if upload is None or upload['size'] is None:
+            return {'errors': [{'message': 'Upload {} not found'.format(key)}]}
+
+        current = self.get_current_round()
+        now = self.clock.now()
+        submission = FakeSubmission(uuid.uuid4().hex, current.number, tournament, upload['filename'],
+                                    upload['size'], now, (now - current.open_time).total_seconds())
+        logger.info('FakeNumerai: Submission for round %d tournament %d, %.1f seconds after the round opened',
+                    submission.round_number, tournament, submission.latency)
+
+        with self.lock:
+            self.submissions.append(submission)
+        return {'data': {'create_submission': {'id': submission.id}}}
+
+    def store_upload(self, key, data):
+        """ Store the data of an upload, returns whether the upload was authorized """
+
+        with self.lock:
+            upload = self.uploads.get(key)
+            if upload is None:
+                return False
+            upload['size'] = len(data)
+
+        if self.upload_directory is not None:
+            os.makedirs(str(self.upload_directory), exist_ok=True)
+            with open(os.path.join(str(self.upload_directory), '{}_{}'.format(key, upload['filename'])), 'wb') as fp:
+                fp.write(data)
+        return True
+
+
+class FakeNumeraiHandler(BaseHTTPRequestHandler):
+    """ Request handler of FakeNumerai """
+
+    protocol_version = 'HTTP/1.1'
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def log_message(self, format, *args):
+        logger.debug('FakeNumerai: ' + format, *args)
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_failure(self):
+        self.send_response(500)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def read_body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.fake.before_request('graphql', self.path):
+            return self.send_failure()
+
+        request = json.loads(body.decode('utf-8'))
+        authorized = self.headers.get('Authorization', '').startswith('Token ')
+        self.send_json(self.fake.graphql(request.get('query', ''), request.get('variables'), authorized))
+
+    def do_PUT(self):
+        body = self.read_body()
+        if self.fake.before_request('upload', self.path):
+            return self.send_failure()
+
+        if not self.path.startswith('/uploads/') or not self.fake.store_upload(self.path[len('/uploads/'):], body):
+            return self.send_json({'message': 'Forbidden'}, status=403)
+
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        if self.fake.before_request('dataset', self.path):
+            return self.send_failure()
+
+        match = re.match(r'^/datasets/numerai_dataset_(\d+)\.zip$', self.path)
+        fake_round = self.fake.get_round(int(match.group(1))) if match else None
+        if fake_round is None:
+            return self.send_json({'message': 'Not found'}, status=404)
+
+        filename = fake_round.dataset
+        size = os.path.getsize(filename)
+        etag = self.fake.get_etag(filename)
+
+        start, end, status = 0, size - 1, 200
+        match = RANGE_HEADER.match(self.headers.get('Range', ''))
+        if match and self.headers.get('If-Range', etag) == etag:
+            start = int(match.group(1))
+            end = min(int(match.group(2)), size - 1) if match.group(2) else size - 1
+            status = 206
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */{}'.format(size))
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/zip')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('ETag', etag)
+        self.send_header('Last-Modified', email.utils.formatdate(os.path.getmtime(filename), usegmt=True))
+        if status == 206:
+            self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end, size))
+        self.end_headers()
+
+        with open(filename, 'rb') as fp:
+            fp.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                block = fp.read(min(SERVE_BUFFER_SIZE, remaining))
+                if not block:
+                    break
+                self.wfile.write(block)
+                remaining -= len(block)
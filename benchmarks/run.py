@@ -0,0 +1,225 @@
+"""
+Runs the numerauto benchmarks and writes the results to a JSON file.
+
+Every run of a benchmark happens in a fresh process, so the peak RSS that is
+reported belongs to that benchmark alone. Example:
+    python -m benchmarks.run --scale small --repeat 3 --output results.json
+    python -m benchmarks.run --scale small --output new.json --compare results.json
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import platform
+import datetime
+import statistics
+import logging
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numerauto
+from numerauto.instrumentation import get_peak_rss
+
+from .synthetic import SCALES, DatasetSpec, generate_dataset
+from .suite import BENCHMARKS, BENCHMARK_ROUND, BenchmarkContext
+
+
+logger = logging.getLogger(__name__)
+
+
+# Version of the format of the results file
+RESULTS_VERSION = 1
+
+
+def run_benchmark(name, data_directory, work_directory, spec, precision):
+    """
+    Runs a benchmark once. Called in a fresh worker process.
+
+    Returns:
+        Dictionary with the number of rows, wall and CPU time in seconds, and
+        the peak RSS in bytes before (after setup) and after the timed part.
+    """
+
+    logging.basicConfig(level=logging.WARNING)
+
+    context = BenchmarkContext(data_directory, work_directory, spec, precision=precision)
+    rows, func = BENCHMARKS[name](context)
+
+    rss_setup = get_peak_rss()
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    func()
+    cpu_time = time.process_time() - cpu_start
+    wall_time = time.perf_counter() - wall_start
+
+    return {'rows': rows,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'peak_rss_setup': rss_setup,
+            'peak_rss': get_peak_rss()}
+
+
+def run_benchmarks(names, spec, work_directory, precision='float32', repeat=1):
+    """
+    Generates a synthetic dataset (unless the one in the work directory has
+    the same spec) and runs benchmarks on it.
+
+    Args:
+        names: Names of the benchmarks to run (see suite.BENCHMARKS)
+        spec: DatasetSpec of the dataset
+        work_directory: Directory for the dataset and the benchmark output
+        precision: Precision of the feature matrices
+        repeat: Number of times each benchmark is run
+
+    Returns:
+        Dictionary with the results, see main.
+    """
+
+    work_directory = Path(work_directory).resolve()
+    data_directory = work_directory / 'data'
+    spec_filename = work_directory / 'spec.json'
+
+    try:
+        with open(spec_filename, 'r') as fp:
+            existing_spec = json.load(fp)
+    except FileNotFoundError:
+        existing_spec = None
+
+    if existing_spec != spec.to_dict():
+        logger.info('Generating dataset %s', spec.to_dict())
+        shutil.rmtree(str(data_directory), ignore_errors=True)
+        generate_dataset(data_directory, BENCHMARK_ROUND, spec)
+        with open(spec_filename, 'w') as fp:
+            json.dump(spec.to_dict(), fp)
+
+    results = []
+    for name in names:
+        runs = []
+        for i in range(repeat):
+            run_directory = work_directory / 'runs' / '{}_{}'.format(name, i)
+            shutil.rmtree(str(run_directory), ignore_errors=True)
+            run_directory.mkdir(parents=True)
+
+            # A new process per run, so peak RSS and caches are not shared
+            with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                future = executor.submit(run_benchmark, name, data_directory, run_directory, spec, precision)
+                try:
+                    runs.append(future.result())
+                except ImportError as e:
+                    logger.warning('Skipping benchmark %s: %s', name, e)
+                    break
+
+            shutil.rmtree(str(run_directory), ignore_errors=True)
+
+        if not runs:
+            results.append({'name': name, 'skipped': True})
+            continue
+
+        wall_times = [run['wall_time'] for run in runs]
+        peak_rss = [run['peak_rss'] for run in runs if run['peak_rss'] is not None]
+        result = {'name': name,
+                  'rows': runs[0]['rows'],
+                  'wall_time': min(wall_times),
+                  'wall_time_median': statistics.median(wall_times),
+                  'cpu_time': min(run['cpu_time'] for run in runs),
+                  'rows_per_second': runs[0]['rows'] / min(wall_times) if min(wall_times) > 0 else None,
+                  'peak_rss': max(peak_rss) if peak_rss else None,
+                  'runs': runs}
+        logger.info('%s: %.3f s, %.0f rows/s', name, result['wall_time'], result['rows_per_second'] or 0)
+        results.append(result)
+
+    return {'version': RESULTS_VERSION,
+            'numerauto_version': numerauto.__version__,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'timestamp': datetime.datetime.utcnow().isoformat(),
+            'precision': precision,
+            'spec': spec.to_dict(),
+            'results': results}
+
+
+def format_results(results, baseline=None):
+    """
+    Formats results as a table, with the ratio of the wall time to that of a
+    baseline (results of an earlier run) if given.
+    """
+
+    baseline_times = {}
+    if baseline is not None:
+        baseline_times = {r['name']: r['wall_time'] for r in baseline['results'] if not r.get('skipped')}
+
+    lines = ['{:<20} {:>10} {:>12} {:>14} {:>12} {:>10}'.format(
+        'benchmark', 'rows', 'wall (s)', 'rows/s', 'peak RSS', 'vs base')]
+    for r in results['results']:
+        if r.get('skipped'):
+            lines.append('{:<20} skipped'.format(r['name']))
+            continue
+
+        ratio = ''
+        if r['name'] in baseline_times and baseline_times[r['name']] > 0:
+            ratio = '{:.2f}x'.format(r['wall_time'] / baseline_times[r['name']])
+        peak_rss = '{:.0f} MiB'.format(r['peak_rss'] / 2**20) if r['peak_rss'] is not None else '-'
+        lines.append('{:<20} {:>10d} {:>12.3f} {:>14.0f} {:>12} {:>10}'.format(
+            r['name'], r['rows'], r['wall_time'], r['rows_per_second'] or 0, peak_rss, ratio))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """ Command line entry point """
+
+    parser = argparse.ArgumentParser(description='Run numerauto benchmarks on synthetic data')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='small',
+                        help='Predefined dataset scale (default: small)')
+    parser.add_argument('--train-rows', type=int, help='Number of training rows (overrides --scale)')
+    parser.add_argument('--tournament-rows', type=int, help='Number of tournament rows (overrides --scale)')
+    parser.add_argument('--features', type=int, help='Number of features (overrides --scale)')
+    parser.add_argument('--eras', type=int, help='Number of training eras (overrides --scale)')
+    parser.add_argument('--targets', type=int, default=1, help='Number of target columns (default: 1)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the dataset generator (default: 0)')
+    parser.add_argument('--precision', default='float32',
+                        help='Precision of the feature matrices (default: float32)')
+    parser.add_argument('--benchmarks', default=','.join(BENCHMARKS),
+                        help='Comma-separated benchmarks to run (default: all): ' + ', '.join(BENCHMARKS))
+    parser.add_argument('--repeat', type=int, default=1, help='Runs per benchmark (default: 1)')
+    parser.add_argument('--work-dir', default='benchmark_data',
+                        help='Directory for the generated dataset (default: benchmark_data)')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--compare', help='JSON file with earlier results to compare with')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)8s] %(name)s: %(message)s', level=logging.INFO)
+
+    names = [name.strip() for name in args.benchmarks.split(',') if name.strip()]
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error('Unknown benchmarks: {}'.format(', '.join(unknown)))
+
+    train_rows, tournament_rows, features, eras = SCALES[args.scale]
+    spec = DatasetSpec(args.train_rows if args.train_rows is not None else train_rows,
+                       args.tournament_rows if args.tournament_rows is not None else tournament_rows,
+                       args.features if args.features is not None else features,
+                       args.eras if args.eras is not None else eras,
+                       num_targets=args.targets, seed=args.seed)
+
+    results = run_benchmarks(names, spec, args.work_dir, precision=args.precision, repeat=args.repeat)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as fp:
+            baseline = json.load(fp)
+        if baseline.get('spec') != results['spec'] or baseline.get('precision') != results['precision']:
+            logger.warning('The results in %s were measured on a different dataset or precision', args.compare)
+
+    print(format_results(results, baseline))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        logger.info('Results written to %s', os.path.abspath(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,223 @@
+"""
+Simulates weeks of Numerai rounds against a local stand-in of the Numerai API
+(see fake_numerai) and measures the latency from the opening of each round to
+the upload of its predictions.
+
+The daemon and the stand-in share an AcceleratedClock, so waiting for the
+next round takes seconds, while downloading, checking, training and
+predicting take as long as they really do. Example:
+    python -m benchmarks.simulate --rounds 4 --scale tiny --output latency.json
+"""
+
+import os
+import json
+import time
+import shutil
+import argparse
+import datetime
+import logging
+import statistics
+from pathlib import Path
+
+from numerauto import Numerauto
+from numerauto.eventhandlers import EventHandler, SKLearnModelTrainer, PredictionUploader
+from numerauto.scheduler import AcceleratedClock, Scheduler
+from numerauto.journal import CheckpointJournal
+from numerauto.instrumentation import Instrumentation
+
+from .synthetic import SCALES, DatasetSpec, generate_dataset
+from .fake_numerai import FakeNumerai
+
+
+logger = logging.getLogger(__name__)
+
+
+# Tournament the simulated daemon participates in
+SIMULATION_TOURNAMENT_ID = 8
+SIMULATION_TOURNAMENT_NAME = 'bernie'
+
+# Seconds between the opening of successive rounds (one week)
+ROUND_PERIOD = 7 * 24 * 3600
+
+
+class SimulationStopper(EventHandler):
+    """
+    Event handler that stops the daemon after it handled the tournament data
+    of the last round of the simulation.
+    """
+
+    def __init__(self, name, last_round):
+        super().__init__(name)
+        self.last_round = last_round
+
+    def on_new_tournament_data(self, round_number):
+        if round_number >= self.last_round:
+            logger.info('SimulationStopper: Last round %d handled, stopping', round_number)
+            self.numerauto.scheduler.request_stop()
+
+
+def generate_rounds(directory, spec, rounds):
+    """
+    Generates the datasets of the simulated rounds 1 to rounds. All rounds
+    have the same training data and new tournament data.
+
+    Returns:
+        Dictionary of round number to the filename of the dataset zip file.
+    """
+
+    datasets = {}
+    for round_number in range(1, rounds + 1):
+        paths = generate_dataset(directory, round_number, spec, tournament_seed=spec.seed + round_number)
+        # Only the zip files are served
+        shutil.rmtree(str(paths['training'].parent))
+        datasets[round_number] = str(paths['zip'])
+    return datasets
+
+
+def run_simulation(spec, work_directory, rounds=4, speed=100000, period=ROUND_PERIOD, dataset_delay=0,
+                   latency=0, failure_rate=0, seed=0):
+    """
+    Runs the Numerauto daemon with an SKLearnModelTrainer and a
+    PredictionUploader against a FakeNumerai server, from the opening of
+    round 1 until the predictions of the last round are uploaded.
+
+    Args:
+        spec: DatasetSpec of the datasets of the rounds
+        work_directory: Directory for the datasets and the files of the daemon
+        rounds: Number of rounds to simulate
+        speed: Factor by which waits are compressed (see AcceleratedClock)
+        period: Seconds between the opening of successive rounds
+        dataset_delay: Seconds after the opening of a round (from round 2 on)
+                       until its dataset is served
+        latency: Seconds of (real) delay added to every request
+        failure_rate: Probability that a request to the server fails
+        seed: Seed of the injected failures
+
+    Returns:
+        Dictionary with the results, see main.
+    """
+
+    from sklearn.linear_model import LogisticRegression
+
+    work_directory = Path(work_directory).resolve()
+    server_directory = work_directory / 'server'
+    daemon_directory = work_directory / 'daemon'
+    shutil.rmtree(str(server_directory), ignore_errors=True)
+    shutil.rmtree(str(daemon_directory), ignore_errors=True)
+    daemon_directory.mkdir(parents=True)
+
+    datasets = generate_rounds(server_directory, spec, rounds)
+
+    clock = AcceleratedClock(speed=speed)
+    scheduler = Scheduler(clock)
+
+    fake = FakeNumerai(clock=clock, tournaments={SIMULATION_TOURNAMENT_ID: SIMULATION_TOURNAMENT_NAME},
+                       latency=latency, failure_rate=failure_rate, seed=seed)
+    for round_number in range(1, rounds + 1):
+        open_time = clock.start + datetime.timedelta(seconds=(round_number - 1) * period)
+        fake.add_round(round_number, open_time, open_time + datetime.timedelta(seconds=period),
+                       datasets[round_number], dataset_delay=dataset_delay if round_number > 1 else 0)
+
+    # The daemon writes its state, models and predictions to the working directory
+    cwd = os.getcwd()
+    os.chdir(str(daemon_directory))
+    real_start = time.perf_counter()
+    try:
+        with fake:
+            numerauto = Numerauto(tournament_id=SIMULATION_TOURNAMENT_ID, data_directory=daemon_directory / 'data',
+                                  scheduler=scheduler, api_url=fake.api_url,
+                                  journal=CheckpointJournal(daemon_directory / 'checkpoints.db'),
+                                  instrumentation=Instrumentation(daemon_directory / 'metrics'))
+            numerauto.add_event_handler(SKLearnModelTrainer('model', lambda: LogisticRegression(max_iter=200)))
+            numerauto.add_event_handler(PredictionUploader('upload', 'model.csv', 'public', 'secret'),
+                                        depends_on=['model'])
+            numerauto.add_event_handler(SimulationStopper('stop', rounds), depends_on=['upload'])
+            numerauto.run()
+    finally:
+        os.chdir(cwd)
+    real_time = time.perf_counter() - real_start
+
+    submissions = [s.to_dict() for s in fake.submissions]
+    latencies = [s['latency'] for s in submissions]
+    detection = numerauto.persistent_state.get('round_detection', {})
+
+    # Time spent per step, event, handler and API call in each round
+    instrumentation = {}
+    for round_number in range(1, rounds + 1):
+        with open(str(daemon_directory / 'metrics' / 'round_{}.json'.format(round_number)), 'r') as fp:
+            instrumentation[str(round_number)] = json.load(fp)['summary']
+
+    return {'spec': spec.to_dict(),
+            'rounds': rounds,
+            'speed': speed,
+            'period': period,
+            'dataset_delay': dataset_delay,
+            'latency': latency,
+            'failure_rate': failure_rate,
+            'real_time': real_time,
+            'simulated_time': (clock.now() - clock.start).total_seconds(),
+            'requests': fake.requests,
+            'submissions': submissions,
+            'upload_latency': {'min': min(latencies) if latencies else None,
+                               'median': statistics.median(latencies) if latencies else None,
+                               'max': max(latencies) if latencies else None},
+            'round_detection': {str(number): record for number, record in sorted(detection.items())},
+            'instrumentation': instrumentation}
+
+
+def format_results(results):
+    """ Formats the upload latency of each round as a table """
+
+    detection = results['round_detection']
+    lines = ['{:>6} {:>16} {:>16} {:>8}'.format('round', 'upload (s)', 'detection (s)', 'polls')]
+    for submission in results['submissions']:
+        record = detection.get(str(submission['round']), {})
+        lag = '{:.1f}'.format(record['lag']) if 'lag' in record else '-'
+        lines.append('{:>6d} {:>16.1f} {:>16} {:>8}'.format(submission['round'], submission['latency'], lag,
+                                                          record.get('polls', '-')))
+    lines.append('{} simulated days in {:.1f} seconds'.format(round(results['simulated_time'] / 86400, 1),
+                                                             results['real_time']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    """ Command line entry point """
+
+    parser = argparse.ArgumentParser(description='Simulate Numerai rounds against a local stand-in of the API')
+    parser.add_argument('--rounds', type=int, default=4, help='Number of rounds to simulate (default: 4)')
+    parser.add_argument('--scale', choices=sorted(SCALES), default='tiny',
+                        help='Predefined dataset scale (default: tiny)')
+    parser.add_argument('--targets', type=int, default=1, help='Number of target columns (default: 1)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the datasets and failures (default: 0)')
+    parser.add_argument('--speed', type=float, default=100000,
+                        help='Factor by which waits are compressed (default: 100000)')
+    parser.add_argument('--period', type=float, default=ROUND_PERIOD,
+                        help='Seconds between the opening of rounds (default: one week)')
+    parser.add_argument('--dataset-delay', type=float, default=0,
+                        help='Seconds after the opening of a round until its dataset is served (default: 0)')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='Seconds of real delay added to every request (default: 0)')
+    parser.add_argument('--failure-rate', type=float, default=0,
+                        help='Probability that a request fails (default: 0)')
+    parser.add_argument('--work-dir', default='simulation_data',
+                        help='Directory for the datasets and the daemon (default: simulation_data)')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s [%(levelname)8s] %(name)s: %(message)s', level=logging.INFO)
+
+    spec = DatasetSpec.from_scale(args.scale, num_targets=args.targets, seed=args.seed)
+    results = run_simulation(spec, args.work_dir, rounds=args.rounds, speed=args.speed, period=args.period,
+                             dataset_delay=args.dataset_delay, latency=args.latency,
+                             failure_rate=args.failure_rate, seed=args.seed)
+
+    print(format_results(results))
+
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
+        logger.info('Results written to %s', os.path.abspath(args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""
+Benchmarks of the hot paths of numerauto.
+
+Each benchmark is a function that takes a BenchmarkContext, does its
+(untimed) setup and returns the number of rows it processes and a function
+without arguments that runs the timed part.
+"""
+
+import os
+import shutil
+import logging
+from pathlib import Path
+
+import numpy
+
+from numerauto import Numerauto
+from numerauto.utils import check_dataset, load_dataset, DatasetFingerprint, PredictionWriter
+from numerauto.columnar import convert_to_columnar, convert_zip_to_columnar, load_columnar
+from numerauto.journal import CheckpointJournal
+
+
+logger = logging.getLogger(__name__)
+
+
+# Round number of the generated dataset
+BENCHMARK_ROUND = 1
+
+# Tournament id and name used by the model benchmarks
+BENCHMARK_TOURNAMENT_ID = 8
+BENCHMARK_TOURNAMENT_NAME = 'bernie'
+
+# Registered benchmarks, by name, in order of registration
+BENCHMARKS = {}
+
+
+def benchmark(name):
+    """ Decorator that registers a benchmark function """
+
+    def register(func):
+        BENCHMARKS[name] = func
+        return func
+    return register
+
+
+class BenchmarkContext:
+    """
+    Input and scratch space of a benchmark.
+
+    Attributes:
+        data_directory: Data directory with the generated dataset of BENCHMARK_ROUND
+        work_directory: Empty directory the benchmark can write to
+        spec: synthetic.DatasetSpec of the generated dataset
+        precision: Precision of the feature matrices
+    """
+
+    def __init__(self, data_directory, work_directory, spec, precision='float32'):
+        self.data_directory = Path(data_directory)
+        self.work_directory = Path(work_directory)
+        self.spec = spec
+        self.precision = precision
+
+    def get_dataset_filename(self, name):
+        """ Get the filename of the generated 'training' or 'tournament' data """
+
+        filename = 'numerai_{}_data.csv'.format(name)
+        return self.data_directory / 'numerai_dataset_{}'.format(BENCHMARK_ROUND) / filename
+
+    def get_zip_filename(self):
+        return self.data_directory / 'numerai_dataset_{}.zip'.format(BENCHMARK_ROUND)
+
+    def create_numerauto(self):
+        """
+        Creates a Numerauto instance for the generated dataset, with its
+        working files in the work directory. The tournament list is stored in
+        the metadata cache, so the Numerai API is never queried.
+        """
+
+        numerauto = Numerauto(tournament_id=BENCHMARK_TOURNAMENT_ID, data_directory=self.data_directory,
+                              feature_precision=self.precision,
+                              journal=CheckpointJournal(self.work_directory / 'checkpoints.db'))
+        numerauto.napi.cache.put('tournaments', 'tournaments',
+                                 [{'tournament': BENCHMARK_TOURNAMENT_ID, 'name': BENCHMARK_TOURNAMENT_NAME,
+                                   'active': True}])
+        numerauto.persistent_state = {'last_round_processed': None, 'last_round_trained': None}
+        return numerauto
+
+
+@benchmark('check_dataset')
+def benchmark_check_dataset(context):
+    """ Compares the training data with an identical copy, which reads both files completely """
+
+    filename = context.get_dataset_filename('training')
+    copy = context.work_directory / 'numerai_training_data.csv'
+    shutil.copyfile(str(filename), str(copy))
+    return context.spec.train_rows, lambda: check_dataset(filename, copy)
+
+
+@benchmark('fingerprint')
+def benchmark_fingerprint(context):
+    """ Fingerprints the training data, with per-row hashes """
+
+    filename = context.get_dataset_filename('training')
+    return context.spec.train_rows, lambda: DatasetFingerprint.from_file(filename, keep_rows=True)
+
+
+@benchmark('load_csv')
+def benchmark_load_csv(context):
+    """ Loads the training data CSV file """
+
+    filename = context.get_dataset_filename('training')
+    return context.spec.train_rows, lambda: load_dataset(filename, precision=context.precision)
+
+
+@benchmark('convert_columnar')
+def benchmark_convert_columnar(context):
+    """ Converts the training data CSV file to a columnar store """
+
+    filename = context.get_dataset_filename('training')
+    directory = context.work_directory / 'columnar'
+    return context.spec.train_rows, lambda: convert_to_columnar(filename, directory, precision=context.precision)
+
+
+@benchmark('convert_zip')
+def benchmark_convert_zip(context):
+    """ Streams both dataset files out of the zip file into columnar stores """
+
+    directories = {'training': context.work_directory / 'training',
+                   'tournament': context.work_directory / 'tournament'}
+    rows = context.spec.train_rows + context.spec.tournament_rows
+    return rows, lambda: convert_zip_to_columnar(context.get_zip_filename(), directories,
+                                                 precision=context.precision)
+
+
+@benchmark('load_columnar')
+def benchmark_load_columnar(context):
+    """ Memory-maps a columnar store and decodes its feature matrix """
+
+    directory = context.work_directory / 'columnar'
+    convert_to_columnar(context.get_dataset_filename('training'), directory, precision=context.precision)
+    return context.spec.train_rows, lambda: load_columnar(directory).get_feature_matrix()
+
+
+@benchmark('fit')
+def benchmark_fit(context):
+    """ Fits a model with SKLearnModelTrainer on the (preloaded) training data """
+
+    trainer, numerauto = create_trainer(context)
+    numerauto.get_dataset(BENCHMARK_ROUND, 'training')
+    return context.spec.train_rows, lambda: trainer.on_new_training_data(BENCHMARK_ROUND)
+
+
+@benchmark('predict')
+def benchmark_predict(context):
+    """ Applies a model with SKLearnModelTrainer to the (preloaded) tournament data """
+
+    trainer, numerauto = create_trainer(context)
+    trainer.on_new_training_data(BENCHMARK_ROUND)
+    numerauto.persistent_state['last_round_trained'] = BENCHMARK_ROUND
+    numerauto.get_dataset(BENCHMARK_ROUND, 'tournament')
+    return context.spec.tournament_rows, lambda: trainer.on_new_tournament_data(BENCHMARK_ROUND)
+
+
+@benchmark('write_predictions')
+def benchmark_write_predictions(context):
+    """ Writes a predictions file for the tournament data """
+
+    ids = load_columnar_ids(context, 'tournament')
+    probabilities = numpy.random.default_rng(0).random(len(ids))
+    filename = context.work_directory / 'predictions.csv'
+
+    def write():
+        with PredictionWriter(filename, 'probability_' + BENCHMARK_TOURNAMENT_NAME) as writer:
+            writer.write(ids, probabilities)
+
+    return len(ids), write
+
+
+def load_columnar_ids(context, name):
+    """ Get the ids of a generated dataset file """
+
+    directory = context.work_directory / 'columnar_{}'.format(name)
+    convert_to_columnar(context.get_dataset_filename(name), directory, precision=context.precision)
+    return load_columnar(directory).ids
+
+
+def create_trainer(context):
+    """
+    Creates an SKLearnModelTrainer with a logistic regression model, which
+    writes its models and predictions to the work directory.
+
+    Returns:
+        (SKLearnModelTrainer, Numerauto) tuple
+
+    Raises:
+        ImportError: scikit-learn is not installed
+    """
+
+    from sklearn.linear_model import LogisticRegression
+    from numerauto.eventhandlers import SKLearnModelTrainer
+
+    # The trainer writes to ./models and ./predictions
+    os.chdir(str(context.work_directory))
+
+    numerauto = context.create_numerauto()
+    trainer = SKLearnModelTrainer('benchmark', lambda: LogisticRegression(max_iter=200))
+    numerauto.add_event_handler(trainer)
+    return trainer, numerauto
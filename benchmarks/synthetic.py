@@ -0,0 +1,211 @@
+"""
+Generator of synthetic Numerai datasets.
+
+The datasets have the layout that numerauto expects: an id, era and data_type
+column, quantized feature columns (values 0, 0.25, 0.5, 0.75 and 1) and one
+binary target column per tournament. The training data contains 'train'
+rows, the tournament data 'validation' rows (with targets) and 'test' and
+'live' rows (without targets, in era 'eraX'). The targets depend weakly on a
+few features, so models have something to learn.
+
+Datasets are generated in chunks of rows, so datasets larger than memory can
+be generated, and are fully determined by their parameters and seed.
+"""
+
+import os
+import zipfile
+import logging
+from pathlib import Path
+
+import numpy
+import pandas
+
+
+logger = logging.getLogger(__name__)
+
+
+# Number of rows that are generated and written at once
+GENERATE_CHUNKSIZE = 100000
+
+# Tournament names for which target columns are generated, in order
+TOURNAMENT_NAMES = ('bernie', 'elizabeth', 'jordan', 'ken', 'charles', 'frank', 'hillary')
+
+# Fractions of the tournament rows of each data type
+TOURNAMENT_DATA_TYPES = (('validation', 0.3), ('test', 0.65), ('live', 0.05))
+
+# Predefined dataset scales: (training rows, tournament rows, features, eras)
+SCALES = {'tiny': (5000, 2000, 20, 20),
+          'small': (50000, 20000, 50, 60),
+          'medium': (200000, 100000, 310, 120),
+          'full': (500000, 400000, 310, 120)}
+
+# Number of features on which the targets depend
+SIGNAL_FEATURES = 5
+
+
+class DatasetSpec:
+    """
+    Parameters of a synthetic dataset.
+
+    Attributes:
+        train_rows: Number of rows of the training data
+        tournament_rows: Number of rows of the tournament data
+        num_features: Number of feature columns
+        num_eras: Number of training eras
+        num_targets: Number of target columns (see TOURNAMENT_NAMES)
+        seed: Seed of the random number generator
+    """
+
+    def __init__(self, train_rows, tournament_rows, num_features, num_eras, num_targets=1, seed=0):
+        if num_targets > len(TOURNAMENT_NAMES):
+            raise ValueError('At most {} targets are supported'.format(len(TOURNAMENT_NAMES)))
+
+        self.train_rows = train_rows
+        self.tournament_rows = tournament_rows
+        self.num_features = num_features
+        self.num_eras = num_eras
+        self.num_targets = num_targets
+        self.seed = seed
+
+    @classmethod
+    def from_scale(cls, scale, num_targets=1, seed=0):
+        """ Creates a DatasetSpec of a predefined scale (see SCALES) """
+
+        if scale not in SCALES:
+            raise ValueError('Unknown scale: {}'.format(scale))
+        return cls(*SCALES[scale], num_targets=num_targets, seed=seed)
+
+    def to_dict(self):
+        return dict(self.__dict__)
+
+    @property
+    def feature_names(self):
+        return ['feature{}'.format(i + 1) for i in range(self.num_features)]
+
+    @property
+    def target_names(self):
+        return ['target_{}'.format(name) for name in TOURNAMENT_NAMES[:self.num_targets]]
+
+
+def generate_ids(start, stop, salt):
+    """
+    Generates unique, random looking ids of the form 'n' followed by 15 hex
+    digits for the rows start to stop. Row numbers are scrambled with a
+    multiplication by an odd constant modulo 2^60, which is a bijection, so
+    the ids of all rows are unique.
+    """
+
+    rows = numpy.arange(start, stop, dtype=numpy.uint64)
+    scrambled = (rows * numpy.uint64(0x9E3779B97F4A7C15) + numpy.uint64(salt)) & numpy.uint64((1 << 60) - 1)
+    return numpy.char.mod('n%015x', scrambled.astype(numpy.int64))
+
+
+def generate_chunk(spec, rng, start, stop, total, data_type, salt):
+    """
+    Generates rows start to stop of a dataset file.
+
+    Args:
+        spec: DatasetSpec
+        rng: numpy random Generator
+        start: Index of the first row
+        stop: Index after the last row
+        total: Number of rows of the dataset file
+        data_type: Data type of the rows, or None for the tournament layout
+                   (see TOURNAMENT_DATA_TYPES)
+        salt: Salt of the ids (see generate_ids)
+
+    Returns:
+        pandas DataFrame
+    """
+
+    n = stop - start
+    index = numpy.arange(start, stop)
+
+    if data_type is not None:
+        data_types = numpy.full(n, data_type, dtype=object)
+        era_numbers = index * spec.num_eras // max(total, 1) + 1
+        era_names = numpy.char.mod('era%d', era_numbers).astype(object)
+    else:
+        # Data types follow each other in the order of TOURNAMENT_DATA_TYPES
+        bounds = numpy.cumsum([fraction for _, fraction in TOURNAMENT_DATA_TYPES]) * total
+        type_index = numpy.searchsorted(bounds, index, side='right')
+        data_types = numpy.array([name for name, _ in TOURNAMENT_DATA_TYPES], dtype=object)[type_index]
+        validation_eras = max(spec.num_eras // 10, 1)
+        era_numbers = spec.num_eras + 1 + index * validation_eras // max(int(bounds[0]), 1)
+        era_names = numpy.char.mod('era%d', era_numbers).astype(object)
+        era_names[data_types != 'validation'] = 'eraX'
+
+    features = rng.integers(0, 5, size=(n, spec.num_features)).astype(numpy.float32) / 4
+
+    frame = pandas.DataFrame(features, columns=spec.feature_names)
+    frame.insert(0, 'id', generate_ids(start, stop, salt))
+    frame.insert(1, 'era', era_names)
+    frame.insert(2, 'data_type', data_types)
+
+    signal = features[:, :min(SIGNAL_FEATURES, spec.num_features)].mean(axis=1) - 0.5
+    for i, name in enumerate(spec.target_names):
+        noise = rng.normal(scale=0.5, size=n)
+        target = (signal * (1 + 0.1 * i) + noise > 0).astype(numpy.float32)
+        if data_type is None:
+            target[data_types != 'validation'] = numpy.nan
+        frame[name] = target
+
+    return frame
+
+
+def write_dataset_file(filename, spec, rows, data_type, seed):
+    """ Writes a dataset CSV file in chunks """
+
+    logger.info('Generating %s (%d rows)', filename, rows)
+
+    rng = numpy.random.default_rng(seed)
+    with open(filename, 'w', newline='') as fp:
+        for start in range(0, max(rows, 1), GENERATE_CHUNKSIZE):
+            stop = min(start + GENERATE_CHUNKSIZE, rows)
+            chunk = generate_chunk(spec, rng, start, stop, rows, data_type, seed)
+            chunk.to_csv(fp, index=False, header=(start == 0))
+
+
+def generate_dataset(data_directory, round_number, spec, tournament_seed=None):
+    """
+    Generates the dataset of a round in the layout of the data directory of
+    Numerauto:
+        <data_directory>/numerai_dataset_<round>/numerai_training_data.csv
+        <data_directory>/numerai_dataset_<round>/numerai_tournament_data.csv
+        <data_directory>/numerai_dataset_<round>.zip
+
+    Args:
+        data_directory: Data directory
+        round_number: Round number
+        spec: DatasetSpec
+        tournament_seed: Seed of the tournament data (default: None, i.e. the
+                         seed of the spec plus one). Datasets of successive
+                         rounds with the same spec and different tournament
+                         seeds have the same training data and new live data.
+
+    Returns:
+        Dictionary with the paths of the training and tournament data and the
+        zip file.
+    """
+
+    dataset_path = Path(data_directory) / 'numerai_dataset_{}'.format(round_number)
+    dataset_path.mkdir(parents=True, exist_ok=True)
+
+    paths = {'training': dataset_path / 'numerai_training_data.csv',
+             'tournament': dataset_path / 'numerai_tournament_data.csv',
+             'zip': Path(data_directory) / 'numerai_dataset_{}.zip'.format(round_number)}
+
+    if tournament_seed is None:
+        tournament_seed = spec.seed + 1
+
+    write_dataset_file(paths['training'], spec, spec.train_rows, 'train', spec.seed)
+    write_dataset_file(paths['tournament'], spec, spec.tournament_rows, None, tournament_seed)
+
+    logger.info('Writing %s', paths['zip'])
+    tmp_filename = '{}.tmp'.format(paths['zip'])
+    with zipfile.ZipFile(tmp_filename, 'w', compression=zipfile.ZIP_DEFLATED) as z:
+        for name in ('training', 'tournament'):
+            z.write(paths[name], arcname=os.path.basename(str(paths[name])))
+    os.replace(tmp_filename, str(paths['zip']))
+
+    return paths
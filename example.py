@@ -16,6 +16,12 @@ from numerauto import Numerauto
 from numerauto.eventhandlers import SKLearnModelTrainer, PredictionUploader
 
 
+def create_model():
+    # A module-level factory (unlike a lambda) can be pickled, which is
+    # needed when event handlers run in a process pool (executor='process')
+    return LogisticRegression()
+
+
 # Set up logging to file and stdout
 log_format = "%(asctime)s [%(levelname)8s] %(name)s: %(message)s"
 logging.basicConfig(format=log_format, level=logging.DEBUG,
@@ -23,54 +29,28 @@ logging.basicConfig(format=log_format, level=logging.DEBUG,
                               logging.StreamHandler(sys.stdout)])
 
 # Create Numerauto instance and add event handlers
-# Note that the event handlers are processed in the order they are added
-na = Numerauto()
+# Numerauto detects rounds and downloads the dataset once, and dispatches the
+# events of per-tournament event handlers (such as the model trainer and
+# prediction uploader below) once for each of the given tournaments.
+# Note that the event handlers are processed in the order they are added,
+# unless max_workers is set to run independent handlers concurrently, e.g.:
+# na = Numerauto(tournament_ids=[1, 2, 3, 4, 5], max_workers=4)
+na = Numerauto(tournament_ids=[1, 2, 3, 4, 5])
 
-# Model trainers: One for each tournament ID
-# The tournament ID defaults to that of the Numerauto instance (which defaults to 1)
+# Model trainer: Trains a model for each tournament
+# Use the tournament_id argument to train for a single tournament only
 
 # Models are stored in ./models/tournament_<name>/round_<num>/<name>.p
 # Predictions are stored in ./predictions/tournament_<name>/round_<num>/<name>.csv
-na.add_event_handler(SKLearnModelTrainer('logistic_regression1',
-                                         lambda: LogisticRegression()))
-na.add_event_handler(SKLearnModelTrainer('logistic_regression2',
-                                         lambda: LogisticRegression(),
-                                         tournament_id=2))
-na.add_event_handler(SKLearnModelTrainer('logistic_regression3',
-                                         lambda: LogisticRegression(),
-                                         tournament_id=3))
-na.add_event_handler(SKLearnModelTrainer('logistic_regression4',
-                                         lambda: LogisticRegression(),
-                                         tournament_id=4))
-na.add_event_handler(SKLearnModelTrainer('logistic_regression5',
-                                         lambda: LogisticRegression(),
-                                         tournament_id=5))
+na.add_event_handler(SKLearnModelTrainer('logistic_regression', create_model))
 
-# Prediction uploaders: One for each tournament
-na.add_event_handler(PredictionUploader('logistic_regression_uploader1',
-                                        'logistic_regression1.csv',
-                                        'insert your publickey here',
-                                        'insert your secretkey here'))
-na.add_event_handler(PredictionUploader('logistic_regression_uploader2',
-                                        'logistic_regression2.csv',
-                                        'insert your publickey here',
-                                        'insert your secretkey here',
-                                        tournament_id=2))
-na.add_event_handler(PredictionUploader('logistic_regression_uploader3',
-                                        'logistic_regression3.csv',
-                                        'insert your publickey here',
-                                        'insert your secretkey here',
-                                        tournament_id=3))
-na.add_event_handler(PredictionUploader('logistic_regression_uploader4',
-                                        'logistic_regression4.csv',
-                                        'insert your publickey here',
-                                        'insert your secretkey here',
-                                        tournament_id=4))
-na.add_event_handler(PredictionUploader('logistic_regression_uploader5',
-                                        'logistic_regression5.csv',
+# Prediction uploader: Uploads the predictions for each tournament
+# The uploader depends on the model trainer that writes its predictions files
+na.add_event_handler(PredictionUploader('logistic_regression_uploader',
+                                        'logistic_regression.csv',
                                         'insert your publickey here',
-                                        'insert your secretkey here',
-                                        tournament_id=5))
+                                        'insert your secretkey here'),
+                     depends_on=['logistic_regression'])
 try:
     na.run()
 except Exception as e:
@@ -0,0 +1,468 @@
+"""
+asyncio version of the Numerauto daemon
+"""
+
+import asyncio
+import functools
+import inspect
+import signal
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import dateutil
+
+from .numerauto import Numerauto, PROBE_TIMEOUT
+from .scheduler import InterruptedException
+from .journal import IncompleteStepException
+from .detection import RoundDetection
+from .instrumentation import Timer, measure_call
+
+
+logger = logging.getLogger(__name__)
+
+
+# Number of threads that run blocking Numerai API calls and dataset operations
+API_WORKERS = 4
+
+
+class AsyncNumerauto(Numerauto):
+    """
+    asyncio version of the Numerai daemon.
+
+    AsyncNumerauto detects and processes rounds like Numerauto, but its run
+    method is a coroutine that runs in an asyncio event loop:
+        asyncio.run(AsyncNumerauto().run())
+
+    Numerai API calls, downloads and dataset checks run in a thread pool, so
+    their waits and retries do not block the event loop. Event handlers can
+    implement events as coroutines (async def), which are awaited in the event
+    loop. Events that are implemented as regular methods are run in the
+    executor of the instance (see the max_workers and executor arguments of
+    Numerauto). Event handlers run as soon as the handlers they depend on have
+    finished, like Numerauto.dispatch_event does for max_workers > 1.
+
+    Only one instance (Numerauto or AsyncNumerauto) can run in a working
+    directory at a time, because they share state.pickle, checkpoints.db and
+    the ./models, ./predictions and ./metrics directories.
+
+    Attributes (in addition to those of Numerauto):
+        api_executor: Thread pool for blocking API calls and dataset operations
+        handler_executor: Executor for event handlers that are not coroutines
+    """
+
+    def __init__(self, *args, **kwargs):
+        """
+        Creates an AsyncNumerauto instance. Takes the same arguments as
+        Numerauto.
+        """
+
+        super().__init__(*args, **kwargs)
+        self.api_executor = None
+        self.handler_executor = None
+
+    def __getstate__(self):
+        # Executors can not be pickled, see Numerauto.__getstate__
+        state = super().__getstate__()
+        state['api_executor'] = None
+        state['handler_executor'] = None
+        return state
+
+    async def run_blocking(self, func, *args, **kwargs):
+        """
+        Runs a blocking function (e.g. a Numerai API call) in the thread pool
+        of this instance.
+
+        Returns:
+            Return value of the function
+        """
+
+        if self.api_executor is None:
+            self.api_executor = ThreadPoolExecutor(max_workers=API_WORKERS)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.api_executor, functools.partial(func, *args, **kwargs))
+
+    async def call_event_task(self, task):
+        """
+        Calls an event on an event handler. Coroutines are awaited, other
+        events are run in the handler executor. The call is measured by the
+        instrumentation of this instance (without CPU time for coroutines,
+        which share the thread of the event loop).
+
+        Args:
+            task: EventTask to run
+        """
+
+        if inspect.iscoroutinefunction(getattr(task.handler, task.event)):
+            # Coroutines are not profiled, see profiling.Profiler
+            with self.instrumentation.measure('handler', task.handler.name, event=task.event,
+                                              tournament_id=task.tournament_id, cpu_clock=None):
+                return await getattr(task.handler, task.event)(*task.args)
+
+        if self.handler_executor is None:
+            self.handler_executor = self.create_executor()
+
+        loop = asyncio.get_running_loop()
+        timer = Timer(cpu_clock=None)
+        try:
+            # The call is measured in the worker that runs it
+            func, args = self.get_task_call(task)
+            result, values = await loop.run_in_executor(self.handler_executor, measure_call, func, *args)
+        except BaseException:
+            self.record_event_task(task, timer.stop(), error=True)
+            raise
+
+        self.record_event_task(task, values)
+        return result
+
+    async def dispatch_event(self, event, *args):
+        """
+        Calls an event on all event handlers. Each handler starts as soon as
+        the handlers it depends on have finished. If a handler raises an
+        exception, the handlers that depend on it are skipped, the other
+        handlers are completed and the exception is then re-raised. Calls that
+        completed before are skipped, see Numerauto.dispatch_event.
+
+        Args:
+            event: Name of the event (e.g. 'on_new_training_data')
+            args: Arguments of the event
+        """
+
+        with self.instrumentation.measure('event', event, cpu_clock='process'):
+            await self.dispatch_event_tasks(event, self.get_event_tasks(event, *args))
+
+    async def dispatch_event_tasks(self, event, tasks):
+        """ Runs the calls of an event, see dispatch_event """
+
+        futures = {}
+        errors = []
+
+        async def run_task(task):
+            # Returns whether the task succeeded (or completed before)
+            if self.is_task_complete(task):
+                return True
+
+            for dependency in task.depends_on:
+                if not await futures[dependency]:
+                    logger.error('%s: Skipping event handler %s because a dependency failed',
+                                 event, task.name)
+                    return False
+
+            try:
+                await self.call_event_task(task)
+            except IncompleteStepException as e:
+                self.record_incomplete_task(task, e)
+                return False
+            except Exception as e:
+                logger.exception('%s: Event handler %s failed', event, task.name)
+                errors.append(e)
+                return False
+
+            self.mark_task_complete(task)
+            return True
+
+        # Tasks come after their dependencies, so their futures already exist
+        for task in tasks:
+            futures[task] = asyncio.ensure_future(run_task(task))
+
+        await asyncio.gather(*futures.values())
+
+        if errors:
+            raise errors[0]
+
+    async def on_start(self):
+        """ Internal event on daemon start """
+
+        logger.debug('on_start')
+        await self.dispatch_event('on_start')
+
+    async def on_shutdown(self):
+        """ Internal event on daemon shutdown """
+
+        logger.debug('on_shutdown')
+        await self.dispatch_event('on_shutdown')
+
+    async def on_round_begin(self, round_number):
+        """ Internal event on round start """
+
+        logger.debug('on_round_begin(%d)', round_number)
+        await self.dispatch_event('on_round_begin', round_number)
+
+    async def on_training_data_delta(self, round_number, delta):
+        """ Internal event on detection of changes in the training data """
+
+        logger.debug('on_training_data_delta(%d)', round_number)
+        self.training_data_deltas[round_number] = delta
+        await self.dispatch_event('on_training_data_delta', round_number, delta)
+
+    async def on_new_training_data(self, round_number):
+        """ Internal event on detection of new training data """
+
+        logger.debug('on_new_training_data(%d)', round_number)
+        await self.dispatch_event('on_new_training_data', round_number)
+
+    async def on_new_tournament_data(self, round_number):
+        """ Internal event on detection of new tournament data """
+
+        logger.debug('on_new_tournament_data(%d)', round_number)
+        await self.dispatch_event('on_new_tournament_data', round_number)
+
+    async def on_round_begin_internal(self, round_number):
+        """ Internal event on round start """
+
+        logger.debug('on_round_begin_internal(%d)', round_number)
+        try:
+            await self.on_round_begin(round_number)
+
+            # Check if training is needed, if so call on_new_training_data
+            if await self.run_blocking(self.run_step, 'check_new_training_data', self.check_new_training_data,
+                                       round_number):
+                # Signal the changes in the training data, if they are known
+                if self.persistent_state['last_round_trained'] is not None:
+                    delta = await self.run_blocking(self.run_step, 'get_training_delta', self.get_training_delta,
+                                                    self.persistent_state['last_round_trained'], round_number)
+                    if delta is not None:
+                        logger.info('on_round_begin_internal: %s', delta)
+                        await self.on_training_data_delta(round_number, delta)
+
+                # Signal new training data
+                await self.on_new_training_data(round_number)
+                self.persistent_state['last_round_trained'] = round_number
+
+                # Immediately save state to prevent retraining if other event handlers fail
+                self.save_state()
+
+            # Signal new tournament data
+            await self.on_new_tournament_data(round_number)
+        finally:
+            # Free the memory of the cached datasets while waiting for the next round,
+            # also if an event handler failed
+            self.dataset_cache.clear()
+            self.training_data_deltas.clear()
+
+    async def wait_till_next_round(self):
+        """
+        Wait until a new Numerai round is detected, see
+        Numerauto.wait_till_next_round.
+
+        Returns:
+            Dictionary with the new round information.
+        """
+
+        logger.debug('wait_till_next_round')
+
+        round_info = await self.run_blocking(self.napi.get_current_round_details,
+                                             tournament=self.tournament_id)
+        dt_round_close = dateutil.parser.parse(round_info['closeTime'])
+
+        new_round_info = round_info
+
+        dt_now = self.scheduler.now()
+        logger.info('Waiting for round %d. Time to next round: %.1f hours',
+                    self.persistent_state['last_round_processed'] + 1,
+                    (dt_round_close - dt_now).total_seconds() / 3600)
+
+        detection = RoundDetection(round_info['number'] + 1, dt_round_close)
+
+        # Loop until the API reports a new round number
+        probe = None
+        while new_round_info['number'] == round_info['number']:
+            await self.scheduler.async_wait_until(self.get_next_poll_time(dt_round_close, detection.dataset_changed))
+
+            # Probe the dataset while the round number is polled. A probe that
+            # is still running from a previous poll is not repeated.
+            if self.round_detection.probe_dataset and (probe is None or probe.done()):
+                probe = asyncio.ensure_future(self.run_blocking(self.probe_dataset))
+
+            new_round_info = await self.run_blocking(self.napi.get_current_round_details,
+                                                     tournament=self.tournament_id, refresh=True)
+            detection.polls += 1
+            if probe is not None:
+                try:
+                    remote = await asyncio.wait_for(asyncio.shield(probe), PROBE_TIMEOUT)
+                    detection.update_dataset(remote, self.scheduler.now())
+                except asyncio.TimeoutError:
+                    logger.warning('probe_dataset: No response within %d seconds', PROBE_TIMEOUT)
+
+            self.log_round_poll(new_round_info, dt_round_close)
+
+        self.record_round_detection(detection, new_round_info)
+        return new_round_info
+
+    async def run_new_round(self):
+        """
+        Internal function that downloads and verifies a new dataset and calls
+        the internal event handlers.
+        """
+
+        logger.debug('run_new_round')
+        self.instrumentation.begin_round(self.round_number)
+        self.incomplete_tasks = []
+        try:
+            if not await self.run_blocking(self.is_dataset_checked, self.round_number):
+                # Download data. If data is not valid, wait 10 minutes and try again.
+                valid = await self.run_blocking(self.run_step, 'download_and_check', self.download_and_check)
+
+                while not valid:
+                    logger.info('run_new_round: New dataset is not valid, retrying in 10 minutes')
+
+                    self.remove_downloaded_dataset()
+
+                    await self.scheduler.async_wait(600)
+
+                    valid = await self.run_blocking(self.run_step, 'download_and_check', self.download_and_check)
+
+                self.journal.mark_complete(self.round_number, 'download_and_check')
+
+            if self.convert_columnar:
+                await self.run_blocking(self.run_step, 'convert_dataset', self.convert_dataset, self.round_number)
+
+            # Call round begin event
+            await self.on_round_begin_internal(self.round_number)
+
+            # Save current round as the last round processed, see Numerauto.run_new_round
+            self.persistent_state['last_round_processed'] = self.round_number
+            self.persistent_state['last_round_incomplete'] = len(self.incomplete_tasks) > 0
+
+            # Save persistent state (in case of any crash)
+            self.save_state()
+
+            # Earlier rounds are not processed again
+            self.journal.prune(self.round_number)
+        finally:
+            # Write the measurements of the round, also if a step or event handler failed
+            self.instrumentation.end_round()
+
+    def install_signal_handlers(self, task):
+        """ Cancel a task on SIGINT/SIGTERM to gracefully exit """
+
+        loop = asyncio.get_running_loop()
+        signalled = []
+
+        def cancel(signum=None, frame=None):
+            # Cancel only once, so repeated signals do not interrupt the shutdown
+            if not signalled:
+                logger.info('Signal received, exiting!')
+                signalled.append(signum)
+                loop.call_soon_threadsafe(task.cancel)
+                # Also interrupt waits (e.g. retries) in executor threads
+                loop.call_soon_threadsafe(self.scheduler.request_stop)
+
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(signum, cancel)
+            except NotImplementedError:
+                # Event loops on Windows do not support signal handlers
+                signal.signal(signum, cancel)
+
+    async def shutdown_executors(self):
+        """
+        Shut down the executors of this instance, if they were started. Calls
+        that have not started are cancelled, and running calls are waited for
+        (without blocking the event loop), so they do not use the journal or
+        the state after the daemon has closed them.
+        """
+
+        loop = asyncio.get_running_loop()
+        for name in ('api_executor', 'handler_executor'):
+            executor = getattr(self, name)
+            if executor is not None:
+                logger.debug('shutdown_executors: Shutting down %s', name)
+                await loop.run_in_executor(None, functools.partial(executor.shutdown, wait=True,
+                                                                   cancel_futures=True))
+                setattr(self, name, None)
+
+    # Run Numerauto in daemon mode
+    async def run(self, single_run=False, handle_signals=True):
+        """
+        Start the Numerauto daemon. Will process Numerai rounds until
+        interrupted or cancelled.
+
+        Args:
+            single_run: Indicates whether this function should only process
+                        one round after catching up to the current round, see
+                        Numerauto.run.
+            handle_signals: Install SIGINT/SIGTERM handlers that stop the
+                            daemon. Set to False when the daemon runs as one
+                            of several tasks in an event loop, and cancel its
+                            task instead.
+
+        Raises:
+            asyncio.CancelledError: The task was cancelled (other than by the
+                                    signal handlers of the daemon), after the
+                                    daemon has shut down.
+        """
+        logger.debug('run')
+
+        if handle_signals:
+            self.scheduler.reset()
+            self.install_signal_handlers(asyncio.current_task())
+
+        # Load internal state
+        self.load_state()
+
+        try:
+            # Trigger start event
+            await self.on_start()
+
+            self.round_number = await self.run_blocking(self.napi.get_current_round,
+                                                        tournament=self.tournament_id)
+            if self.persistent_state['last_round_processed'] is None:
+                # Without a state (e.g. state.pickle was removed), the round is
+                # processed and trained from the start
+                self.journal.clear(self.round_number)
+            if (self.persistent_state['last_round_processed'] is None or
+                    self.persistent_state['last_round_trained'] is None or
+                    self.round_number > self.persistent_state['last_round_processed'] or
+                    self.persistent_state['last_round_incomplete']):
+                logger.info('Current round (%d) does not appear to be processed',
+                            self.round_number)
+                await self.run_new_round()
+
+            logger.info('Entering daemon loop')
+
+            while True:
+                round_info = await self.run_blocking(self.napi.get_current_round_details,
+                                                     tournament=self.tournament_id, refresh=True)
+                # Check if we didn't already pass into the next round
+                if round_info['number'] == self.persistent_state['last_round_processed']:
+                    # In case of a single run, check whether we're not going to wait
+                    # too long (> 24 hours) for the next round
+                    if single_run:
+                        dt_round_close = dateutil.parser.parse(round_info['closeTime'])
+                        dt_now = self.scheduler.now()
+
+                        if (dt_round_close - dt_now).total_seconds() > 86400:
+                            logger.info('Single run stopping because new round is more than 1 day in the future')
+                            break
+
+                    # Wait till next round starts
+                    round_info = await self.wait_till_next_round()
+
+                self.round_number = round_info['number']
+                await self.run_new_round()
+
+                if single_run:
+                    # Stop after processing one round
+                    logger.info('Exiting daemon loop because of single_run')
+                    break
+        except asyncio.CancelledError:
+            logger.info('Exiting daemon loop because of interrupt')
+            # A cancellation by the signal handlers (which also request the
+            # scheduler to stop) ends the daemon normally
+            if not (handle_signals and self.scheduler.stop_requested()):
+                raise
+        except InterruptedException:
+            logger.info('Exiting daemon loop because of interrupt')
+        finally:
+            # Shut down also if the task was cancelled or an event handler failed
+            try:
+                # Trigger shutdown event
+                await self.on_shutdown()
+            finally:
+                await self.shutdown_executors()
+                self.shutdown_process_pool()
+                self.journal.close()
+
+                # Save internal state
+                self.save_state()
@@ -0,0 +1,306 @@
+"""
+Columnar storage of Numerai datasets.
+
+Numerai datasets are distributed as CSV files, which are slow to parse. This
+module converts a dataset to a columnar representation that is stored as
+plain binary files in a directory, and loads it again as memory-mapped numpy
+arrays:
+    meta.json       Column names, number of rows and data types
+    features.bin    Feature matrix (rows x features)
+    targets.bin     Target matrix (rows x targets), NaN if unknown
+    ids.npy         Row ids
+    eras.npy        Row eras
+    data_types.npy  Row data types
+"""
+
+import os
+import mmap
+import json
+import shutil
+import zipfile
+import logging
+
+import numpy
+
+from .utils import read_dataset_chunks, DATASET_CHUNKSIZE
+from .utils import NumeraiDataset, FeatureEncoder, FeatureQuantizationError, DatasetFingerprint
+from .utils import get_feature_columns, get_target_columns
+
+
+logger = logging.getLogger(__name__)
+
+
+# Dataset files in a Numerai dataset directory, by name
+DATASET_FILENAMES = {'training': 'numerai_training_data.csv',
+                     'tournament': 'numerai_tournament_data.csv'}
+
+
+class ColumnarWriter:
+    """
+    Writes a Numerai dataset to a columnar store, one chunk of rows at a time.
+    The store is written to a temporary directory that is moved into place
+    when the writer is closed, so an incomplete store is never loaded.
+    """
+
+    def __init__(self, directory, precision='float32'):
+        """
+        Creates a new ColumnarWriter.
+
+        Args:
+            directory: Directory of the columnar store
+            precision: Precision of the stored feature matrix (see
+                       utils.FEATURE_PRECISIONS)
+        """
+
+        self.directory = str(directory)
+        self.tmp_directory = self.directory + '.tmp'
+        self.encoder = FeatureEncoder(precision)
+        self.feature_names = None
+        self.target_names = None
+        self.rows = 0
+        self.ids = []
+        self.eras = []
+        self.data_types = []
+
+        if os.path.isdir(self.tmp_directory):
+            shutil.rmtree(self.tmp_directory)
+        os.makedirs(self.tmp_directory)
+
+        self.features_file = open(os.path.join(self.tmp_directory, 'features.bin'), 'wb')
+        self.targets_file = open(os.path.join(self.tmp_directory, 'targets.bin'), 'wb')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def append(self, chunk):
+        """
+        Append a chunk of rows to the store.
+
+        Args:
+            chunk: pandas DataFrame with the columns of a Numerai dataset
+        """
+
+        if self.feature_names is None:
+            self.feature_names = get_feature_columns(chunk.columns)
+            self.target_names = get_target_columns(chunk.columns)
+
+        self.ids.append(numpy.asarray(chunk['id'], dtype=str))
+        self.eras.append(numpy.asarray(chunk['era'], dtype=str))
+        self.data_types.append(numpy.asarray(chunk['data_type'], dtype=str))
+
+        self.encoder.encode(chunk[self.feature_names].values).tofile(self.features_file)
+        chunk[self.target_names].values.astype(numpy.float32).tofile(self.targets_file)
+
+        self.rows += len(chunk)
+
+    def close(self):
+        """ Finish writing the store and move it into place """
+
+        self.features_file.close()
+        self.targets_file.close()
+
+        numpy.save(os.path.join(self.tmp_directory, 'ids.npy'), _concatenate(self.ids))
+        numpy.save(os.path.join(self.tmp_directory, 'eras.npy'), _concatenate(self.eras))
+        numpy.save(os.path.join(self.tmp_directory, 'data_types.npy'), _concatenate(self.data_types))
+
+        meta = {'rows': self.rows,
+                'dtype': self.encoder.dtype.str,
+                'feature_scale': self.encoder.scale,
+                'feature_names': self.feature_names or [],
+                'target_names': self.target_names or []}
+        with open(os.path.join(self.tmp_directory, 'meta.json'), 'w') as fp:
+            json.dump(meta, fp)
+
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        os.rename(self.tmp_directory, self.directory)
+
+    def abort(self):
+        """ Stop writing the store and remove the temporary directory """
+
+        self.features_file.close()
+        self.targets_file.close()
+        shutil.rmtree(self.tmp_directory, ignore_errors=True)
+
+
+def _concatenate(arrays):
+    if len(arrays) == 0:
+        return numpy.empty(0, dtype=str)
+    return numpy.concatenate(arrays)
+
+
+def convert_to_columnar(filename, directory, precision='float32', chunksize=DATASET_CHUNKSIZE):
+    """
+    Converts a Numerai dataset CSV file to a columnar store. If 'uint8'
+    precision is requested but the features are not quantized, float32 is
+    used instead.
+
+    Args:
+        filename: Filename of the dataset
+        directory: Directory of the columnar store
+        precision: Precision of the stored feature matrix (see
+                   utils.FEATURE_PRECISIONS)
+        chunksize: Number of rows read per chunk
+    """
+
+    logger.info('convert_to_columnar: Converting %s', filename)
+
+    try:
+        with ColumnarWriter(directory, precision=precision) as writer:
+            for chunk in read_dataset_chunks(filename, chunksize=chunksize):
+                writer.append(chunk)
+    except FeatureQuantizationError as e:
+        logger.warning('convert_to_columnar: %s, converting %s as float32', e, filename)
+        convert_to_columnar(filename, directory, precision='float32', chunksize=chunksize)
+
+
+def convert_zip_to_columnar(zip_filename, directories, precision='float32', chunksize=DATASET_CHUNKSIZE,
+                            keep_rows=False):
+    """
+    Converts the dataset CSV files in a Numerai dataset zip file to columnar
+    stores and computes their fingerprints in the same pass. The CSV files
+    are streamed out of the zip file, so they are never extracted to disk.
+
+    Args:
+        zip_filename: Filename of the dataset zip file
+        directories: Dictionary of dataset name ('training' or 'tournament')
+                     to the directory of its columnar store
+        precision: Precision of the stored feature matrices (see
+                   utils.FEATURE_PRECISIONS)
+        chunksize: Number of rows read per chunk
+        keep_rows: Keep the id and digest of every row in the fingerprints
+                   (default: False)
+
+    Returns:
+        Dictionary of dataset filename to DatasetFingerprint, for the
+        datasets that were found in the zip file.
+    """
+
+    logger.info('convert_zip_to_columnar: Converting %s', zip_filename)
+
+    fingerprints = {}
+    with zipfile.ZipFile(str(zip_filename), 'r') as z:
+        members = {os.path.basename(m): m for m in z.namelist()}
+
+        for name, directory in directories.items():
+            filename = DATASET_FILENAMES[name]
+            if filename not in members:
+                logger.warning('convert_zip_to_columnar: %s not found in %s', filename, zip_filename)
+                continue
+
+            fingerprints[filename] = _convert_zip_member(z, members[filename], directory,
+                                                         precision, chunksize, keep_rows)
+
+    return fingerprints
+
+
+def _convert_zip_member(z, member, directory, precision, chunksize, keep_rows):
+    fingerprint = DatasetFingerprint(keep_rows=keep_rows)
+
+    try:
+        with z.open(member) as fp, ColumnarWriter(directory, precision=precision) as writer:
+            for chunk in read_dataset_chunks(fp, chunksize=chunksize):
+                writer.append(chunk)
+                fingerprint.update(chunk)
+    except FeatureQuantizationError as e:
+        logger.warning('convert_zip_to_columnar: %s, converting %s as float32', e, member)
+        return _convert_zip_member(z, member, directory, 'float32', chunksize, keep_rows)
+
+    return fingerprint
+
+
+def is_columnar(directory):
+    """ Returns whether a complete columnar store exists in a directory """
+    return os.path.isfile(os.path.join(str(directory), 'meta.json'))
+
+
+def load_columnar(directory):
+    """
+    Loads a columnar store as memory-mapped arrays. No data is read until the
+    arrays are accessed.
+
+    Args:
+        directory: Directory of the columnar store
+
+    Returns:
+        NumeraiDataset with read-only memory-mapped arrays
+    """
+
+    logger.debug('load_columnar(%s)', directory)
+
+    directory = str(directory)
+    with open(os.path.join(directory, 'meta.json'), 'r') as fp:
+        meta = json.load(fp)
+
+    rows = meta['rows']
+    feature_names = meta['feature_names']
+    target_names = meta['target_names']
+
+    features = _memmap(os.path.join(directory, 'features.bin'), meta['dtype'], (rows, len(feature_names)))
+    targets = _memmap(os.path.join(directory, 'targets.bin'), numpy.float32, (rows, len(target_names)))
+
+    return NumeraiDataset(numpy.load(os.path.join(directory, 'ids.npy'), mmap_mode='r'),
+                          numpy.load(os.path.join(directory, 'eras.npy'), mmap_mode='r'),
+                          numpy.load(os.path.join(directory, 'data_types.npy'), mmap_mode='r'),
+                          features, targets, feature_names, target_names,
+                          feature_scale=meta.get('feature_scale'))
+
+
+def _memmap(filename, dtype, shape):
+    # numpy can not memory-map empty files
+    if shape[0] * shape[1] == 0:
+        return numpy.empty(shape, dtype=dtype)
+    return numpy.memmap(filename, dtype=dtype, mode='r', shape=shape)
+
+
+class SharedArray:
+    """
+    Picklable reference to a memory-mapped array. When it is sent to another
+    process (e.g. through a ProcessPoolExecutor), only the filename and the
+    layout of the array are pickled, and the receiving process maps the same
+    file instead of receiving a copy of the data.
+    """
+
+    def __init__(self, array):
+        """
+        Creates a reference to a memory-mapped array.
+
+        Args:
+            array: numpy memmap opened in read-only mode
+        """
+
+        self.filename = array.filename
+        self.dtype = array.dtype.str
+        self.shape = array.shape
+        self.offset = array.offset
+
+    def open(self):
+        """ Maps the referenced array into memory (read-only) """
+        return numpy.memmap(self.filename, dtype=self.dtype, mode='r', shape=self.shape, offset=self.offset)
+
+
+def share_array(array):
+    """
+    Get an object that can be sent to another process to access an array.
+    Memory-mapped arrays are shared through a SharedArray reference, other
+    arrays (including views of memory-mapped arrays) are returned as is, and
+    will be copied when pickled.
+    """
+
+    if isinstance(array, numpy.memmap) and isinstance(array.base, mmap.mmap):
+        return SharedArray(array)
+    return array
+
+
+def open_shared_array(shared):
+    """ Opens an array that was shared using share_array """
+
+    if isinstance(shared, SharedArray):
+        return shared.open()
+    return shared
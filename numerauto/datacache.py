@@ -0,0 +1,151 @@
+"""
+Dataset cache shared by the event handlers of a Numerauto instance.
+"""
+
+import os
+import threading
+import logging
+
+from .columnar import DATASET_FILENAMES, is_columnar, load_columnar
+from .utils import NumeraiDataset, FeatureEncoder, FeatureQuantizationError, load_dataset
+
+
+logger = logging.getLogger(__name__)
+
+
+class DatasetCache:
+    """
+    Per-round cache of Numerai datasets. Each dataset file is loaded once, the
+    first time an event handler requests it, and the same read-only arrays
+    are handed out to every other handler. Datasets that were converted to a
+    columnar store are memory-mapped instead of parsed.
+
+    Concurrent requests for the same dataset are coalesced: only one thread
+    loads it while the others wait for its result. Requests for other
+    datasets (e.g. another file or precision) do not wait.
+
+    Attributes:
+        numerauto: Numerauto instance that owns this cache
+        datasets: Dictionary of (round number, name, precision) to NumeraiDataset
+    """
+
+    def __init__(self, numerauto):
+        """
+        Creates a new DatasetCache.
+
+        Args:
+            numerauto: Numerauto instance that owns this cache
+        """
+
+        self.numerauto = numerauto
+        self.datasets = {}
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+    def get(self, round_number, name, precision=None):
+        """
+        Get a dataset file of a round, loading it if it is not cached.
+
+        Args:
+            round_number: Number of the round.
+            name: Name of the dataset file ('training' or 'tournament').
+            precision: Precision of the feature matrix (default: None, i.e. the
+                       feature_precision of the Numerauto instance)
+
+        Returns:
+            NumeraiDataset with read-only arrays.
+        """
+
+        if precision is None:
+            precision = self.numerauto.feature_precision
+
+        key = (round_number, name, precision)
+        while True:
+            with self.lock:
+                if key in self.datasets:
+                    return self.datasets[key]
+
+                event = self.in_flight.get(key)
+                loading = event is None
+                if loading:
+                    event = self.in_flight[key] = threading.Event()
+
+            if not loading:
+                # Another thread is loading this dataset, use its result
+                event.wait()
+                continue
+
+            try:
+                dataset = self.load(round_number, name, precision)
+                with self.lock:
+                    self.datasets[key] = dataset
+                return dataset
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+                event.set()
+
+    def load(self, round_number, name, precision):
+        """ Load a dataset file of a round, bypassing the cache """
+
+        columnar_path = self.numerauto.get_columnar_path(round_number, name)
+        filename = self.numerauto.get_dataset_path(round_number) / DATASET_FILENAMES[name]
+        if not os.path.isfile(filename):
+            # The CSV file was not extracted, use (or create) the columnar store
+            self.numerauto.get_columnar_dataset(round_number, name)
+
+        if is_columnar(columnar_path):
+            logger.info('DatasetCache: Loading columnar %s data for round %d', name, round_number)
+            dataset = load_columnar(columnar_path)
+            if dataset.features.dtype.name == precision:
+                return dataset
+            return convert_precision(dataset, precision)
+
+        logger.info('DatasetCache: Loading %s data for round %d', name, round_number)
+        return load_dataset(filename, precision=precision)
+
+    def __getstate__(self):
+        # Locks can not be pickled, and cached datasets should not be copied
+        # when the owning Numerauto instance is sent to another process
+        state = self.__dict__.copy()
+        state['datasets'] = {}
+        state['in_flight'] = {}
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def clear(self):
+        """ Remove all datasets from the cache """
+
+        logger.debug('DatasetCache: clear')
+        with self.lock:
+            self.datasets = {}
+
+
+def convert_precision(dataset, precision):
+    """
+    Creates a copy of a dataset with its feature matrix in another precision.
+    The other arrays are shared with the original dataset. If the features
+    can not be quantized to 'uint8', the original dataset is returned.
+
+    Args:
+        dataset: NumeraiDataset
+        precision: Precision of the feature matrix (see utils.FEATURE_PRECISIONS)
+
+    Returns:
+        NumeraiDataset
+    """
+
+    encoder = FeatureEncoder(precision)
+    try:
+        features = encoder.encode(dataset.get_feature_matrix())
+    except FeatureQuantizationError as e:
+        logger.warning('convert_precision: %s, keeping %s features', e, dataset.features.dtype.name)
+        return dataset
+
+    features.flags.writeable = False
+    return NumeraiDataset(dataset.ids, dataset.eras, dataset.data_types, features, dataset.targets,
+                          dataset.feature_names, dataset.target_names, feature_scale=encoder.scale)
@@ -0,0 +1,183 @@
+"""
+Detection of the start of new Numerai rounds.
+"""
+
+import datetime
+import logging
+
+import dateutil.parser
+
+
+logger = logging.getLogger(__name__)
+
+
+class RoundDetectionStrategy:
+    """
+    Polling schedule that is used to detect the start of a new round.
+
+    Nothing is polled until lead_time seconds before the expected start of the
+    next round (the closing time of the current round). From then on, the
+    round number is polled every dense_interval seconds until dense_period
+    seconds after the expected start. If the round still has not started, the
+    interval backs off in proportion to the delay (backoff times the number of
+    seconds since the expected start), up to max_interval seconds.
+
+    If probe_dataset is set, the properties (ETag, Last-Modified date and
+    size) of the current dataset file are requested along with every poll of
+    the round number. As soon as the dataset changes, the round number is
+    polled every dense_interval seconds again, because the round is about to
+    start.
+
+    Attributes:
+        lead_time: Seconds before the expected start of the round at which
+                   polling starts
+        dense_interval: Seconds between polls around the expected start
+        dense_period: Seconds after the expected start during which polling
+                      stays dense
+        backoff: Poll interval after the dense period, as a fraction of the
+                 number of seconds since the expected start
+        max_interval: Maximum number of seconds between polls
+        probe_dataset: Whether the dataset file is probed along with the
+                       round number
+    """
+
+    def __init__(self, lead_time=60, dense_interval=5, dense_period=180, backoff=0.1,
+                 max_interval=300, probe_dataset=True):
+        """
+        Creates a new RoundDetectionStrategy.
+
+        Args:
+            lead_time: Seconds before the expected start of the round at which
+                       polling starts (default: 60)
+            dense_interval: Seconds between polls around the expected start
+                            (default: 5)
+            dense_period: Seconds after the expected start during which
+                          polling stays dense (default: 180)
+            backoff: Poll interval after the dense period, as a fraction of
+                     the number of seconds since the expected start
+                     (default: 0.1, e.g. every minute when the round is 10
+                     minutes late)
+            max_interval: Maximum number of seconds between polls (default: 300)
+            probe_dataset: Probe the dataset file along with the round number
+                           (default: True)
+        """
+
+        self.lead_time = lead_time
+        self.dense_interval = dense_interval
+        self.dense_period = dense_period
+        self.backoff = backoff
+        self.max_interval = max_interval
+        self.probe_dataset = probe_dataset
+
+    def get_next_poll_time(self, dt_round_close, dt_now, dataset_changed=False):
+        """
+        Get the time at which the round number should be polled next.
+
+        Args:
+            dt_round_close: Closing time of the current round (the expected
+                            start of the next round)
+            dt_now: Current time
+            dataset_changed: Whether a new dataset was detected
+
+        Returns:
+            datetime of the next poll.
+        """
+
+        if dataset_changed:
+            return dt_now + datetime.timedelta(seconds=self.dense_interval)
+
+        dt_start = dt_round_close - datetime.timedelta(seconds=self.lead_time)
+        if dt_now < dt_start:
+            return dt_start
+
+        seconds_late = (dt_now - dt_round_close).total_seconds()
+        if seconds_late <= self.dense_period:
+            interval = self.dense_interval
+        else:
+            interval = min(self.max_interval, max(self.dense_interval, seconds_late * self.backoff))
+
+        return dt_now + datetime.timedelta(seconds=interval)
+
+
+def dataset_version(remote):
+    """
+    Get the version of a dataset file from its properties (see
+    download.RemoteFile), or None if it is unknown.
+    """
+
+    if remote is None:
+        return None
+    return (remote.size, remote.etag, remote.last_modified)
+
+
+class RoundDetection:
+    """
+    Measurements of the detection of a new round.
+
+    Attributes:
+        round_number: Number of the round that was waited for
+        dt_expected: Expected start of the round
+        polls: Number of polls of the round number
+        dataset_version: Version of the dataset at the first probe
+        dt_dataset_changed: Time at which a new dataset was detected (None if
+                            it was not detected before the round started)
+    """
+
+    def __init__(self, round_number, dt_expected):
+        self.round_number = round_number
+        self.dt_expected = dt_expected
+        self.polls = 0
+        self.dataset_version = None
+        self.dt_dataset_changed = None
+
+    @property
+    def dataset_changed(self):
+        """ Whether a new dataset was detected """
+        return self.dt_dataset_changed is not None
+
+    def update_dataset(self, remote, dt_now):
+        """
+        Record the result of a probe of the dataset file.
+
+        Args:
+            remote: download.RemoteFile of the dataset, or None if the probe failed
+            dt_now: Time of the probe
+        """
+
+        version = dataset_version(remote)
+        if version is None or self.dataset_changed:
+            return
+
+        if self.dataset_version is None:
+            self.dataset_version = version
+        elif version != self.dataset_version:
+            logger.info('RoundDetection: New dataset detected while waiting for round %d',
+                        self.round_number)
+            self.dt_dataset_changed = dt_now
+
+    def to_dict(self, round_info, dt_detected):
+        """
+        Get the measurements as a dictionary, to store in the persistent state.
+
+        Args:
+            round_info: Details of the new round (see
+                        RobustNumerAPI.get_current_round_details)
+            dt_detected: Time at which the new round was detected
+
+        Returns:
+            Dictionary with the times (as ISO 8601 strings), the number of
+            polls and the detection lag in seconds: the time between the
+            opening time of the round (or the expected start if that is
+            unknown) and the detection.
+        """
+
+        dt_open = round_info.get('openTime')
+        dt_open = dateutil.parser.parse(dt_open) if dt_open else self.dt_expected
+
+        return {'expected': self.dt_expected.isoformat(),
+                'opened': dt_open.isoformat(),
+                'detected': dt_detected.isoformat(),
+                'dataset_changed': (self.dt_dataset_changed.isoformat()
+                                    if self.dt_dataset_changed is not None else None),
+                'polls': self.polls,
+                'lag': (dt_detected - dt_open).total_seconds()}
@@ -0,0 +1,316 @@
+"""
+Parallel, resumable and verified file downloads.
+
+A file is downloaded in parts using HTTP range requests, which run in
+parallel over a pooled requests Session. The parts are written to
+<filename>.part, and the progress is recorded in a sidecar file
+<filename>.download.json, so a download that is interrupted (by a crash or a
+network error) resumes with the missing parts. When the download is complete,
+its size and (if the ETag of the file is a plain MD5 checksum) its checksum
+are verified before it is moved into place. The sidecar file is kept, so the
+file is not transferred again while the ETag, Last-Modified date and size of
+the remote file are unchanged.
+"""
+
+import os
+import re
+import json
+import hashlib
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.exceptions import RequestException
+
+
+logger = logging.getLogger(__name__)
+
+
+# Size of the parts that are downloaded with one range request in bytes
+DOWNLOAD_PART_SIZE = 16 * 1024 * 1024
+
+# Number of parts that are downloaded in parallel
+DOWNLOAD_WORKERS = 4
+
+# Buffer size used while streaming and hashing files
+DOWNLOAD_BUFFER_SIZE = 1024 * 1024
+
+# An ETag that is a plain MD5 checksum (not a multipart upload ETag)
+MD5_ETAG = re.compile(r'^"?([0-9a-fA-F]{32})"?$')
+
+
+class DownloadError(RequestException):
+    """
+    Error that is raised if a download can not be completed or verified.
+    Subclass of RequestException, so it is handled like other failed requests.
+    """
+    pass
+
+
+class RemoteFile:
+    """
+    Properties of a remote file, as reported by the server.
+
+    Attributes:
+        size: Size in bytes (None if unknown)
+        etag: ETag header (None if not reported)
+        last_modified: Last-Modified header (None if not reported)
+        accept_ranges: Whether the server supports range requests
+    """
+
+    def __init__(self, size=None, etag=None, last_modified=None, accept_ranges=False):
+        self.size = size
+        self.etag = etag
+        self.last_modified = last_modified
+        self.accept_ranges = accept_ranges
+
+    def matches(self, state):
+        """ Returns whether a download state was recorded for this version of the file """
+
+        if state is None or (self.etag is None and self.last_modified is None):
+            return False
+        return (state.get('size') == self.size and state.get('etag') == self.etag and
+                state.get('last_modified') == self.last_modified)
+
+    def get_md5(self):
+        """ Returns the MD5 checksum in the ETag, or None if the ETag is not an MD5 checksum """
+
+        match = MD5_ETAG.match(self.etag or '')
+        return match.group(1).lower() if match else None
+
+
+class Downloader:
+    """
+    Downloads files with parallel range requests, resuming interrupted
+    downloads and skipping unchanged files.
+
+    Attributes:
+        session: requests Session used for all requests
+        timeout: Timeout of requests in seconds, or a (connect, read) tuple
+        workers: Number of parts that are downloaded in parallel
+        part_size: Size of the parts in bytes
+    """
+
+    def __init__(self, session, timeout=None, workers=DOWNLOAD_WORKERS, part_size=DOWNLOAD_PART_SIZE):
+        """
+        Creates a new Downloader.
+
+        Args:
+            session: requests Session used for all requests. Its connection
+                     pool should hold at least workers connections.
+            timeout: Timeout of requests in seconds, or a (connect, read) tuple
+            workers: Number of parts that are downloaded in parallel
+            part_size: Size of the parts in bytes
+        """
+
+        self.session = session
+        self.timeout = timeout
+        self.workers = workers
+        self.part_size = part_size
+        self.state_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['state_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.state_lock = threading.Lock()
+
+    def get_remote_file(self, url):
+        """
+        Requests the properties of a remote file. A range request for the
+        first byte is used instead of a HEAD request, because presigned
+        download URLs are often only valid for GET requests.
+
+        Args:
+            url: URL of the file
+
+        Returns:
+            RemoteFile
+        """
+
+        with self.session.get(url, headers={'Range': 'bytes=0-0'}, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+
+            size = None
+            content_range = r.headers.get('Content-Range', '')
+            if r.status_code == 206 and '/' in content_range and not content_range.endswith('/*'):
+                size = int(content_range.rsplit('/', 1)[1])
+            elif r.status_code == 200 and 'Content-Length' in r.headers:
+                size = int(r.headers['Content-Length'])
+
+            return RemoteFile(size=size, etag=r.headers.get('ETag'),
+                              last_modified=r.headers.get('Last-Modified'),
+                              accept_ranges=r.status_code == 206)
+
+    def download(self, url, filename):
+        """
+        Downloads a file, unless the file exists and the remote file did not
+        change since it was downloaded.
+
+        Args:
+            url: URL of the file
+            filename: Destination filename
+
+        Returns:
+            True if the file was transferred, False if it was unchanged.
+
+        Raises:
+            DownloadError: The downloaded file could not be verified
+            RequestException: A request failed (the download can be resumed)
+        """
+
+        logger.debug('Downloader.download(%s)', filename)
+
+        filename = str(filename)
+        tmp_filename = '{}.part'.format(filename)
+        remote = self.get_remote_file(url)
+        state = load_download_state(filename)
+
+        if os.path.isfile(filename) and state is not None and state.get('complete') and remote.matches(state):
+            logger.info('Downloader: %s is unchanged, skipping download', filename)
+            return False
+
+        if remote.size is None or not remote.accept_ranges:
+            # Range requests are not supported, download in a single request
+            logger.info('Downloader: Downloading %s in a single request', filename)
+            self.download_stream(url, tmp_filename)
+        else:
+            if not (os.path.isfile(tmp_filename) and state is not None and not state.get('complete') and
+                    remote.matches(state) and state.get('part_size') == self.part_size):
+                state = {'size': remote.size,
+                         'etag': remote.etag,
+                         'last_modified': remote.last_modified,
+                         'part_size': self.part_size,
+                         'parts': [],
+                         'complete': False}
+                with open(tmp_filename, 'wb') as fp:
+                    fp.truncate(remote.size)
+                save_download_state(filename, state)
+
+            self.download_parts(url, filename, tmp_filename, remote, state)
+
+        try:
+            verify_download(tmp_filename, remote)
+        except DownloadError:
+            # Start from scratch on the next attempt
+            os.remove(tmp_filename)
+            remove_download_state(filename)
+            raise
+
+        os.replace(tmp_filename, filename)
+        save_download_state(filename, {'size': remote.size,
+                                       'etag': remote.etag,
+                                       'last_modified': remote.last_modified,
+                                       'complete': True})
+        return True
+
+    def download_stream(self, url, tmp_filename):
+        """ Downloads a file in a single request """
+
+        with self.session.get(url, stream=True, timeout=self.timeout) as r:
+            r.raise_for_status()
+            with open(tmp_filename, 'wb') as fp:
+                for chunk in r.iter_content(chunk_size=DOWNLOAD_BUFFER_SIZE):
+                    fp.write(chunk)
+
+    def download_parts(self, url, filename, tmp_filename, remote, state):
+        """ Downloads the missing parts of a file in parallel, recording progress in the state """
+
+        num_parts = (remote.size + self.part_size - 1) // self.part_size
+        done = set(state['parts'])
+        missing = [i for i in range(num_parts) if i not in done]
+
+        logger.info('Downloader: Downloading %d of %d parts of %s', len(missing), num_parts, filename)
+
+        def download_part(index):
+            start = index * self.part_size
+            end = min(start + self.part_size, remote.size) - 1
+            headers = {'Range': 'bytes={}-{}'.format(start, end)}
+            if remote.etag is not None:
+                # Returns the whole file instead of the range if it changed
+                headers['If-Range'] = remote.etag
+
+            with self.session.get(url, headers=headers, stream=True, timeout=self.timeout) as r:
+                r.raise_for_status()
+                if r.status_code != 206:
+                    raise DownloadError('Remote file changed during download of {}'.format(filename))
+
+                with open(tmp_filename, 'r+b') as fp:
+                    fp.seek(start)
+                    written = 0
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_BUFFER_SIZE):
+                        fp.write(chunk)
+                        written += len(chunk)
+
+            if written != end - start + 1:
+                raise DownloadError('Incomplete part {} of {}'.format(index, filename))
+
+            with self.state_lock:
+                state['parts'].append(index)
+                save_download_state(filename, state)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            # Raise the first error after all parts have finished, so the
+            # progress of the other parts is recorded
+            futures = [executor.submit(download_part, i) for i in missing]
+            errors = [f.exception() for f in futures if f.exception() is not None]
+
+        if errors:
+            raise errors[0]
+
+
+def get_download_state_path(filename):
+    """ Get the path of the sidecar file with the download state of a file """
+    return '{}.download.json'.format(filename)
+
+
+def load_download_state(filename):
+    """ Load the download state of a file, or None if there is none """
+
+    try:
+        with open(get_download_state_path(filename), 'r') as fp:
+            return json.load(fp)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def save_download_state(filename, state):
+    """ Save the download state of a file """
+
+    tmp_filename = '{}.tmp'.format(get_download_state_path(filename))
+    with open(tmp_filename, 'w') as fp:
+        json.dump(state, fp)
+    os.replace(tmp_filename, get_download_state_path(filename))
+
+
+def remove_download_state(filename):
+    """ Remove the download state of a file, if it exists """
+
+    if os.path.isfile(get_download_state_path(filename)):
+        os.remove(get_download_state_path(filename))
+
+
+def verify_download(filename, remote):
+    """
+    Verifies the size of a downloaded file and, if the ETag of the remote file
+    is a plain MD5 checksum, its checksum.
+
+    Raises:
+        DownloadError: The file does not match the remote file
+    """
+
+    size = os.path.getsize(filename)
+    if remote.size is not None and size != remote.size:
+        raise DownloadError('Size of {} is {} bytes, expected {} bytes'.format(filename, size, remote.size))
+
+    md5 = remote.get_md5()
+    if md5 is not None:
+        hasher = hashlib.md5()
+        with open(filename, 'rb') as fp:
+            for block in iter(lambda: fp.read(DOWNLOAD_BUFFER_SIZE), b''):
+                hasher.update(block)
+        if hasher.hexdigest() != md5:
+            raise DownloadError('Checksum of {} does not match ETag {}'.format(filename, remote.etag))
@@ -4,13 +4,24 @@ Numerauto event handlers module
 
 import os
 from pathlib import Path
-import pickle
+import json
 import logging
 
-import pandas as pd
+import numpy as np
 
 from numerapi.utils import ensure_directory_exists
 from .robust_numerapi import RobustNumerAPI, NumerAPIError
+from .columnar import share_array, open_shared_array
+from .utils import decode_features, PredictionWriter, DATASET_CHUNKSIZE
+from .modelstore import PickleModelStore
+from .journal import IncompleteStepException
+
+
+# Default number of rows per partial_fit call of SKLearnModelTrainer
+DEFAULT_BATCH_SIZE = 10000
+
+# Default number of estimators added to an ensemble per warm_start update
+DEFAULT_WARM_START_INCREMENT = 10
 
 
 logger = logging.getLogger(__name__)
@@ -24,11 +35,22 @@ class EventHandler:
     Subclasses of EventHandler can override one or more of these events and
     implement custom code to execute when the event triggers.
 
+    Subclasses that set the class attribute per_tournament to True receive
+    on_training_data_delta, on_new_training_data and on_new_tournament_data
+    once for each tournament of the Numerauto instance (or only for their
+    tournament_id attribute, if it is set), with the tournament id as last
+    argument. Overrides of these events that do not accept the tournament id
+    are called once, without it.
+
     Attributes:
         name: Name of the event handler
         numerauto: Numerauto instance this handler is added to (None if not added)
+        depends_on: Names of the event handlers that must have finished
+                    handling an event before this handler handles it
     """
 
+    per_tournament = False
+
     def __init__(self, name):
         """
         Creates a new EventHandler instance.
@@ -42,6 +64,20 @@ class EventHandler:
 
         self.name = name
         self.numerauto = None
+        self.depends_on = []
+
+    def get_tournament_id(self, tournament_id=None):
+        """
+        Get the tournament id an event should be handled for: the tournament
+        id passed with the event, or else the tournament_id attribute of this
+        handler, or else the tournament id of the Numerauto instance.
+        """
+
+        if tournament_id is not None:
+            return tournament_id
+        if getattr(self, 'tournament_id', None) is not None:
+            return self.tournament_id
+        return self.numerauto.tournament_id
 
     def on_start(self):
         """ Triggered when the Numerauto daemon starts """
@@ -55,18 +91,121 @@ class EventHandler:
         """ Triggered when a new Numerai round is detected """
         pass
 
-    def on_new_training_data(self, round_number):
-        """ Triggered when new training data is detected """
+    def on_training_data_delta(self, round_number, delta, tournament_id=None):
+        """
+        Triggered before on_new_training_data, if the changes in the training
+        data since the last round trained are known. delta is a
+        utils.DatasetDelta with the eras (and ids) that were added, removed
+        or changed. tournament_id is only passed to per-tournament event
+        handlers.
+        """
         pass
 
-    def on_new_tournament_data(self, round_number):
+    def on_new_training_data(self, round_number, tournament_id=None):
+        """
+        Triggered when new training data is detected. tournament_id is only
+        passed to per-tournament event handlers.
+        """
+        pass
+
+    def on_new_tournament_data(self, round_number, tournament_id=None):
         """
         Triggered when new tournament data is detected. Currently this triggers
-        for every new round.
+        for every new round. tournament_id is only passed to per-tournament
+        event handlers.
         """
         pass
 
 
+def decode_shared_features(features, feature_scale):
+    """ Opens a shared feature matrix and decodes quantized features """
+
+    return decode_features(open_shared_array(features), feature_scale)
+
+
+def fit_model(model, features, targets, feature_scale=None):
+    """
+    Fits a model on a shared feature matrix (see columnar.share_array). Used
+    to fit models in a worker process.
+
+    Returns:
+        The fitted model
+    """
+
+    model.fit(decode_shared_features(features, feature_scale), targets)
+    return model
+
+
+def predict_model(model, features, feature_scale=None, batch_size=DATASET_CHUNKSIZE):
+    """
+    Applies a model to a shared feature matrix (see columnar.share_array) in
+    batches of batch_size rows, so only one batch is decoded at a time. Used
+    to apply models in a worker process.
+
+    Returns:
+        Probabilities of the positive class
+    """
+
+    features = open_shared_array(features)
+    return np.concatenate([predict_batch(model, features[start:start + batch_size], feature_scale)
+                           for start in range(0, len(features), batch_size)] or [np.empty(0)])
+
+
+def predict_batch(model, features, feature_scale=None):
+    """ Applies a model to a batch of (possibly quantized) features """
+
+    return model.predict_proba(decode_features(features, feature_scale))[:, 1]
+
+
+def is_ensemble(model):
+    """ Whether a model is an ensemble that grows with its n_estimators parameter """
+
+    return 'n_estimators' in model.get_params()
+
+
+def update_model(model, features, targets, rows, incremental, batch_size, feature_scale=None,
+                 warm_start_increment=DEFAULT_WARM_START_INCREMENT):
+    """
+    Continues training a model on a selection of rows of a (shared) feature
+    matrix (see columnar.share_array), either with partial_fit in batches of
+    rows, or with fit after enabling warm_start. With warm_start, the
+    n_estimators of an ensemble are raised by warm_start_increment, so that
+    the new estimators are fitted on the selected rows; other models use the
+    previous model only as the initial solution, so rows must then select
+    all rows. Only the selected rows are read from a memory-mapped feature
+    matrix. Can be used in a worker process.
+
+    Args:
+        model: Fitted model
+        features: Feature matrix, or a shared feature matrix
+        targets: Target vector
+        rows: Array of the indices of the rows to train on
+        incremental: 'partial_fit' or 'warm_start'
+        batch_size: Number of rows per partial_fit call
+        feature_scale: Scale of quantized features (None if not quantized)
+        warm_start_increment: Number of estimators added to an ensemble with warm_start
+
+    Returns:
+        The updated model
+    """
+
+    features = open_shared_array(features)
+
+    if incremental == 'partial_fit':
+        for start in range(0, len(rows), batch_size):
+            batch = rows[start:start + batch_size]
+            model.partial_fit(decode_features(features[batch], feature_scale), targets[batch])
+    elif incremental == 'warm_start':
+        model.set_params(warm_start=True)
+        if is_ensemble(model):
+            model.set_params(n_estimators=model.get_params()['n_estimators'] + warm_start_increment)
+        model.fit(decode_features(features[rows], feature_scale), targets[rows])
+    else:
+        raise ValueError('Unknown incremental mode: {}'.format(incremental))
+
+    return model
+
+
 class SKLearnModelTrainer(EventHandler):
     """
     Event handler that trains and applies models that adhere to the sklearn API.
@@ -75,12 +214,53 @@ class SKLearnModelTrainer(EventHandler):
 
     Each time the model is trained, it is saved to the ./models directory:
         ./models/tournament_<name>/round_<num>/<name>.p
-    Each time the model is applied, predictions are written to the ./predictions
-    directory:
+    (or <name>.cas.json with a modelstore.ContentAddressedModelStore, which
+    stores the arrays of the model as memory-mappable blobs that are shared
+    across rounds). Each time the model is applied, predictions are written
+    to the ./predictions directory:
         ./predictions/tournament_<name>/round_<num>/<name>.csv
+
+    If use_process_pool is set, the model is fit and applied in the process
+    pool of the Numerauto instance. The feature matrix is then read from the
+    columnar store of the dataset, which worker processes memory-map instead
+    of receiving a copy. Create the Numerauto instance with max_workers larger
+    than 1 to fit several models at the same time.
+
+    A model is trained and applied for each tournament of the Numerauto
+    instance, unless tournament_id is set.
+
+    If incremental is set, the model of the last round trained is updated
+    instead of fitting a new model: with 'partial_fit', partial_fit is called
+    on batches of batch_size rows, and with 'warm_start', fit is called after
+    setting the warm_start parameter of the model. If the changes in the
+    training data are known (see Numerauto.get_training_data_delta), the
+    model is only updated with the rows that were added or changed, otherwise
+    with all rows. With 'warm_start', this only holds for ensembles (models
+    with an n_estimators parameter), which get warm_start_increment new
+    estimators fitted on these rows; other models are fitted on all rows,
+    starting from the previous model. A new model is fitted on all rows if
+    there is no previous model, if the features changed, or if the last full
+    fit is full_refit_every rounds old. A JSON file with the training history
+    is saved next to each model:
+        ./models/tournament_<name>/round_<num>/<name>.json
+
+    The model is applied to batches of predict_batch_size rows, and the
+    predictions of each batch are appended to the predictions file. If the
+    features are memory-mapped from the columnar store (see the
+    convert_columnar and extract_csv arguments of Numerauto), the memory
+    needed to apply the model is bounded by the batch size.
+
+    If a ModelCache is set (on the handler or on the Numerauto instance), the
+    model is kept in memory after it is trained or loaded, and applied in the
+    next rounds without unpickling it again until it is retrained.
     """
 
-    def __init__(self, name, model_factory, tournament_id=None):
+    per_tournament = True
+
+    def __init__(self, name, model_factory, tournament_id=None, precision=None,
+                 use_process_pool=False, incremental=None, full_refit_every=None,
+                 batch_size=DEFAULT_BATCH_SIZE, predict_batch_size=DATASET_CHUNKSIZE, model_cache=None,
+                 model_store=None, warm_start_increment=DEFAULT_WARM_START_INCREMENT):
         """
         Creates a new SKLearnModelTrainer instance.
 
@@ -88,67 +268,235 @@ class SKLearnModelTrainer(EventHandler):
             name: Event handler name.
             model_factory: Function that creates a new model instance.
                            The function must take no arguments.
-            tournament_id: ID of the tournament to upload predictions to. The default None will copy the tournament id of the Numerauto instance
+            tournament_id: ID of the tournament to train for. The default None will train for all tournaments of the Numerauto instance
+            precision: Precision of the feature matrix ('float64', 'float32', 'float16' or 'uint8'). The default None will use the feature_precision of the Numerauto instance
+            use_process_pool: Fit and apply the model in the process pool of the Numerauto instance. The model must be picklable, and precision is ignored (the precision of the columnar store is used)
+            incremental: Update the model of the last round trained instead of fitting a new model: 'partial_fit', 'warm_start' or None (default: None, i.e. always fit a new model)
+            full_refit_every: Number of rounds after which a new model is fitted on all rows in incremental mode (default: None, i.e. only when needed)
+            batch_size: Number of rows per partial_fit call (default: 10000)
+            predict_batch_size: Number of rows the model is applied to at once (default: 100000)
+            model_cache: ModelCache that keeps models in memory across rounds. The default None will use the model_cache of the Numerauto instance, if any
+            model_store: Store used to save and load models (see numerauto.modelstore). The default None will use a PickleModelStore
+            warm_start_increment: Number of estimators added to an ensemble per update with incremental='warm_start' (default: 10)
         """
 
+        if incremental not in (None, 'partial_fit', 'warm_start'):
+            raise ValueError('Unknown incremental mode: {}'.format(incremental))
+
         super().__init__(name)
         self.model_factory = model_factory
         self.tournament_id = tournament_id
+        self.precision = precision
+        self.use_process_pool = use_process_pool
+        self.incremental = incremental
+        self.full_refit_every = full_refit_every
+        self.batch_size = batch_size
+        self.predict_batch_size = predict_batch_size
+        self.model_cache = model_cache
+        self.model_store = model_store if model_store is not None else PickleModelStore()
+        self.warm_start_increment = warm_start_increment
+
+    def get_model_path(self, tournament_name, round_number):
+        """ Get the directory of the models of a tournament and round """
+        return Path('./models/tournament_{}/round_{}'.format(tournament_name, round_number))
+
+    def get_model_cache(self):
+        """ Get the ModelCache to use, or None if models are not cached """
+
+        if self.model_cache is not None:
+            return self.model_cache
+        return getattr(self.numerauto, 'model_cache', None)
+
+    def get_model_filename(self, tournament_name, round_number):
+        """ Get the filename of the model of a tournament and round """
+        return self.model_store.get_filename(self.get_model_path(tournament_name, round_number), self.name)
+
+    def load_model(self, tournament_name, round_number):
+        """ Load the model of a round, from the model cache if there is one """
+
+        model_filename = self.get_model_filename(tournament_name, round_number)
+        model_cache = self.get_model_cache()
+        if model_cache is not None:
+            return model_cache.get(tournament_name, round_number, self.name, model_filename,
+                                   store=self.model_store)
+
+        return self.model_store.load(model_filename)
+
+    def load_model_info(self, tournament_name, round_number):
+        """
+        Load the training history of the model of a round, or None if it does
+        not exist.
+        """
 
-    def on_new_training_data(self, round_number):
-        # Get tournament name
-        napi = RobustNumerAPI()
-        if self.tournament_id is None:
-            self.tournament_id = self.numerauto.tournament_id
-        tournament_name = napi.tournament_number2name(self.tournament_id)
+        try:
+            with open(self.get_model_path(tournament_name, round_number) / '{}.json'.format(self.name), 'r') as fp:
+                return json.load(fp)
+        except FileNotFoundError:
+            return None
 
-        train_x = pd.read_csv(self.numerauto.get_dataset_path(round_number) / 'numerai_training_data.csv', header=0)
-        target_columns = set([x for x in list(train_x) if x[0:7] == 'target_'])
+    def check_incremental(self, model):
+        """
+        Raise a ValueError if a model does not support the incremental mode,
+        before any time is spent on fitting it.
+        """
 
-        train_y = train_x['target_' + tournament_name].as_matrix()
-        train_x = train_x.drop({'id', 'era', 'data_type'} | target_columns, axis=1).as_matrix()
+        if self.incremental == 'partial_fit' and not hasattr(model, 'partial_fit'):
+            raise ValueError('SKLearnModelTrainer({}): incremental=\'partial_fit\' requires a model '
+                             'with a partial_fit method, got {}'.format(self.name, type(model).__name__))
+        if self.incremental == 'warm_start' and 'warm_start' not in model.get_params():
+            raise ValueError('SKLearnModelTrainer({}): incremental=\'warm_start\' requires a model '
+                             'with a warm_start parameter, got {}'.format(self.name, type(model).__name__))
 
-        logger.info('SKLearnModelTrainer(%s): Fitting model for tournament %s round %d',
-                    self.name, tournament_name, round_number)
-        model = self.model_factory()
-        model.fit(train_x, train_y)
+    def get_full_refit_reason(self, info, dataset, delta, round_number):
+        """
+        Get the reason why a new model must be fitted on all rows in
+        incremental mode, or None if the previous model can be updated.
+        """
 
-        ensure_directory_exists(Path('./models/tournament_{}/round_{}'.format(tournament_name, round_number)))
-        model_filename = Path('./models/tournament_{}/round_{}/{}.p'.format(tournament_name, round_number, self.name))
-        pickle.dump(model, open(model_filename, 'wb'))
+        if info is None:
+            return 'no previous model'
+        if info['feature_names'] != list(dataset.feature_names) or (delta is not None and delta.columns_changed):
+            return 'features changed'
+        if self.full_refit_every is not None and round_number - info['full_refit_round'] >= self.full_refit_every:
+            return 'last full fit in round {}'.format(info['full_refit_round'])
+        return None
 
-    def on_new_tournament_data(self, round_number):
-        # Get tournament name
-        napi = RobustNumerAPI()
-        if self.tournament_id is None:
-            self.tournament_id = self.numerauto.tournament_id
-        tournament_name = napi.tournament_number2name(self.tournament_id)
+    def get_update_rows(self, dataset, delta):
+        """
+        Get the indices of the rows to update a model with: the rows that
+        were added or changed according to delta, or all rows if delta is None.
+        """
+
+        if delta is None:
+            return np.arange(len(dataset))
 
-        test_x = pd.read_csv(self.numerauto.get_dataset_path(round_number) / 'numerai_tournament_data.csv', header=0)
-        target_columns = set([x for x in list(test_x) if x[0:7] == 'target_'])
+        if delta.added_ids is not None:
+            return np.flatnonzero(np.isin(dataset.ids, np.concatenate([delta.added_ids, delta.changed_ids])))
+        return np.flatnonzero(np.isin(dataset.eras, delta.new_eras))
 
-        test_ids = test_x['id']
-        test_x = test_x.drop({'id', 'era', 'data_type'} | target_columns, axis=1).as_matrix()
+    def on_new_training_data(self, round_number, tournament_id=None):
+        # Get tournament name
+        tournament_id = self.get_tournament_id(tournament_id)
+        tournament_name = self.numerauto.napi.tournament_number2name(tournament_id)
+        # Read from the Numerauto instance, as this handler may be a copy in another process
+        delta = self.numerauto.get_training_data_delta(round_number)
+
+        if self.use_process_pool:
+            dataset = self.numerauto.get_columnar_dataset(round_number, 'training')
+        else:
+            dataset = self.numerauto.get_dataset(round_number, 'training', precision=self.precision)
+
+        reason = 'not incremental'
+        last_round_trained = self.numerauto.persistent_state['last_round_trained']
+        if self.incremental is not None:
+            info = None
+            if last_round_trained is not None:
+                info = self.load_model_info(tournament_name, last_round_trained)
+            reason = self.get_full_refit_reason(info, dataset, delta, round_number)
+
+        if reason is None:
+            if delta is None:
+                logger.warning('SKLearnModelTrainer(%s): Changes in the training data of round %d are not known, '
+                               'updating the model with all rows', self.name, round_number)
+
+            # Load a private copy instead of the cached model, which is updated in place
+            model = self.model_store.load(self.get_model_filename(tournament_name, last_round_trained))
+            self.check_incremental(model)
+            rows = self.get_update_rows(dataset, delta)
+            if self.incremental == 'warm_start' and not is_ensemble(model) and len(rows) > 0:
+                # warm_start only initialises the solver, so the old rows are needed as well
+                rows = np.arange(len(dataset))
+            logger.info('SKLearnModelTrainer(%s): Updating model of round %d for tournament %s round %d '
+                        'with %d rows (%s)', self.name, last_round_trained, tournament_name, round_number,
+                        len(rows), self.incremental)
+
+            targets = np.asarray(dataset.get_target(tournament_name))
+            if len(rows) == 0:
+                logger.info('SKLearnModelTrainer(%s): No new rows, keeping the model unchanged', self.name)
+            elif self.use_process_pool:
+                future = self.numerauto.get_process_pool().submit(
+                    update_model, model, share_array(dataset.features), targets, rows,
+                    self.incremental, self.batch_size, dataset.feature_scale, self.warm_start_increment)
+                model = future.result()
+            else:
+                model = update_model(model, dataset.features, targets, rows, self.incremental,
+                                     self.batch_size, dataset.feature_scale, self.warm_start_increment)
+            full_refit_round = info['full_refit_round']
+        else:
+            logger.info('SKLearnModelTrainer(%s): Fitting model for tournament %s round %d',
+                        self.name, tournament_name, round_number)
+            if self.incremental is not None:
+                logger.info('SKLearnModelTrainer(%s): Fitting a new model because of: %s', self.name, reason)
+            model = self.model_factory()
+            self.check_incremental(model)
+
+            if self.use_process_pool:
+                future = self.numerauto.get_process_pool().submit(
+                    fit_model, model, share_array(dataset.features),
+                    np.array(dataset.get_target(tournament_name)), dataset.feature_scale)
+                model = future.result()
+            else:
+                model.fit(dataset.get_feature_matrix(), dataset.get_target(tournament_name))
+            rows = np.arange(len(dataset))
+            full_refit_round = round_number
+
+        model_path = self.get_model_path(tournament_name, round_number)
+        ensure_directory_exists(model_path)
+        model_filename = self.get_model_filename(tournament_name, round_number)
+        self.model_store.save(model, model_filename)
+
+        model_cache = self.get_model_cache()
+        if model_cache is not None:
+            model_cache.put(tournament_name, round_number, self.name, model_filename, model,
+                            store=self.model_store)
+
+        info = {'round': round_number,
+                'full_refit_round': full_refit_round,
+                'incremental': self.incremental if reason is None else None,
+                'rows': len(rows),
+                'feature_names': list(dataset.feature_names)}
+        with open(model_path / '{}.json'.format(self.name), 'w') as fp:
+            json.dump(info, fp)
+
+    def on_new_tournament_data(self, round_number, tournament_id=None):
+        # Get tournament name
+        tournament_name = self.numerauto.napi.tournament_number2name(self.get_tournament_id(tournament_id))
 
         logger.info('SKLearnModelTrainer(%s): Applying model for tournament %s round %d',
                     self.name, tournament_name, round_number)
-        model_filename = Path('./models/tournament_{}/round_{}/{}.p'.format(
-            tournament_name, self.numerauto.persistent_state['last_round_trained'], self.name))
-        model = pickle.load(open(model_filename, 'rb'))
-        predictions = model.predict_proba(test_x)[:, 1]
-
-        df = pd.DataFrame(predictions, columns=['probability_' + tournament_name], index=test_ids)
-        ensure_directory_exists(Path('./predictions/tournament_{}/round_{}'.format(tournament_name, round_number)))
-        df.to_csv(Path('./predictions/tournament_{}/round_{}/{}.csv'.format(tournament_name, round_number, self.name)),
-                  index_label='id', float_format='%.8f')
+        model = self.load_model(tournament_name, self.numerauto.persistent_state['last_round_trained'])
+
+        prediction_path = Path('./predictions/tournament_{}/round_{}'.format(tournament_name, round_number))
+        ensure_directory_exists(prediction_path)
+
+        with PredictionWriter(prediction_path / '{}.csv'.format(self.name),
+                              'probability_' + tournament_name) as writer:
+            if self.use_process_pool:
+                dataset = self.numerauto.get_columnar_dataset(round_number, 'tournament')
+                future = self.numerauto.get_process_pool().submit(
+                    predict_model, model, share_array(dataset.features), dataset.feature_scale,
+                    self.predict_batch_size)
+                writer.write(dataset.ids, future.result())
+            else:
+                # Only one batch of features is decoded at a time
+                dataset = self.numerauto.get_dataset(round_number, 'tournament', precision=self.precision)
+                for start in range(0, len(dataset), self.predict_batch_size):
+                    stop = start + self.predict_batch_size
+                    writer.write(dataset.ids[start:stop],
+                                 model.predict_proba(dataset.get_feature_matrix(start, stop))[:, 1])
 
 
 class PredictionUploader(EventHandler):
     """
     Event handler that uploads a predictions file from the ./predictions directory
     using the Numerai API.
+
+    The predictions file is uploaded for each tournament of the Numerauto
+    instance, unless tournament_id is set.
     """
 
+    per_tournament = True
+
     def __init__(self, name, filename, public_id, secret_key, tournament_id=None):
         """
         Creates a new PredictionUploader instance.
@@ -158,7 +506,7 @@ class PredictionUploader(EventHandler):
             filename: Filename of the predictions file.
             public_id: Numerai public API key for the account the prediction is uploaded to.
             secret_key: Numerai secret API key for the account the prediction is uploaded to.
-            tournament_id: ID of the tournament to upload predictions to. The default None will copy the tournament id of the Numerauto instance
+            tournament_id: ID of the tournament to upload predictions to. The default None will upload to all tournaments of the Numerauto instance
         """
         super().__init__(name)
         self.filename = filename
@@ -167,25 +515,31 @@ class PredictionUploader(EventHandler):
         self.tournament_id = tournament_id
 
 
-    def on_new_tournament_data(self, round_number):
+    def on_new_tournament_data(self, round_number, tournament_id=None):
         logger.info('PredictionUploader(%s): Uploading predictions for round %d: %s',
                     self.name, round_number, self.filename)
-        napi = RobustNumerAPI(public_id=self.public_id, secret_key=self.secret_key)
+        napi = RobustNumerAPI(public_id=self.public_id, secret_key=self.secret_key,
+                              session=self.numerauto.napi.session, cache=self.numerauto.napi.cache,
+                              api_url=self.numerauto.napi.api_url,
+                              instrumentation=self.numerauto.napi.instrumentation,
+                              scheduler=self.numerauto.napi.scheduler)
 
         # Get tournament name
-        if self.tournament_id is None:
-            self.tournament_id = self.numerauto.tournament_id
-        tournament_name = napi.tournament_number2name(self.tournament_id)
+        tournament_id = self.get_tournament_id(tournament_id)
+        tournament_name = napi.tournament_number2name(tournament_id)
 
         try:
             prediction_path = Path('./predictions/tournament_{}/round_{}/'.format(tournament_name, round_number))
-            napi.upload_predictions(prediction_path / self.filename, tournament=self.tournament_id)
+            napi.upload_predictions(prediction_path / self.filename, tournament=tournament_id)
         except NumerAPIError as e:
             logger.error('PredictionUploader(%s): NumerAPI exception in tournament %s round %d: %s',
                          self.name, tournament_name, round_number, e)
             logger.error('PredictionUploader(%s): Predictions not uploaded successfully, '
-                         'please upload %s manually, or remove state.pickle and restart '
-                         'Numerauto to process this round again', self.name, prediction_path / self.filename)
+                         'the upload is retried when Numerauto is restarted, or upload %s manually',
+                         self.name, prediction_path / self.filename)
+            # The upload is not recorded as complete in the checkpoint journal,
+            # so a restart resumes at this step
+            raise IncompleteStepException(str(e)) from e
 
 
 
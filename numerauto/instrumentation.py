@@ -0,0 +1,362 @@
+"""
+Performance instrumentation of the steps, events, event handlers and API
+calls of each round.
+"""
+
+import os
+import sys
+import json
+import time
+import datetime
+import threading
+import contextlib
+import logging
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum number of measurements that are kept per round, so a daemon that
+# waits for a long time between rounds does not accumulate measurements
+# without bound. Further measurements are only counted in the summary.
+MAX_MEASUREMENTS = 10000
+
+# Version of the format of the round reports
+REPORT_VERSION = 1
+
+
+def get_peak_rss():
+    """ Get the peak resident set size of this process in bytes, or None if it is unknown """
+
+    try:
+        import resource
+    except ImportError:
+        # Not available on Windows
+        return None
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+class Timer:
+    """
+    Measures the wall time, CPU time and peak RSS of a piece of code.
+
+    Attributes:
+        cpu_clock: 'thread' to measure the CPU time of the current thread,
+                   'process' to measure that of the whole process, or None
+                   to not measure CPU time
+    """
+
+    def __init__(self, cpu_clock='thread'):
+        self.cpu_clock = cpu_clock
+        self.wall_start = time.perf_counter()
+        self.cpu_start = self.get_cpu_time()
+        self.peak_rss_start = get_peak_rss()
+
+    def get_cpu_time(self):
+        if self.cpu_clock == 'thread':
+            return time.thread_time()
+        if self.cpu_clock == 'process':
+            return time.process_time()
+        return None
+
+    def stop(self):
+        """
+        Returns:
+            Dictionary with the wall time and CPU time in seconds, the peak
+            RSS of the process in bytes, and how much the peak RSS increased
+            while the code ran.
+        """
+
+        wall_time = time.perf_counter() - self.wall_start
+        cpu_time = self.get_cpu_time()
+        peak_rss = get_peak_rss()
+        return {'wall_time': wall_time,
+                'cpu_time': cpu_time - self.cpu_start if cpu_time is not None else None,
+                'peak_rss': peak_rss,
+                'peak_rss_increase': (peak_rss - self.peak_rss_start
+                                      if peak_rss is not None and self.peak_rss_start is not None else None)}
+
+
+def measure_call(func, *args):
+    """
+    Calls a function and measures it in the thread (or process) that runs
+    it, e.g. an event handler in an executor.
+
+    Returns:
+        (return value, measured values of Timer.stop) tuple
+    """
+
+    timer = Timer()
+    result = func(*args)
+    return result, timer.stop()
+
+
+class Instrumentation:
+    """
+    Collects measurements of the wall time, CPU time and peak memory of the
+    steps of the daemon (e.g. download_and_check), event dispatches, event
+    handler calls, Numerai API calls and downloads, and counts retries.
+
+    The measurements since the previous round are optionally written as a
+    JSON report per round (<directory>/round_<round>.json) when the round is
+    processed, and optionally as a Prometheus textfile (for the textfile collector of
+    the node exporter), which holds the measurements of the last round
+    processed and the retries since the daemon started.
+
+    The CPU time of steps and events is that of the whole process (all
+    threads), the CPU time of event handlers and API calls that of the thread
+    that ran them. Work done in other processes (e.g. the process pool) is
+    not included. Peak RSS is the peak of the process, peak_rss_increase
+    shows whether a call raised it.
+
+    Attributes:
+        directory: Directory of the round reports (None to not write reports)
+        prometheus_file: Filename of the Prometheus textfile (None to not
+                         write it)
+        measurements: Measurements since the last report
+        summary: Dictionary of (kind, name, event, tournament id) to the
+                 number of calls, errors and total times since the last report
+        retries: Dictionary of (kind, name) to the number of retries since
+                 the daemon started
+        round_number: Round that is being processed, or None
+    """
+
+    def __init__(self, directory=None, prometheus_file=None):
+        """
+        Creates a new Instrumentation instance.
+
+        Args:
+            directory: Directory of the round reports, e.g. ./metrics
+                       (default: None, i.e. no reports)
+            prometheus_file: Filename of the Prometheus textfile, e.g. in the
+                             directory of the textfile collector of the node
+                             exporter (default: None, i.e. no textfile)
+        """
+
+        self.directory = Path(directory) if directory is not None else None
+        self.prometheus_file = Path(prometheus_file) if prometheus_file is not None else None
+        self.measurements = []
+        self.summary = {}
+        self.retries = {}
+        self.round_number = None
+        self.round_timer = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can not be pickled, a copy in another process (e.g. in a
+        # process pool) starts without measurements
+        state = self.__dict__.copy()
+        state['measurements'] = []
+        state['summary'] = {}
+        state['round_timer'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def record(self, kind, name, values, event=None, tournament_id=None, error=False):
+        """
+        Record a measurement.
+
+        Args:
+            kind: Kind of measurement: 'step', 'event', 'handler', 'api' or
+                  'download'
+            name: Name of the step, event, event handler or API call
+            values: Measured values (see Timer.stop)
+            event: Event of event handler calls (default: None)
+            tournament_id: Tournament id of per-tournament calls (default: None)
+            error: Whether the call raised an exception (default: False)
+        """
+
+        measurement = dict(values, kind=kind, name=name, event=event, tournament=tournament_id,
+                           round=self.round_number, error=error)
+
+        with self.lock:
+            if len(self.measurements) < MAX_MEASUREMENTS:
+                self.measurements.append(measurement)
+
+            key = (kind, name, event, tournament_id)
+            summary = self.summary.setdefault(key, {'calls': 0, 'errors': 0, 'wall_time': 0.0, 'cpu_time': 0.0,
+                                                    'peak_rss_increase': 0})
+            summary['calls'] += 1
+            summary['errors'] += int(error)
+            summary['wall_time'] += values['wall_time']
+            summary['cpu_time'] += values['cpu_time'] or 0.0
+            summary['peak_rss_increase'] += values['peak_rss_increase'] or 0
+
+    @contextlib.contextmanager
+    def measure(self, kind, name, event=None, tournament_id=None, cpu_clock='thread'):
+        """
+        Context manager that measures the code it wraps, see record. A
+        measurement is also recorded if the code raises an exception.
+
+        Args:
+            kind: Kind of measurement (see record)
+            name: Name of the step, event, event handler or API call
+            event: Event of event handler calls (default: None)
+            tournament_id: Tournament id of per-tournament calls (default: None)
+            cpu_clock: CPU time to measure, see Timer (default: 'thread')
+        """
+
+        timer = Timer(cpu_clock=cpu_clock)
+        try:
+            yield
+        except BaseException:
+            self.record(kind, name, timer.stop(), event=event, tournament_id=tournament_id, error=True)
+            raise
+        self.record(kind, name, timer.stop(), event=event, tournament_id=tournament_id)
+
+    def count_retry(self, kind, name):
+        """ Count a retry of a failed API call or download """
+
+        with self.lock:
+            self.retries[(kind, name)] = self.retries.get((kind, name), 0) + 1
+
+    def begin_round(self, round_number):
+        """ Start measuring the processing of a round """
+
+        logger.debug('Instrumentation: begin_round(%d)', round_number)
+        self.round_number = round_number
+        self.round_timer = Timer(cpu_clock='process')
+
+    def end_round(self):
+        """
+        Finish measuring the processing of the current round: write the
+        round report and the Prometheus textfile, and clear the measurements.
+
+        Returns:
+            The round report (see get_report)
+        """
+
+        logger.debug('Instrumentation: end_round(%s)', self.round_number)
+
+        report = self.get_report()
+        with self.lock:
+            self.measurements = []
+            self.summary = {}
+
+        if self.directory is not None:
+            filename = self.directory / 'round_{}.json'.format(report['round'])
+            self.directory.mkdir(parents=True, exist_ok=True)
+            write_atomic(filename, json.dumps(report, indent=2))
+            logger.info('Instrumentation: Round %s took %.1f seconds, report written to %s',
+                        report['round'], report['wall_time'] or 0, filename)
+
+        if self.prometheus_file is not None:
+            write_atomic(self.prometheus_file, format_prometheus(report, self.retries))
+
+        self.round_number = None
+        self.round_timer = None
+        return report
+
+    def get_report(self):
+        """
+        Get the report of the current round.
+
+        Returns:
+            Dictionary with the round number, the finishing time, the wall and
+            CPU time of the whole round, the measurements, a summary per
+            (kind, name, event, tournament) and the retries since the daemon
+            started.
+        """
+
+        totals = self.round_timer.stop() if self.round_timer is not None else {}
+
+        with self.lock:
+            measurements = list(self.measurements)
+            summary = [dict(values, kind=kind, name=name, event=event, tournament=tournament_id)
+                       for (kind, name, event, tournament_id), values in self.summary.items()]
+            retries = [{'kind': kind, 'name': name, 'retries': count}
+                       for (kind, name), count in sorted(self.retries.items())]
+
+        return {'version': REPORT_VERSION,
+                'round': self.round_number,
+                'finished': datetime.datetime.utcnow().isoformat(),
+                'wall_time': totals.get('wall_time'),
+                'cpu_time': totals.get('cpu_time'),
+                'peak_rss': totals.get('peak_rss', get_peak_rss()),
+                'summary': summary,
+                'measurements': measurements,
+                'retries': retries}
+
+
+def write_atomic(filename, text):
+    """ Write a text file under a temporary name and rename it, so readers never see a partial file """
+
+    tmp_filename = '{}.tmp'.format(filename)
+    with open(tmp_filename, 'w') as fp:
+        fp.write(text)
+    os.replace(tmp_filename, str(filename))
+
+
+def format_prometheus_labels(labels):
+    """ Format a dictionary as Prometheus labels, leaving out None values """
+
+    escaped = []
+    for key, value in labels.items():
+        if value is None:
+            continue
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('{}="{}"'.format(key, value))
+    return '{' + ','.join(escaped) + '}' if escaped else ''
+
+
+def format_prometheus(report, retries):
+    """
+    Format a round report in the Prometheus text exposition format.
+
+    Args:
+        report: Round report (see Instrumentation.get_report)
+        retries: Dictionary of (kind, name) to the number of retries since
+                 the daemon started
+
+    Returns:
+        Text of the Prometheus textfile
+    """
+
+    metrics = [
+        ('numerauto_calls', 'gauge', 'Number of calls in the last round processed', 'calls'),
+        ('numerauto_errors', 'gauge', 'Number of calls that failed in the last round processed', 'errors'),
+        ('numerauto_wall_seconds', 'gauge', 'Total wall time of the calls in the last round processed', 'wall_time'),
+        ('numerauto_cpu_seconds', 'gauge', 'Total CPU time of the calls in the last round processed', 'cpu_time'),
+        ('numerauto_peak_rss_increase_bytes', 'gauge',
+         'Increase of the peak RSS during the calls in the last round processed', 'peak_rss_increase'),
+    ]
+
+    lines = []
+    for metric, metric_type, help_text, field in metrics:
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} {}'.format(metric, metric_type))
+        for summary in report['summary']:
+            labels = format_prometheus_labels({'kind': summary['kind'], 'name': summary['name'],
+                                               'event': summary['event'], 'tournament': summary['tournament']})
+            lines.append('{}{} {}'.format(metric, labels, summary[field]))
+
+    lines.append('# HELP numerauto_retries_total Number of retries of failed calls since the daemon started')
+    lines.append('# TYPE numerauto_retries_total counter')
+    for (kind, name), count in sorted(retries.items()):
+        lines.append('numerauto_retries_total{} {}'.format(format_prometheus_labels({'kind': kind, 'name': name}),
+                                                           count))
+
+    round_values = [('numerauto_last_round', 'Number of the last round processed', report['round']),
+                    ('numerauto_last_round_wall_seconds', 'Wall time of the last round processed',
+                     report['wall_time']),
+                    ('numerauto_last_round_cpu_seconds', 'CPU time of the last round processed',
+                     report['cpu_time']),
+                    ('numerauto_peak_rss_bytes', 'Peak RSS of the daemon process', report['peak_rss']),
+                    ('numerauto_last_round_timestamp_seconds', 'Time at which the last round was processed',
+                     time.time())]
+    for metric, help_text, value in round_values:
+        if value is None:
+            continue
+        lines.append('# HELP {} {}'.format(metric, help_text))
+        lines.append('# TYPE {} gauge'.format(metric))
+        lines.append('{} {}'.format(metric, value))
+
+    return '\n'.join(lines) + '\n'
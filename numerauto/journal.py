@@ -0,0 +1,151 @@
+"""
+Checkpoint journal of the completed steps of each round.
+"""
+
+import sqlite3
+import threading
+import logging
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+class IncompleteStepException(Exception):
+    """
+    Exception that an event handler raises when it could not complete an
+    event (e.g. a rejected upload), while the daemon should keep running. The
+    call is not recorded as complete, so it is repeated when the round is
+    processed again after a restart, and the other event handlers are not
+    affected.
+    """
+    pass
+
+
+class CheckpointJournal:
+    """
+    Journal of the steps of a round that have completed: the download and
+    check of the dataset, and each event that was handled by an event handler
+    (for a tournament). Steps are recorded in an SQLite database as soon as
+    they complete, so the record survives a crash. When a round is processed
+    again after a restart, completed steps are skipped and processing resumes
+    at the first incomplete step. Only the steps of the last round that was
+    processed are kept (see prune).
+
+    Attributes:
+        filename: Filename of the SQLite database
+    """
+
+    def __init__(self, filename=Path('checkpoints.db')):
+        """
+        Creates a new CheckpointJournal. The database is opened (and created)
+        on first use.
+
+        Args:
+            filename: Filename of the SQLite database (default: checkpoints.db)
+        """
+
+        self.filename = Path(filename)
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Connections and locks can not be pickled, a copy of the journal in
+        # another process opens its own connection
+        state = self.__dict__.copy()
+        state['connection'] = None
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get_connection(self):
+        """ Get the connection to the database, opening it on first use. The lock must be held. """
+
+        if self.connection is None:
+            logger.debug('CheckpointJournal: Opening %s', self.filename)
+            self.connection = sqlite3.connect(str(self.filename), check_same_thread=False,
+                                              isolation_level=None)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS steps ('
+                                    'round INTEGER NOT NULL, '
+                                    'event TEXT NOT NULL, '
+                                    'handler TEXT NOT NULL, '
+                                    'tournament INTEGER NOT NULL, '
+                                    'completed TEXT NOT NULL, '
+                                    'PRIMARY KEY (round, event, handler, tournament))')
+        return self.connection
+
+    def is_complete(self, round_number, event, handler='', tournament_id=None):
+        """
+        Check whether a step has completed.
+
+        Args:
+            round_number: Round number
+            event: Name of the event or step (e.g. 'on_new_training_data')
+            handler: Name of the event handler ('' for steps of the daemon)
+            tournament_id: Tournament id of per-tournament calls (default: None)
+
+        Returns:
+            True if the step has completed, False otherwise.
+        """
+
+        with self.lock:
+            row = self.get_connection().execute(
+                'SELECT 1 FROM steps WHERE round = ? AND event = ? AND handler = ? AND tournament = ?',
+                (round_number, event, handler, tournament_id or 0)).fetchone()
+        return row is not None
+
+    def mark_complete(self, round_number, event, handler='', tournament_id=None):
+        """ Record that a step has completed (see is_complete for the arguments) """
+
+        logger.debug('CheckpointJournal: Completed round %d %s %s %s', round_number, event, handler,
+                     tournament_id)
+        with self.lock:
+            self.get_connection().execute(
+                "INSERT OR REPLACE INTO steps VALUES (?, ?, ?, ?, datetime('now'))",
+                (round_number, event, handler, tournament_id or 0))
+
+    def get_completed(self, round_number):
+        """
+        Get the completed steps of a round.
+
+        Returns:
+            List of (event, handler, tournament id) tuples, with tournament id
+            None for calls that are not per-tournament.
+        """
+
+        with self.lock:
+            rows = self.get_connection().execute(
+                'SELECT event, handler, tournament FROM steps WHERE round = ? ORDER BY completed',
+                (round_number,)).fetchall()
+        return [(event, handler, tournament or None) for event, handler, tournament in rows]
+
+    def clear(self, round_number=None):
+        """
+        Remove the steps of a round, so it is processed from the start (or of
+        all rounds if round_number is None).
+        """
+
+        logger.debug('CheckpointJournal: clear(%s)', round_number)
+        with self.lock:
+            if round_number is None:
+                self.get_connection().execute('DELETE FROM steps')
+            else:
+                self.get_connection().execute('DELETE FROM steps WHERE round = ?', (round_number,))
+
+    def prune(self, round_number):
+        """ Remove the steps of all rounds before round_number, which are not processed again """
+
+        logger.debug('CheckpointJournal: prune(%d)', round_number)
+        with self.lock:
+            self.get_connection().execute('DELETE FROM steps WHERE round < ?', (round_number,))
+
+    def close(self):
+        """ Close the connection to the database """
+
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
@@ -0,0 +1,188 @@
+"""
+Model cache shared by the event handlers of a Numerauto instance.
+"""
+
+import os
+import threading
+import logging
+from collections import OrderedDict
+
+from .modelstore import PickleModelStore
+
+
+logger = logging.getLogger(__name__)
+
+
+class ModelCache:
+    """
+    Cache of trained models that are kept in memory across rounds, so a model
+    is not unpickled again every time it is applied. Models are keyed by
+    tournament name, round number and event handler name, and are checked
+    against the size and modification time of their model file, so a model
+    file that is rewritten is loaded again.
+
+    When more than max_models models are cached, or the total size of the
+    cached models exceeds max_memory bytes, the least recently used models
+    are evicted. The size of a model is estimated by the size of its pickle,
+    which is close to its size in memory for models that consist mostly of
+    arrays (for a ContentAddressedModelStore, by the size of its blobs).
+    Models that are larger than max_memory are not cached.
+
+    Only the model of the last round is used again, so when a model is added,
+    the models of earlier rounds of the same tournament and event handler are
+    removed. The cache thus holds at most one model per event handler and
+    tournament, also without limits.
+
+    Cached models are shared, so they must not be modified (e.g. by
+    partial_fit).
+
+    Attributes:
+        max_models: Maximum number of cached models (None for no limit)
+        max_memory: Maximum total size of the cached models in bytes (None
+                    for no limit)
+        models: OrderedDict of (tournament name, round number, handler name)
+                to (model, size, file version), least recently used first
+        size: Total size of the cached models in bytes
+        hits: Number of requests that were served from the cache
+        misses: Number of requests for which the model was loaded
+    """
+
+    def __init__(self, max_models=None, max_memory=None):
+        """
+        Creates a new ModelCache.
+
+        Args:
+            max_models: Maximum number of cached models (default: None, i.e.
+                        no limit)
+            max_memory: Maximum total size of the cached models in bytes
+                        (default: None, i.e. no limit)
+        """
+
+        self.max_models = max_models
+        self.max_memory = max_memory
+        self.models = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        # Locks can not be pickled, and cached models should not be copied
+        # when the owning Numerauto instance is sent to another process
+        state = self.__dict__.copy()
+        state['models'] = OrderedDict()
+        state['size'] = 0
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def get(self, tournament_name, round_number, name, filename, store=None):
+        """
+        Get a model from the cache, loading it from its model file if it is
+        not cached or the file changed.
+
+        Args:
+            tournament_name: Name of the tournament
+            round_number: Round number in which the model was trained
+            name: Name of the event handler that trained the model
+            filename: Filename of the saved model
+            store: Model store that saved the model (default: None, i.e.
+                   modelstore.PickleModelStore)
+
+        Returns:
+            The model
+        """
+
+        key = (tournament_name, round_number, name)
+        version = get_file_version(filename)
+
+        with self.lock:
+            entry = self.models.get(key)
+            if entry is not None and entry[2] == version:
+                self.models.move_to_end(key)
+                self.hits += 1
+                logger.debug('ModelCache: Hit for %s', key)
+                return entry[0]
+            self.misses += 1
+
+        if store is None:
+            store = PickleModelStore()
+
+        logger.info('ModelCache: Loading model %s', filename)
+        model = store.load(filename)
+
+        self.put(tournament_name, round_number, name, filename, model, store=store)
+        return model
+
+    def put(self, tournament_name, round_number, name, filename, model, store=None):
+        """
+        Add a model to the cache, e.g. right after it was trained and saved.
+        Models of earlier rounds of the same tournament and event handler are
+        removed from the cache.
+
+        Args:
+            tournament_name: Name of the tournament
+            round_number: Round number in which the model was trained
+            name: Name of the event handler that trained the model
+            filename: Filename of the saved model, which must exist
+            model: The model
+            store: Model store that saved the model (default: None, i.e.
+                   modelstore.PickleModelStore)
+        """
+
+        if store is None:
+            store = PickleModelStore()
+
+        key = (tournament_name, round_number, name)
+        version = get_file_version(filename)
+        size = store.get_size(filename)
+
+        with self.lock:
+            self.remove_entry(key)
+            for old_key in [k for k in self.models if k[0] == tournament_name and k[2] == name and
+                            k[1] < round_number]:
+                logger.debug('ModelCache: Replacing %s by the model of round %d', old_key, round_number)
+                self.remove_entry(old_key)
+
+            if self.max_memory is not None and size > self.max_memory:
+                logger.info('ModelCache: Not caching %s, its size (%d bytes) exceeds the memory budget',
+                            key, size)
+                return
+
+            self.models[key] = (model, size, version)
+            self.size += size
+            self.evict()
+
+    def remove_entry(self, key):
+        """ Remove a model from the cache, the lock must be held """
+
+        entry = self.models.pop(key, None)
+        if entry is not None:
+            self.size -= entry[1]
+
+    def evict(self):
+        """ Evict the least recently used models until the limits are met, the lock must be held """
+
+        while self.models and ((self.max_models is not None and len(self.models) > self.max_models) or
+                               (self.max_memory is not None and self.size > self.max_memory)):
+            key, (_, size, _) = self.models.popitem(last=False)
+            self.size -= size
+            logger.info('ModelCache: Evicted %s (%d bytes)', key, size)
+
+    def clear(self):
+        """ Remove all models from the cache """
+
+        logger.debug('ModelCache: clear')
+        with self.lock:
+            self.models = OrderedDict()
+            self.size = 0
+
+
+def get_file_version(filename):
+    """ Get the size and modification time of a file, to detect changes """
+
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns)
@@ -0,0 +1,257 @@
+"""
+Model stores that save and load the models of event handlers.
+
+PickleModelStore writes every model to a pickle file. ContentAddressedModelStore
+splits models into a small pickle stream and the data of their (numpy)
+arrays, which is pickled out-of-band (pickle protocol 5). Both are saved as
+blobs named by their SHA-256 checksum in a shared blob directory, so identical
+artifacts are stored only once across rounds and handlers, and only a small
+manifest is written per model. On load, uncompressed array data is
+memory-mapped (copy-on-write) instead of read, so loading is nearly instant
+and pages are only read when they are used.
+"""
+
+import os
+import json
+import mmap
+import pickle
+import zlib
+import hashlib
+import logging
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+# Buffers smaller than this number of bytes are kept in the pickle stream
+MIN_BLOB_SIZE = 64 * 1024
+
+# Compression methods of ContentAddressedModelStore
+COMPRESSIONS = (None, 'zlib')
+
+
+class PickleModelStore:
+    """
+    Model store that writes each model to a pickle file:
+        <directory>/<name>.p
+    """
+
+    def get_filename(self, directory, name):
+        """ Get the filename of the model of an event handler in a directory """
+        return Path(directory) / '{}.p'.format(name)
+
+    def save(self, model, filename):
+        """ Save a model to a file """
+
+        logger.debug('PickleModelStore.save(%s)', filename)
+        with open(filename, 'wb') as fp:
+            pickle.dump(model, fp)
+
+    def load(self, filename):
+        """
+        Load a model from a file. The returned model is a private copy, which
+        can be modified.
+        """
+
+        logger.debug('PickleModelStore.load(%s)', filename)
+        with open(filename, 'rb') as fp:
+            return pickle.load(fp)
+
+    def get_size(self, filename):
+        """ Get the size of a saved model in bytes """
+        return os.path.getsize(filename)
+
+
+class ContentAddressedModelStore:
+    """
+    Model store that deduplicates models and their arrays across rounds by
+    content addressing. A manifest is written for each model:
+        <directory>/<name>.cas.json
+    which refers to blobs in the blob directory:
+        <blob_directory>/<sha256[:2]>/<sha256>
+
+    Array data of at least min_blob_size bytes is stored in separate blobs,
+    which are memory-mapped on load if they are not compressed. With
+    compression 'zlib', blobs are compressed (at compression_level, fast by
+    default), which saves disk space but requires blobs to be decompressed
+    into memory on load.
+
+    Blobs that are no longer referenced by any manifest can be removed with
+    remove_unused_blobs.
+
+    Attributes:
+        blob_directory: Directory of the blobs
+        compression: Compression method of new blobs (None or 'zlib')
+        compression_level: zlib compression level
+        min_blob_size: Minimum size in bytes of array data that is stored in
+                       a separate blob
+    """
+
+    def __init__(self, blob_directory=Path('./models/blobs'), compression=None, compression_level=1,
+                 min_blob_size=MIN_BLOB_SIZE):
+        """
+        Creates a new ContentAddressedModelStore.
+
+        Args:
+            blob_directory: Directory of the blobs (default: ./models/blobs)
+            compression: Compression method of new blobs: None or 'zlib'
+                         (default: None, i.e. blobs are memory-mapped on load)
+            compression_level: zlib compression level (default: 1, fastest)
+            min_blob_size: Minimum size in bytes of array data that is stored
+                           in a separate blob (default: 64 KiB)
+        """
+
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression: {}'.format(compression))
+
+        self.blob_directory = Path(blob_directory)
+        self.compression = compression
+        self.compression_level = compression_level
+        self.min_blob_size = min_blob_size
+
+    def get_filename(self, directory, name):
+        """ Get the filename of the manifest of an event handler in a directory """
+        return Path(directory) / '{}.cas.json'.format(name)
+
+    def get_blob_path(self, digest):
+        """ Get the path of a blob """
+        return self.blob_directory / digest[:2] / digest
+
+    def save(self, model, filename):
+        """ Save a model, writing the blobs that do not exist yet and the manifest """
+
+        logger.debug('ContentAddressedModelStore.save(%s)', filename)
+
+        buffers = []
+
+        def buffer_callback(buffer):
+            # Large buffers are pickled out-of-band (False), small ones in-band (True)
+            if buffer.raw().nbytes < self.min_blob_size:
+                return True
+            buffers.append(buffer)
+            return False
+
+        if pickle.HIGHEST_PROTOCOL >= 5:
+            data = pickle.dumps(model, protocol=5, buffer_callback=buffer_callback)
+        else:
+            data = pickle.dumps(model, protocol=pickle.HIGHEST_PROTOCOL)
+
+        manifest = {'pickle': self.write_blob(memoryview(data)),
+                    'buffers': [self.write_blob(buffer.raw()) for buffer in buffers]}
+
+        tmp_filename = '{}.tmp'.format(filename)
+        with open(tmp_filename, 'w') as fp:
+            json.dump(manifest, fp)
+        os.replace(tmp_filename, filename)
+
+    def write_blob(self, data):
+        """
+        Write a blob, unless a blob with the same contents exists.
+
+        Args:
+            data: memoryview of the contents
+
+        Returns:
+            Dictionary with the checksum, size and compression of the blob
+        """
+
+        digest = hashlib.sha256(data).hexdigest()
+        blob = {'sha256': digest, 'size': data.nbytes, 'compression': self.compression}
+        path = self.get_blob_path(digest)
+
+        if self.compression is not None:
+            path = Path('{}.{}'.format(path, self.compression))
+
+        if path.is_file():
+            logger.debug('ContentAddressedModelStore: Blob %s exists', path.name)
+            return blob
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if self.compression == 'zlib':
+            data = zlib.compress(data, self.compression_level)
+
+        tmp_path = '{}.tmp'.format(path)
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+        return blob
+
+    def read_blob(self, blob):
+        """
+        Read a blob. Uncompressed blobs are memory-mapped copy-on-write, so
+        the arrays of a loaded model can be modified without changing the
+        blob.
+
+        Returns:
+            Buffer with the contents of the blob
+        """
+
+        path = self.get_blob_path(blob['sha256'])
+        if blob['compression'] == 'zlib':
+            with open('{}.zlib'.format(path), 'rb') as fp:
+                return bytearray(zlib.decompress(fp.read()))
+
+        if blob['size'] == 0:
+            # Empty files can not be memory-mapped
+            return bytearray()
+
+        with open(path, 'rb') as fp:
+            return mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    def load(self, filename):
+        """
+        Load a model. The arrays of the model are backed by memory-mapped
+        blobs, with private (copy-on-write) pages, so the model can be
+        modified.
+        """
+
+        logger.debug('ContentAddressedModelStore.load(%s)', filename)
+
+        with open(filename, 'r') as fp:
+            manifest = json.load(fp)
+
+        buffers = [self.read_blob(blob) for blob in manifest['buffers']]
+        if buffers:
+            return pickle.loads(self.read_blob(manifest['pickle']), buffers=buffers)
+        return pickle.loads(self.read_blob(manifest['pickle']))
+
+    def get_size(self, filename):
+        """ Get the size of a saved model in bytes (the uncompressed size of its blobs) """
+
+        with open(filename, 'r') as fp:
+            manifest = json.load(fp)
+
+        # Buffers with the same contents (e.g. views of one array) are counted once
+        blobs = {blob['sha256']: blob['size'] for blob in [manifest['pickle']] + manifest['buffers']}
+        return sum(blobs.values())
+
+    def remove_unused_blobs(self, directory=Path('./models')):
+        """
+        Remove the blobs that are not referenced by any manifest in a
+        directory (recursively). Manifests of other directories that share
+        the blob directory must be in the directory too.
+
+        Args:
+            directory: Directory of the manifests (default: ./models)
+
+        Returns:
+            Number of bytes that were freed
+        """
+
+        logger.debug('ContentAddressedModelStore.remove_unused_blobs(%s)', directory)
+
+        used = set()
+        for manifest_filename in Path(directory).glob('**/*.cas.json'):
+            with open(manifest_filename, 'r') as fp:
+                manifest = json.load(fp)
+            used.update(blob['sha256'] for blob in [manifest['pickle']] + manifest['buffers'])
+
+        freed = 0
+        for path in self.blob_directory.glob('*/*'):
+            if path.name.split('.')[0] not in used:
+                freed += path.stat().st_size
+                path.unlink()
+
+        logger.info('ContentAddressedModelStore: Removed unused blobs (%d bytes)', freed)
+        return freed
@@ -3,35 +3,118 @@ Main Numerauto module
 """
 
 import pickle
-import datetime
+import asyncio
+import inspect
+import threading
 import signal
 import sys
 import os
 import shutil
+import contextlib
 from pathlib import Path
 import logging
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED
+from concurrent.futures import wait as wait_futures
+from concurrent.futures import TimeoutError as FuturesTimeoutError
 
 import requests
-import pytz
 import dateutil
 
-from .robust_numerapi import RobustNumerAPI
+from .robust_numerapi import RobustNumerAPI, MetadataCache, API_TOURNAMENT_URL
 from .utils import check_dataset
-from .utils import wait, wait_until
+from .utils import DatasetFingerprint, write_fingerprint_manifest, load_fingerprint_manifest
+from .utils import DatasetDelta, write_row_hashes, load_row_hashes
+from .scheduler import InterruptedException, get_default_scheduler
+from .columnar import DATASET_FILENAMES, convert_to_columnar, convert_zip_to_columnar
+from .columnar import is_columnar, load_columnar
+from .datacache import DatasetCache
+from .detection import RoundDetectionStrategy, RoundDetection
+from .journal import CheckpointJournal, IncompleteStepException
+from .instrumentation import Instrumentation, Timer, measure_call
+from .profiling import Profiler, profile_call
 
 
 logger = logging.getLogger(__name__)
 
 
-class InterruptedException(Exception):
-    """ Exception that is raised by our signal handler. """
-    pass
+# Events that are dispatched once per tournament to per-tournament event handlers
+PER_TOURNAMENT_EVENTS = ('on_training_data_delta', 'on_new_training_data', 'on_new_tournament_data')
 
-def signal_handler(signum, frame):
-    """ SIGINT/SIGTERM handler """
+# Events of which completed calls are recorded in the checkpoint journal, and
+# skipped when a round is processed again. on_training_data_delta is not
+# recorded, as handlers keep the delta in memory until on_new_training_data.
+CHECKPOINT_EVENTS = ('on_round_begin', 'on_new_training_data', 'on_new_tournament_data')
 
-    logger.info('Signal received, exiting!')
-    raise InterruptedException()
+# Number of rounds of which the detection measurements are kept in persistent_state
+ROUND_DETECTION_HISTORY = 20
+
+# Seconds a poll of the round number waits for the result of a dataset probe
+PROBE_TIMEOUT = 5
+
+
+def call_event_handler(handler, event, args):
+    """
+    Calls an event of an event handler (used to run handlers in an executor).
+    Events that are implemented as coroutines are run to completion in a new
+    event loop.
+    """
+
+    result = getattr(handler, event)(*args)
+    if inspect.iscoroutine(result):
+        return asyncio.run(result)
+    return result
+
+
+def accepts_tournament_id(handler, event, args):
+    """
+    Check whether the event method of a handler accepts the tournament id as
+    extra argument. Subclasses written before per-tournament events (e.g. an
+    override of on_new_tournament_data(self, round_number)) do not.
+    """
+
+    try:
+        inspect.signature(getattr(handler, event)).bind(*args, None)
+    except TypeError:
+        return False
+    return True
+
+
+class EventTask:
+    """
+    A single call of an event on an event handler (for one tournament).
+
+    Attributes:
+        handler: Event handler
+        event: Name of the event
+        args: Arguments of the event
+        tournament_id: Tournament id for per-tournament calls, None otherwise
+        depends_on: List of EventTasks that must finish before this task runs
+    """
+
+    def __init__(self, handler, event, args, tournament_id=None):
+        self.handler = handler
+        self.event = event
+        self.args = args
+        self.tournament_id = tournament_id
+        self.depends_on = []
+
+    @property
+    def round_number(self):
+        """ Round number of calls that are recorded in the checkpoint journal, None otherwise """
+        if self.event in CHECKPOINT_EVENTS:
+            return self.args[0]
+        return None
+
+    @property
+    def name(self):
+        """ Name of the event handler, with the tournament id for per-tournament calls """
+        if self.tournament_id is None:
+            return self.handler.name
+        return '{}[{}]'.format(self.handler.name, self.tournament_id)
+
+    def run(self):
+        """ Call the event on the event handler """
+        return call_event_handler(self.handler, self.event, self.args)
 
 
 class Numerauto:
@@ -47,38 +130,204 @@ class Numerauto:
 
     Attributes:
         tournament_id: Numerai tournament id for which this instance will download data.
+        tournament_ids: Numerai tournament ids for which events are dispatched.
         data_directory: Directory where to store data.
-        napi: A robust version of NumerAPI (note that no API keys are supplied)
+        napi: A robust version of NumerAPI (note that no API keys are supplied).
+              Event handlers can share its connection pool through napi.session.
         event_handlers: List of event handlers that are bound to this instance.
         dataset_path: Path of the last downloaded dataset.
         persistent_state: Internal storage of the current state of the daemon.
         round_number: Current round number.
+        convert_columnar: Whether each new dataset is converted to a columnar store.
+        extract_csv: Whether the dataset CSV files are extracted from the zip file.
+        scheduler: Scheduler used for waiting. Event handlers can schedule
+                   their own (recurring) jobs on it.
+        round_detection: Polling strategy used to detect new rounds.
+        journal: CheckpointJournal of the completed steps of each round.
+        instrumentation: Instrumentation that measures the steps, events,
+                         event handler calls and API calls of each round.
+        profiler: Profiler of selected event handlers, events and steps
+                  (None if profiling is off).
+        dataset_cache: Cache of the datasets of the current round, shared by event handlers.
+        training_data_deltas: DatasetDelta of the training data by round
+                              number, for the round that is processed (see
+                              get_training_data_delta).
+        incomplete_tasks: Event calls of the round that is processed that
+                          raised IncompleteStepException.
+        model_cache: ModelCache of trained models that event handlers keep in
+                     memory across rounds (None if models are not cached).
+        feature_precision: Default precision of loaded feature matrices.
+        max_workers: Maximum number of event handlers that run concurrently.
+        executor: Type of executor used to run event handlers concurrently
+                  ('thread' or 'process').
+        process_pool_size: Number of worker processes in the process pool.
     """
 
-    def __init__(self, tournament_id=1, data_directory=Path('./data')):
+    def __init__(self, tournament_id=1, data_directory=Path('./data'), convert_columnar=False,
+                 feature_precision='float32', max_workers=1, executor='thread',
+                 process_pool_size=None, tournament_ids=None, extract_csv=True, scheduler=None,
+                 round_detection=None, model_cache=None, journal=None, api_url=API_TOURNAMENT_URL,
+                 instrumentation=None, profiler=None):
         """
         Creates a Numerauto instance.
 
         Args:
             tournament_id: Numerai tournament id for which this instance will download data.
             data_directory: Directory where to store data (default: ./data)
+            convert_columnar: Convert each new dataset to a memory-mappable
+                              columnar store after it is validated (default: False)
+            feature_precision: Default precision of loaded feature matrices:
+                               'float64', 'float32', 'float16' or 'uint8'
+                               (quantized codes, see utils.load_dataset)
+                               (default: float32)
+            max_workers: Maximum number of event handlers that run
+                         concurrently. With the default of 1, event handlers
+                         run one after another in the order they are added.
+            executor: Type of executor used to run event handlers concurrently:
+                      'thread' (default) or 'process'. Note that with
+                      'process', event handlers run on a copy of themselves
+                      and of this instance, so changes they make to their
+                      attributes or to persistent_state are lost.
+            process_pool_size: Number of worker processes in the process pool
+                               that event handlers can use for heavy work,
+                               see get_process_pool (default: None, i.e. the
+                               number of CPUs)
+            tournament_ids: Numerai tournament ids for which events are
+                            dispatched to per-tournament event handlers.
+                            Rounds are detected and the dataset is downloaded
+                            only once, for tournament_id (default: None, i.e.
+                            only tournament_id)
+            extract_csv: Extract the dataset CSV files from the downloaded zip
+                         file. If False, the CSV files are streamed out of the
+                         zip file straight into columnar stores (see
+                         get_columnar_dataset), and are never written to disk
+                         (default: True)
+            scheduler: Scheduler used for waiting (also for the retries of
+                       RobustNumerAPI) and for scheduled jobs (default: None,
+                       i.e. the default scheduler)
+            round_detection: RoundDetectionStrategy that determines when the
+                             round number is polled while waiting for a new
+                             round (default: None, i.e. RoundDetectionStrategy())
+            model_cache: ModelCache in which event handlers (e.g.
+                         SKLearnModelTrainer) keep trained models across
+                         rounds, instead of loading them from file every
+                         round (default: None, i.e. no caching)
+            journal: CheckpointJournal in which the completed steps of each
+                     round are recorded, so a round that is interrupted
+                     resumes at the first incomplete step (default: None,
+                     i.e. CheckpointJournal('checkpoints.db'))
+            api_url: URL of the Numerai GraphQL API, e.g. of a local stand-in
+                     for testing (default: API_TOURNAMENT_URL)
+            instrumentation: Instrumentation that measures the wall time, CPU
+                             time and peak memory of the steps, events, event
+                             handler calls and API calls of each round, and
+                             optionally writes a report per round (default:
+                             None, i.e. Instrumentation() without reports)
+            profiler: Profiler that profiles selected event handlers, events
+                      and steps with cProfile and/or tracemalloc (default:
+                      None, i.e. Profiler.from_environment(), which is None
+                      and does not profile unless NUMERAUTO_PROFILE is set)
         """
+
+        if executor not in ('thread', 'process'):
+            raise ValueError('Unknown executor: {}'.format(executor))
+
         self.tournament_id = tournament_id
+        self.tournament_ids = list(tournament_ids) if tournament_ids is not None else [tournament_id]
         self.data_directory = Path(data_directory)
-        self.napi = RobustNumerAPI(verbosity='warning', show_progress_bars=False)
+        self.convert_columnar = convert_columnar
+        self.extract_csv = extract_csv
+        self.scheduler = scheduler if scheduler is not None else get_default_scheduler()
+        self.round_detection = round_detection if round_detection is not None else RoundDetectionStrategy()
+        self.feature_precision = feature_precision
+        self.max_workers = max_workers
+        self.executor = executor
+        self.process_pool_size = process_pool_size
+        self.process_pool = None
+        self.process_pool_lock = threading.Lock()
+        self.columnar_lock = threading.Lock()
+        self.instrumentation = instrumentation if instrumentation is not None else Instrumentation()
+        self.profiler = profiler if profiler is not None else Profiler.from_environment()
+        self.napi = RobustNumerAPI(verbosity='warning', show_progress_bars=False,
+                                   cache=MetadataCache(self.data_directory / 'api_cache.json'),
+                                   api_url=api_url, instrumentation=self.instrumentation,
+                                   scheduler=self.scheduler)
         self.event_handlers = []
         self.dataset_path = None
         self.persistent_state = None
         self.round_number = None
+        self.dataset_cache = DatasetCache(self)
+        self.training_data_deltas = {}
+        self.incomplete_tasks = []
+        self.model_cache = model_cache
+        self.journal = journal if journal is not None else CheckpointJournal()
+
+    def __getstate__(self):
+        # The process pool and locks can not be pickled, a copy of this
+        # instance in another process creates its own pool when needed
+        state = self.__dict__.copy()
+        state['process_pool'] = None
+        del state['process_pool_lock']
+        del state['columnar_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.process_pool_lock = threading.Lock()
+        self.columnar_lock = threading.Lock()
+
+    def get_process_pool(self):
+        """
+        Get the process pool that event handlers can use to run heavy work
+        (e.g. model training) in parallel. The pool is created on first use
+        and shut down when the daemon stops.
+
+        Returns:
+            concurrent.futures.ProcessPoolExecutor
+        """
+
+        with self.process_pool_lock:
+            if self.process_pool is None:
+                logger.debug('get_process_pool: Starting process pool')
+                self.process_pool = ProcessPoolExecutor(max_workers=self.process_pool_size)
+            return self.process_pool
+
+    def shutdown_process_pool(self):
+        """ Shut down the process pool, if it was started """
+
+        with self.process_pool_lock:
+            if self.process_pool is not None:
+                logger.debug('shutdown_process_pool')
+                self.process_pool.shutdown()
+                self.process_pool = None
 
-    def add_event_handler(self, handler):
+    def add_event_handler(self, handler, depends_on=None):
         """
         Add an event handler to this instance.
 
         Args:
             handler: Event handler to add.
+            depends_on: Names of the event handlers that must have finished
+                        handling an event before this handler handles it
+                        (default: None, i.e. keep the dependencies set on
+                        the handler)
+
+        Raises:
+            ValueError: The executor is 'process' and the handler can not be
+                        pickled (e.g. it holds a lambda function)
         """
 
+        if self.executor == 'process':
+            # Handlers are sent to the worker processes with every event
+            try:
+                pickle.dumps(handler)
+            except Exception as e:
+                raise ValueError('Event handler {} can not be pickled, which executor=\'process\' requires: '
+                                 '{}'.format(handler.name, e)) from e
+
+        if depends_on is not None:
+            handler.depends_on = list(depends_on)
+
         self.event_handlers.append(handler)
         handler.numerauto = self
 
@@ -96,40 +345,257 @@ class Numerauto:
 
         self.event_handlers = [h for h in self.event_handlers if h.name != handler_name]
 
+    def get_handler_order(self):
+        """
+        Get the event handlers in an order in which every handler comes after
+        the handlers it depends on. Apart from that, handlers stay in the
+        order they were added.
+
+        Returns:
+            List of event handlers.
+        """
+
+        names = set(h.name for h in self.event_handlers)
+        for h in self.event_handlers:
+            for dependency in h.depends_on:
+                if dependency not in names:
+                    raise ValueError('Event handler {} depends on unknown event handler {}'.format(
+                        h.name, dependency))
+
+        ordered = []
+        ordered_names = set()
+        remaining = list(self.event_handlers)
+        while remaining:
+            ready = [h for h in remaining if set(h.depends_on) <= ordered_names]
+            if not ready:
+                raise ValueError('Circular dependency between event handlers: {}'.format(
+                    ', '.join(h.name for h in remaining)))
+
+            ordered.append(ready[0])
+            ordered_names.add(ready[0].name)
+            remaining.remove(ready[0])
+
+        return ordered
+
+    def get_event_tasks(self, event, *args):
+        """
+        Get the calls that are needed to dispatch an event to all event
+        handlers, in the order of get_handler_order. Per-tournament events are
+        called once for every tournament of a per-tournament handler (see
+        EventHandler.per_tournament), with the tournament id as extra argument.
+        Event methods that do not accept the tournament id are called once,
+        without it, like those of other handlers.
+
+        Args:
+            event: Name of the event (e.g. 'on_new_training_data')
+            args: Arguments of the event
+
+        Returns:
+            List of EventTask objects, with their dependencies set.
+        """
+
+        tasks = []
+        tasks_by_handler = {}
+        for h in self.get_handler_order():
+            if event in PER_TOURNAMENT_EVENTS and h.per_tournament and accepts_tournament_id(h, event, args):
+                if getattr(h, 'tournament_id', None) is not None:
+                    tournament_ids = [h.tournament_id]
+                else:
+                    tournament_ids = self.tournament_ids
+                handler_tasks = [EventTask(h, event, args + (t,), tournament_id=t) for t in tournament_ids]
+            else:
+                handler_tasks = [EventTask(h, event, args)]
+
+            # A task depends on the tasks of each dependency for the same
+            # tournament or, if there are none, on all tasks of the dependency
+            for task in handler_tasks:
+                for dependency in h.depends_on:
+                    dependency_tasks = tasks_by_handler[dependency]
+                    same_tournament = [d for d in dependency_tasks
+                                       if d.tournament_id is not None and d.tournament_id == task.tournament_id]
+                    task.depends_on.extend(same_tournament or dependency_tasks)
+
+            tasks_by_handler[h.name] = handler_tasks
+            tasks.extend(handler_tasks)
+
+        return tasks
+
+    def create_executor(self):
+        """ Creates the executor that is used to run event handlers concurrently """
+
+        if self.executor == 'process':
+            return ProcessPoolExecutor(max_workers=self.max_workers)
+        return ThreadPoolExecutor(max_workers=self.max_workers)
+
+    def dispatch_event(self, event, *args):
+        """
+        Calls an event on all event handlers. If max_workers is larger than 1,
+        event handlers run concurrently, and each handler starts as soon as
+        the handlers it depends on have finished. If a handler raises an
+        exception, the handlers that depend on it are skipped, the other
+        handlers are completed and the exception is then re-raised.
+
+        Calls that were recorded as completed in the checkpoint journal (see
+        CHECKPOINT_EVENTS) are skipped, and count as finished for the
+        handlers that depend on them. A handler that raises
+        IncompleteStepException is not recorded as completed, and the
+        handlers that depend on it are skipped, but the exception is not
+        re-raised.
+
+        The dispatch and every event handler call are measured by the
+        instrumentation of this instance.
+
+        Args:
+            event: Name of the event (e.g. 'on_new_training_data')
+            args: Arguments of the event
+        """
+
+        with self.instrumentation.measure('event', event, cpu_clock='process'):
+            self.dispatch_event_tasks(event, self.get_event_tasks(event, *args))
+
+    def dispatch_event_tasks(self, event, tasks):
+        """ Runs the calls of an event, see dispatch_event """
+
+        completed = [task for task in tasks if self.is_task_complete(task)]
+
+        if self.max_workers <= 1:
+            for task in tasks:
+                if task not in completed:
+                    func, args = self.get_task_call(task)
+                    try:
+                        with self.instrumentation.measure('handler', task.handler.name, event=event,
+                                                          tournament_id=task.tournament_id):
+                            func(*args)
+                    except IncompleteStepException as e:
+                        self.record_incomplete_task(task, e)
+                        continue
+                    self.mark_task_complete(task)
+            return
+
+        pending = [task for task in tasks if task not in completed]
+        running = {}
+        finished = set(completed)
+        failed = set()
+        errors = []
+
+        with self.create_executor() as executor:
+            while pending or running:
+                for task in list(pending):
+                    if set(task.depends_on) & failed:
+                        logger.error('%s: Skipping event handler %s because a dependency failed',
+                                     event, task.name)
+                        pending.remove(task)
+                        failed.add(task)
+                    elif set(task.depends_on) <= finished:
+                        pending.remove(task)
+                        # The call is measured in the worker that runs it
+                        func, args = self.get_task_call(task)
+                        future = executor.submit(measure_call, func, *args)
+                        running[future] = (task, Timer(cpu_clock=None))
+
+                if not running:
+                    break
+
+                done, _ = wait_futures(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    task, timer = running.pop(future)
+                    try:
+                        _, values = future.result()
+                        self.record_event_task(task, values)
+                        self.mark_task_complete(task)
+                        finished.add(task)
+                    except IncompleteStepException as e:
+                        self.record_event_task(task, timer.stop(), error=True)
+                        self.record_incomplete_task(task, e)
+                        failed.add(task)
+                    except Exception as e:
+                        logger.exception('%s: Event handler %s failed', event, task.name)
+                        self.record_event_task(task, timer.stop(), error=True)
+                        failed.add(task)
+                        errors.append(e)
+
+        if errors:
+            raise errors[0]
+
+    def get_task_call(self, task):
+        """
+        Get the function and arguments that run an event task, under the
+        profiler if it selects the call.
+
+        Returns:
+            (function, arguments) tuple
+        """
+
+        if self.profiler is not None and self.profiler.is_selected(task.handler.name, task.event):
+            # on_start and on_shutdown have no round number
+            round_number = task.args[0] if task.args else None
+            return profile_call, (self.profiler, round_number, task.handler.name, task.event, task.tournament_id,
+                                  call_event_handler, task.handler, task.event, task.args)
+        return call_event_handler, (task.handler, task.event, task.args)
+
+    def record_event_task(self, task, values, error=False):
+        """ Record the measurement of an event handler call that ran in an executor """
+
+        self.instrumentation.record('handler', task.handler.name, values, event=task.event,
+                                    tournament_id=task.tournament_id, error=error)
+
+    def is_task_complete(self, task):
+        """ Check whether an event call was recorded as completed in the checkpoint journal """
+
+        if task.round_number is None:
+            return False
+
+        if self.journal.is_complete(task.round_number, task.event, task.handler.name, task.tournament_id):
+            logger.info('%s: Skipping event handler %s, it completed round %d before',
+                        task.event, task.name, task.round_number)
+            return True
+        return False
+
+    def record_incomplete_task(self, task, exception):
+        """
+        Record an event call that raised IncompleteStepException. It is not
+        recorded in the checkpoint journal, and the round is processed again
+        when the daemon restarts.
+        """
+
+        logger.warning('%s: Event handler %s did not complete: %s', task.event, task.name, exception)
+        self.incomplete_tasks.append(task)
+
+    def mark_task_complete(self, task):
+        """ Record a completed event call in the checkpoint journal """
+
+        if task.round_number is not None:
+            self.journal.mark_complete(task.round_number, task.event, task.handler.name, task.tournament_id)
+
     def on_start(self):
         """ Internal event on daemon start """
 
         logger.debug('on_start')
-        for h in self.event_handlers:
-            h.on_start()
+        self.dispatch_event('on_start')
 
     def on_shutdown(self):
         """ Internal event on daemon shutdown """
 
         logger.debug('on_shutdown')
-        for h in self.event_handlers:
-            h.on_shutdown()
+        self.dispatch_event('on_shutdown')
 
     def on_round_begin(self, round_number):
         """ Internal event on round start """
 
         logger.debug('on_round_begin(%d)', round_number)
-        for h in self.event_handlers:
-            h.on_round_begin(round_number)
+        self.dispatch_event('on_round_begin', round_number)
 
     def on_new_training_data(self, round_number):
         """ Internal event on detection of new training data """
 
         logger.debug('on_new_training_data(%d)', round_number)
-        for h in self.event_handlers:
-            h.on_new_training_data(round_number)
+        self.dispatch_event('on_new_training_data', round_number)
 
     def on_new_tournament_data(self, round_number):
         """ Internal event on detection of new tournament data """
 
         logger.debug('on_new_tournament_data(%d)', round_number)
-        for h in self.event_handlers:
-            h.on_new_tournament_data(round_number)
+        self.dispatch_event('on_new_tournament_data', round_number)
 
     def check_new_training_data(self, round_number):
         """
@@ -143,35 +609,139 @@ class Numerauto:
                         'treating training data as new')
             return True
 
-        filename_old = self.get_dataset_path(self.persistent_state['last_round_trained']) / 'numerai_training_data.csv'
-        filename_new = self.get_dataset_path(round_number) / 'numerai_training_data.csv'
-        return check_dataset(filename_old, filename_new)
+        return self.check_dataset_changed(self.persistent_state['last_round_trained'],
+                                          round_number, 'numerai_training_data.csv')
 
-    def on_round_begin_internal(self, round_number):
-        """ Internal event on round start """
+    def check_dataset_changed(self, round_old, round_new, filename, data_type=None):
+        """
+        Check whether a dataset file changed between two rounds. If fingerprint
+        manifests are available for both rounds, only the manifests are
+        compared and the datasets of the old round are not read at all.
+        Otherwise, the dataset files are compared using check_dataset.
 
-        logger.debug('on_round_begin_internal(%d)', round_number)
-        self.on_round_begin(round_number)
+        Args:
+            round_old: Round number of the old dataset
+            round_new: Round number of the new dataset
+            filename: Filename of the dataset file within the dataset path
+            data_type: Data type of the rows to check (default: None, i.e. all rows)
+
+        Returns:
+            True if the dataset changed, False otherwise.
+        """
 
-        # Check if training is needed, if so call on_new_training_data
-        if self.check_new_training_data(round_number):
-            # Signal new training data
-            self.on_new_training_data(round_number)
-            self.persistent_state['last_round_trained'] = round_number
+        logger.debug('check_dataset_changed(%d, %d, %s)', round_old, round_new, filename)
 
-            # Immediately save state to prevent retraining if other event handlers fail
-            self.save_state()
+        manifest_old = load_fingerprint_manifest(self.get_fingerprint_path(round_old))
+        manifest_new = load_fingerprint_manifest(self.get_fingerprint_path(round_new))
+
+        if (manifest_old is not None and filename in manifest_old and
+                manifest_new is not None and filename in manifest_new):
+            logger.info('check_dataset_changed: Comparing fingerprints of %s for round %d and %d',
+                        filename, round_old, round_new)
+            return manifest_new[filename].changed(manifest_old[filename], data_type=data_type)
+
+        filename_old = self.get_dataset_path(round_old) / filename
+        filename_new = self.get_dataset_path(round_new) / filename
+        return check_dataset(filename_old, filename_new, data_type=data_type)
+
+    def get_training_delta(self, round_old, round_new):
+        """
+        Get the difference between the training data of two rounds, from
+        their fingerprint manifests and (if available) row hashes.
+
+        Args:
+            round_old: Round number of the old dataset
+            round_new: Round number of the new dataset
+
+        Returns:
+            DatasetDelta, or None if the fingerprints of either round are not
+            available or do not contain era digests.
+        """
+
+        logger.debug('get_training_delta(%d, %d)', round_old, round_new)
+
+        filename = DATASET_FILENAMES['training']
+        manifest_old = load_fingerprint_manifest(self.get_fingerprint_path(round_old))
+        manifest_new = load_fingerprint_manifest(self.get_fingerprint_path(round_new))
+        if (manifest_old is None or filename not in manifest_old or
+                manifest_new is None or filename not in manifest_new):
+            return None
+
+        fingerprint_old = manifest_old[filename]
+        fingerprint_new = manifest_new[filename]
+        for fingerprint in (fingerprint_old, fingerprint_new):
+            if fingerprint.digest.rows > 0 and not fingerprint.eras:
+                # Written before era digests were added
+                return None
+
+        return DatasetDelta(round_old, round_new, fingerprint_old, fingerprint_new,
+                            rows_old=load_row_hashes(self.get_row_hashes_path(round_old)),
+                            rows_new=load_row_hashes(self.get_row_hashes_path(round_new)))
+
+    def get_training_data_delta(self, round_number):
+        """
+        Get the changes in the training data of a round that is processed,
+        as signalled by on_training_data_delta. The delta is kept on this
+        instance, so event handlers that run in another process (see the
+        executor argument) receive it with their copy of the instance.
 
-        # Signal new tournament data
-        self.on_new_tournament_data(round_number)
+        Args:
+            round_number: Round number of the new training data
+
+        Returns:
+            DatasetDelta, or None if the changes are not known.
+        """
+
+        return self.training_data_deltas.get(round_number)
+
+    def on_training_data_delta(self, round_number, delta):
+        """ Internal event on detection of changes in the training data """
+
+        logger.debug('on_training_data_delta(%d)', round_number)
+        self.training_data_deltas[round_number] = delta
+        self.dispatch_event('on_training_data_delta', round_number, delta)
+
+    def on_round_begin_internal(self, round_number):
+        """ Internal event on round start """
+
+        logger.debug('on_round_begin_internal(%d)', round_number)
+        try:
+            self.on_round_begin(round_number)
+
+            # Check if training is needed, if so call on_new_training_data
+            if self.run_step('check_new_training_data', self.check_new_training_data, round_number):
+                # Signal the changes in the training data, if they are known
+                if self.persistent_state['last_round_trained'] is not None:
+                    delta = self.run_step('get_training_delta', self.get_training_delta,
+                                          self.persistent_state['last_round_trained'], round_number)
+                    if delta is not None:
+                        logger.info('on_round_begin_internal: %s', delta)
+                        self.on_training_data_delta(round_number, delta)
+
+                # Signal new training data
+                self.on_new_training_data(round_number)
+                self.persistent_state['last_round_trained'] = round_number
+
+                # Immediately save state to prevent retraining if other event handlers fail
+                self.save_state()
+
+            # Signal new tournament data
+            self.on_new_tournament_data(round_number)
+        finally:
+            # Free the memory of the cached datasets while waiting for the next round,
+            # also if an event handler failed
+            self.dataset_cache.clear()
+            self.training_data_deltas.clear()
 
 
     def wait_till_next_round(self):
         """
-        Wait until a new Numerai round is detected. Will wait until 5 minutes
-        before the closing time of the current round, as reported by the
-        Numerai API. Then the current round number is requested every minute
-        until a new round number is received.
+        Wait until a new Numerai round is detected. The current round number
+        is polled according to the round_detection strategy: densely around
+        the closing time of the current round, as reported by the Numerai API,
+        and backing off after that. If the strategy probes the dataset, the
+        dataset file is probed at the same time as the round number. The
+        measured detection lag is stored in persistent_state['round_detection'].
 
         Returns:
             Dictionary with the new round information.
@@ -182,33 +752,108 @@ class Numerauto:
         round_info = self.napi.get_current_round_details(tournament=self.tournament_id)
         dt_round_close = dateutil.parser.parse(round_info['closeTime'])
 
-        new_round_info = self.napi.get_current_round_details(tournament=self.tournament_id)
+        new_round_info = round_info
+        detection = RoundDetection(round_info['number'] + 1, dt_round_close)
 
-        dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+        dt_now = self.scheduler.now()
         logger.info('Waiting for round %d. Time to next round: %.1f hours',
                     self.persistent_state['last_round_processed'] + 1,
                     (dt_round_close - dt_now).total_seconds() / 3600)
 
         # Loop until the API reports a new round number
-        while new_round_info['number'] == round_info['number']:
-            dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-            seconds_wait = (dt_round_close - dt_now).total_seconds() + 5
+        probe = None
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            while new_round_info['number'] == round_info['number']:
+                self.scheduler.wait_until(self.get_next_poll_time(dt_round_close, detection.dataset_changed))
+
+                # Probe the dataset while the round number is polled. A probe
+                # that is still running from a previous poll is not repeated.
+                if self.round_detection.probe_dataset and (probe is None or probe.done()):
+                    probe = executor.submit(self.probe_dataset)
+
+                new_round_info = self.napi.get_current_round_details(tournament=self.tournament_id,
+                                                                     refresh=True)
+                detection.polls += 1
+                if probe is not None:
+                    try:
+                        detection.update_dataset(probe.result(timeout=PROBE_TIMEOUT), self.scheduler.now())
+                    except FuturesTimeoutError:
+                        logger.warning('probe_dataset: No response within %d seconds', PROBE_TIMEOUT)
+
+                self.log_round_poll(new_round_info, dt_round_close)
+        finally:
+            # Do not wait for a probe that is still running when the round has started
+            executor.shutdown(wait=False)
+
+        self.record_round_detection(detection, new_round_info)
+        return new_round_info
 
-            if seconds_wait > 360:
-                # Wait till 5 minutes before round start
-                wait_until(dt_round_close - datetime.timedelta(minutes=5))
-            else:
-                # Then query round information every minute until round has started
-                wait(min(seconds_wait, 60))
 
-            new_round_info = self.napi.get_current_round_details(tournament=self.tournament_id)
-            dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
-            logger.info('Periodic check before planned round start. Current '
-                        'round: %d. Time to next round: %.1f minutes',
-                        new_round_info['number'],
-                        (dt_round_close - dt_now).total_seconds() / 60)
+    def get_next_poll_time(self, dt_round_close, dataset_changed=False):
+        """
+        Get the time at which the round information should be requested next
+        while waiting for a new round, see RoundDetectionStrategy.
 
-        return new_round_info
+        Args:
+            dt_round_close: Closing time of the current round.
+            dataset_changed: Whether a new dataset was detected.
+
+        Returns:
+            datetime of the next request.
+        """
+
+        return self.round_detection.get_next_poll_time(dt_round_close, self.scheduler.now(),
+                                                       dataset_changed=dataset_changed)
+
+
+    def probe_dataset(self):
+        """
+        Request the properties of the current dataset file, without
+        downloading it. The requests are not retried, so a failing probe does
+        not delay the polling of the round number.
+
+        Returns:
+            download.RemoteFile, or None if a request failed.
+        """
+
+        try:
+            with self.instrumentation.measure('api', 'probe_dataset'):
+                url = self.napi.get_dataset_url_once(tournament=self.tournament_id)
+                return self.napi.downloader.get_remote_file(url)
+        except Exception as e:
+            logger.warning('probe_dataset: Request failed: %s', e)
+            return None
+
+
+    def log_round_poll(self, round_info, dt_round_close):
+        """ Log the result of polling the round number """
+
+        dt_now = self.scheduler.now()
+        logger.info('Periodic check before planned round start. Current '
+                    'round: %d. Time to next round: %.1f minutes',
+                    round_info['number'],
+                    (dt_round_close - dt_now).total_seconds() / 60)
+
+
+    def record_round_detection(self, detection, round_info):
+        """
+        Store the measurements of the detection of a new round in
+        persistent_state['round_detection'], by round number. Only the last
+        ROUND_DETECTION_HISTORY rounds are kept.
+
+        Args:
+            detection: RoundDetection of the new round
+            round_info: Details of the new round
+        """
+
+        record = detection.to_dict(round_info, self.scheduler.now())
+        records = self.persistent_state.setdefault('round_detection', {})
+        records[round_info['number']] = record
+        for round_number in sorted(records)[:-ROUND_DETECTION_HISTORY]:
+            del records[round_number]
+        logger.info('Round %d detected %.1f seconds after it opened (%d polls)',
+                    round_info['number'], record['lag'], record['polls'])
 
 
     def download_dataset(self):
@@ -222,7 +867,7 @@ class Numerauto:
 
         logger.info('Downloading dataset')
         self.dataset_path = self.napi.download_current_dataset(dest_path=self.data_directory,
-                                                               unzip=True,
+                                                               unzip=self.extract_csv,
                                                                tournament=self.tournament_id)
         return self.dataset_path
 
@@ -241,6 +886,218 @@ class Numerauto:
         return self.data_directory / 'numerai_dataset_{}'.format(round_number)
 
 
+    def get_zip_path(self, round_number):
+        """
+        Get the path of the dataset zip file for a given round number.
+
+        Args:
+            round_number: Number of the round for which the path is requested.
+
+        Returns:
+            pathlib Path for the dataset zip file of the requested round.
+        """
+
+        return self.data_directory / 'numerai_dataset_{}.zip'.format(round_number)
+
+
+    def get_fingerprint_path(self, round_number):
+        """
+        Get the path of the fingerprint manifest for a given round number. The
+        manifest is stored next to the dataset path, so it remains available
+        if the dataset itself is deleted.
+
+        Args:
+            round_number: Number of the round for which the path is requested.
+
+        Returns:
+            pathlib Path for the fingerprint manifest of the requested round.
+        """
+
+        return self.data_directory / 'numerai_dataset_{}.fingerprint.json'.format(round_number)
+
+
+    def create_fingerprint_manifest(self, round_number):
+        """
+        Computes the fingerprints of the dataset files of a round and stores
+        them in the fingerprint manifest, and stores the row hashes of the
+        training data (see get_row_hashes_path). Does nothing if the manifest
+        already exists.
+
+        Args:
+            round_number: Number of the round for which the manifest is created.
+        """
+
+        logger.debug('create_fingerprint_manifest(%d)', round_number)
+
+        manifest_path = self.get_fingerprint_path(round_number)
+        if os.path.isfile(manifest_path):
+            return
+
+        fingerprints = {}
+        for filename in ['numerai_training_data.csv', 'numerai_tournament_data.csv']:
+            dataset_filename = self.get_dataset_path(round_number) / filename
+            if os.path.isfile(dataset_filename):
+                fingerprints[filename] = DatasetFingerprint.from_file(
+                    dataset_filename, keep_rows=filename == DATASET_FILENAMES['training'])
+
+        self.write_fingerprints(round_number, fingerprints)
+
+
+    def write_fingerprints(self, round_number, fingerprints):
+        """
+        Writes the fingerprint manifest and the training data row hashes of a
+        round. The manifest is written last, as it marks the fingerprints as
+        complete.
+
+        Args:
+            round_number: Number of the round.
+            fingerprints: Dictionary of dataset filename to DatasetFingerprint.
+        """
+
+        training = fingerprints.get(DATASET_FILENAMES['training'])
+        if training is not None and training.row_ids is not None:
+            write_row_hashes(self.get_row_hashes_path(round_number), training)
+
+        write_fingerprint_manifest(self.get_fingerprint_path(round_number), fingerprints)
+
+
+    def get_row_hashes_path(self, round_number):
+        """
+        Get the path of the row hashes of the training data for a given round
+        number (see utils.write_row_hashes). Like the fingerprint manifest, it
+        is stored next to the dataset path.
+
+        Args:
+            round_number: Number of the round for which the path is requested.
+
+        Returns:
+            pathlib Path for the row hashes of the requested round.
+        """
+
+        return self.data_directory / 'numerai_dataset_{}.rows.npz'.format(round_number)
+
+
+    def stream_dataset(self, round_number):
+        """
+        Converts the dataset files in the zip file of a round to columnar
+        stores and computes the fingerprint manifest, in one pass over the zip
+        file and without extracting the CSV files. Does nothing if the
+        manifest already exists.
+
+        Args:
+            round_number: Number of the round to convert.
+        """
+
+        logger.debug('stream_dataset(%d)', round_number)
+
+        manifest_path = self.get_fingerprint_path(round_number)
+        if os.path.isfile(manifest_path):
+            return
+
+        directories = {name: self.get_columnar_path(round_number, name) for name in DATASET_FILENAMES}
+        with self.columnar_lock:
+            fingerprints = convert_zip_to_columnar(self.get_zip_path(round_number), directories,
+                                                   precision=self.feature_precision, keep_rows=True)
+
+        self.write_fingerprints(round_number, fingerprints)
+
+
+    def get_columnar_path(self, round_number, name):
+        """
+        Get the path of the columnar store of a dataset file.
+
+        Args:
+            round_number: Number of the round for which the path is requested.
+            name: Name of the dataset file ('training' or 'tournament').
+
+        Returns:
+            pathlib Path for the columnar store.
+        """
+
+        return self.get_dataset_path(round_number) / 'columnar' / name
+
+
+    def convert_dataset(self, round_number):
+        """
+        Converts the dataset files of a round to columnar stores, skipping
+        files that have already been converted.
+
+        Args:
+            round_number: Number of the round to convert.
+        """
+
+        logger.debug('convert_dataset(%d)', round_number)
+
+        for name in DATASET_FILENAMES:
+            with self.columnar_lock:
+                self.convert_dataset_file(round_number, name)
+
+
+    def convert_dataset_file(self, round_number, name):
+        """
+        Converts a dataset file of a round to a columnar store, if that has
+        not been done yet. The CSV file is converted if it was extracted,
+        otherwise the file is streamed out of the zip file. The caller must
+        hold columnar_lock.
+
+        Args:
+            round_number: Number of the round.
+            name: Name of the dataset file ('training' or 'tournament').
+        """
+
+        columnar_path = self.get_columnar_path(round_number, name)
+        if is_columnar(columnar_path):
+            return
+
+        filename = self.get_dataset_path(round_number) / DATASET_FILENAMES[name]
+        if os.path.isfile(filename) or not os.path.isfile(self.get_zip_path(round_number)):
+            convert_to_columnar(filename, columnar_path, precision=self.feature_precision)
+        else:
+            convert_zip_to_columnar(self.get_zip_path(round_number), {name: columnar_path},
+                                    precision=self.feature_precision)
+
+
+    def get_columnar_dataset(self, round_number, name):
+        """
+        Get a dataset file of a round as memory-mapped arrays. The dataset is
+        converted to a columnar store first if that has not been done yet.
+
+        Args:
+            round_number: Number of the round.
+            name: Name of the dataset file ('training' or 'tournament').
+
+        Returns:
+            NumeraiDataset with read-only memory-mapped arrays.
+        """
+
+        logger.debug('get_columnar_dataset(%d, %s)', round_number, name)
+
+        with self.columnar_lock:
+            self.convert_dataset_file(round_number, name)
+
+        return load_columnar(self.get_columnar_path(round_number, name))
+
+
+    def get_dataset(self, round_number, name, precision=None):
+        """
+        Get a dataset file of a round from the dataset cache. The dataset is
+        loaded once per round and shared by all event handlers, so the
+        returned arrays must not be modified. The cache is cleared after
+        on_new_tournament_data has been handled.
+
+        Args:
+            round_number: Number of the round.
+            name: Name of the dataset file ('training' or 'tournament').
+            precision: Precision of the feature matrix (default: None, i.e.
+                       the feature_precision attribute)
+
+        Returns:
+            NumeraiDataset with read-only arrays.
+        """
+
+        return self.dataset_cache.get(round_number, name, precision=precision)
+
+
     def download_and_check(self):
         """
         Download a new dataset and check whether it contains new tournament
@@ -253,11 +1110,13 @@ class Numerauto:
         logger.debug('download_and_check')
         try:
             self.download_dataset()
+            if self.extract_csv:
+                self.create_fingerprint_manifest(self.round_number)
+            else:
+                self.stream_dataset(self.round_number)
 
-            filename_old = self.get_dataset_path(self.round_number - 1) / 'numerai_tournament_data.csv'
-            filename_new = self.get_dataset_path(self.round_number) / 'numerai_tournament_data.csv'
-
-            valid = check_dataset(filename_old, filename_new, data_type='live')
+            valid = self.check_dataset_changed(self.round_number - 1, self.round_number,
+                                               'numerai_tournament_data.csv', data_type='live')
         except requests.RequestException:
             import traceback
             msg = traceback.format_exc()
@@ -268,38 +1127,98 @@ class Numerauto:
         return valid
 
 
+    def is_dataset_checked(self, round_number):
+        """
+        Check whether the dataset of a round was downloaded and validated
+        before (e.g. before a crash), according to the checkpoint journal.
+        """
+
+        if (self.journal.is_complete(round_number, 'download_and_check') and
+                os.path.isfile(self.get_zip_path(round_number)) and
+                os.path.isfile(self.get_fingerprint_path(round_number))):
+            logger.info('Dataset of round %d was downloaded and checked before, skipping download',
+                        round_number)
+            return True
+        return False
+
+
+    def remove_downloaded_dataset(self):
+        """
+        Remove the unzipped files and the fingerprints of an invalid
+        dataset. The zip file is kept, so it is only transferred again if the
+        remote dataset changed.
+        """
+
+        if self.dataset_path is not None:
+            if os.path.isdir(self.dataset_path[:-4]):
+                shutil.rmtree(self.dataset_path[:-4])
+            if os.path.isfile(self.get_fingerprint_path(self.round_number)):
+                os.remove(self.get_fingerprint_path(self.round_number))
+            if os.path.isfile(self.get_row_hashes_path(self.round_number)):
+                os.remove(self.get_row_hashes_path(self.round_number))
+
+
     def run_new_round(self):
         """
         Internal function that downloads and verifies a new dataset and calls
-        the internal event handlers.
+        the internal event handlers. The round is measured by the
+        instrumentation of this instance, which writes its report when the
+        round is processed or has failed.
         """
 
         logger.debug('run_new_round')
+        self.instrumentation.begin_round(self.round_number)
+        self.incomplete_tasks = []
+        try:
+            if not self.is_dataset_checked(self.round_number):
+                # Download data. If data is not valid, wait 10 minutes and try again.
+                valid = self.run_step('download_and_check', self.download_and_check)
+
+                while not valid:
+                    logger.info('run_new_round: New dataset is not valid, retrying in 10 minutes')
+
+                    self.remove_downloaded_dataset()
+
+                    self.scheduler.wait(600)
 
-        # Download data. If data is not valid, wait 10 minutes and try again.
-        valid = self.download_and_check()
+                    valid = self.run_step('download_and_check', self.download_and_check)
 
-        while not valid:
-            logger.info('run_new_round: New dataset is not valid, retrying in 10 minutes')
+                self.journal.mark_complete(self.round_number, 'download_and_check')
 
-            # Remove downloaded and unzipped files
-            if hasattr(self, 'dataset_path'):
-                os.remove(self.dataset_path)
-                if os.path.isdir(self.dataset_path[:-4]):
-                    shutil.rmtree(self.dataset_path[:-4])
+            if self.convert_columnar:
+                self.run_step('convert_dataset', self.convert_dataset, self.round_number)
 
-            wait(600)
+            # Call round begin event
+            self.on_round_begin_internal(self.round_number)
 
-            valid = self.download_and_check()
+            # Save current round as the last round processed. If a step did not
+            # complete, the round is processed again when the daemon restarts.
+            self.persistent_state['last_round_processed'] = self.round_number
+            self.persistent_state['last_round_incomplete'] = len(self.incomplete_tasks) > 0
 
-        # Call round begin event
-        self.on_round_begin_internal(self.round_number)
+            # Save persistent state (in case of any crash)
+            self.save_state()
+
+            # Earlier rounds are not processed again
+            self.journal.prune(self.round_number)
+        finally:
+            # Write the measurements of the round, also if a step or event handler failed
+            self.instrumentation.end_round()
 
-        # Save current round as the last round processed
-        self.persistent_state['last_round_processed'] = self.round_number
 
-        # Save persistent state (in case of any crash)
-        self.save_state()
+    def run_step(self, name, func, *args):
+        """
+        Runs a step of the round (e.g. download_and_check), measured by the
+        instrumentation and profiled if the profiler selects it.
+
+        Returns:
+            Return value of the step
+        """
+
+        profile = (self.profiler.profile(self.round_number, name) if self.profiler is not None
+                   else contextlib.nullcontext())
+        with self.instrumentation.measure('step', name, cpu_clock='process'), profile:
+            return func(*args)
 
 
     def load_state(self):
@@ -323,6 +1242,9 @@ class Numerauto:
         if 'last_round_trained' not in self.persistent_state:
             self.persistent_state['last_round_trained'] = None
 
+        if 'last_round_incomplete' not in self.persistent_state:
+            self.persistent_state['last_round_incomplete'] = False
+
         logger.debug('load_state: last_round_processed = %s',
                      self.persistent_state['last_round_processed'])
         logger.debug('load_state: last_round_trained = %s',
@@ -330,7 +1252,10 @@ class Numerauto:
 
 
     def save_state(self):
-        """ Save the internal state to file using pickle. """
+        """
+        Save the internal state to file using pickle. The state is written
+        to a temporary file first, so a crash never leaves a partial state file.
+        """
 
         logger.debug('save_state')
         logger.debug('save_state: last_round_processed = %s',
@@ -338,9 +1263,27 @@ class Numerauto:
         logger.debug('save_state: last_round_trained = %s',
                      self.persistent_state['last_round_trained'])
 
-        with open('state.pickle', 'wb') as fp:
+        with open('state.pickle.tmp', 'wb') as fp:
             pickle.dump(self.persistent_state, fp)
+        os.replace('state.pickle.tmp', 'state.pickle')
+
+
 
+    def handle_signal(self, signum, frame):
+        """
+        SIGINT/SIGTERM handler. The first signal requests the scheduler to
+        stop, which interrupts the current wait at once and makes the daemon
+        exit at the next wait. A second signal interrupts the daemon
+        immediately, wherever it is.
+        """
+
+        if self.scheduler.stop_requested():
+            logger.info('Signal received again, exiting immediately!')
+            raise InterruptedException()
+
+        logger.info('Signal received, exiting!')
+        # The interrupted thread may hold the locks of the scheduler
+        threading.Thread(target=self.scheduler.request_stop).start()
 
 
     # Run Numerauto in daemon mode
@@ -359,8 +1302,9 @@ class Numerauto:
         logger.debug('run')
 
         # Set up signal handlers to gracefully exit
-        signal.signal(signal.SIGINT, signal_handler)
-        signal.signal(signal.SIGTERM, signal_handler)
+        self.scheduler.reset()
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
 
         # Load internal state
         self.load_state()
@@ -369,10 +1313,15 @@ class Numerauto:
         self.on_start()
 
         try:
-            self.round_number = self.napi.get_current_round()
+            self.round_number = self.napi.get_current_round(tournament=self.tournament_id)
+            if self.persistent_state['last_round_processed'] is None:
+                # Without a state (e.g. state.pickle was removed), the round is
+                # processed and trained from the start
+                self.journal.clear(self.round_number)
             if (self.persistent_state['last_round_processed'] is None or
                     self.persistent_state['last_round_trained'] is None or
-                    self.round_number > self.persistent_state['last_round_processed']):
+                    self.round_number > self.persistent_state['last_round_processed'] or
+                    self.persistent_state['last_round_incomplete']):
                 logger.info('Current round (%d) does not appear to be processed',
                             self.round_number)
                 self.run_new_round()
@@ -380,7 +1329,7 @@ class Numerauto:
             logger.info('Entering daemon loop')
         
             while True:
-                self.round_number = self.napi.get_current_round()
+                self.round_number = self.napi.get_current_round(tournament=self.tournament_id)
                 # Check if we didn't already pass into the next round
                 if self.round_number == self.persistent_state['last_round_processed']:
                     # In case of a single run, check whether we're not going to wait
@@ -389,7 +1338,7 @@ class Numerauto:
                         round_info = self.napi.get_current_round_details(tournament=self.tournament_id)
     
                         dt_round_close = dateutil.parser.parse(round_info['closeTime'])
-                        dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+                        dt_now = self.scheduler.now()
     
                         if (dt_round_close - dt_now).total_seconds() > 86400:
                             logger.info('Single run stopping because new round is more than 1 day in the future')
@@ -407,12 +1356,17 @@ class Numerauto:
                     break
         except InterruptedException:
             logger.info('Exiting daemon loop because of interrupt')
-        
-        # Trigger shutdown event
-        self.on_shutdown()
-
-        # Save internal state
-        self.save_state()
+        finally:
+            # Shut down also if an event handler or step failed
+            try:
+                # Trigger shutdown event
+                self.on_shutdown()
+            finally:
+                self.shutdown_process_pool()
+                self.journal.close()
+
+                # Save internal state
+                self.save_state()
 
 
 # Make this file runnable as a standalone test without event handlers.
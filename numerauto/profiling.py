@@ -0,0 +1,230 @@
+"""
+Opt-in profiling of selected event handlers, events and steps of a round.
+"""
+
+import os
+import cProfile
+import tracemalloc
+import threading
+import contextlib
+import logging
+from pathlib import Path
+
+
+logger = logging.getLogger(__name__)
+
+
+# Environment variable with the comma-separated targets to profile (see Profiler)
+PROFILE_ENV = 'NUMERAUTO_PROFILE'
+
+# Environment variable that enables tracemalloc snapshots if set to 1
+PROFILE_MEMORY_ENV = 'NUMERAUTO_PROFILE_MEMORY'
+
+# Number of lines with the most allocated memory in the summary of a snapshot
+MEMORY_TOP_LINES = 25
+
+
+class Profiler:
+    """
+    Profiles selected event handler calls and steps of a round with cProfile
+    and/or tracemalloc, and writes the profiles to a directory per round:
+        <directory>/round_<round>/<handler>.<event>.prof
+        <directory>/round_<round>/<handler>.<event>.tracemalloc
+        <directory>/round_<round>/<handler>.<event>.tracemalloc.txt
+    Per-tournament calls have the tournament id appended to the handler name
+    (e.g. model-8.on_new_training_data.prof), steps (e.g.
+    download_and_check) are named by the step only. Calls outside a round
+    (on_start, on_shutdown) are written to <directory>/no_round.
+
+    .prof files can be read with pstats or e.g. snakeviz, .tracemalloc files
+    with tracemalloc.Snapshot.load, and the .txt file lists the lines that
+    allocated the most memory that was still allocated at the end of the call.
+
+    Targets select what is profiled: the name of an event handler (all its
+    events), the name of an event (all handlers), handler.event for one event
+    of one handler, the name of a step, or * for everything. cProfile only
+    profiles the thread that runs the call. tracemalloc traces all threads,
+    so snapshots of calls that run concurrently include each other's
+    allocations. Coroutine event handlers of AsyncNumerauto are not
+    profiled, as they share the thread of the event loop.
+
+    Attributes:
+        targets: Set of targets to profile
+        cprofile: Whether calls are profiled with cProfile
+        memory: Whether tracemalloc snapshots are taken
+        memory_frames: Number of frames of the tracebacks of allocations
+        directory: Directory of the profiles
+    """
+
+    def __init__(self, targets, cprofile=True, memory=False, memory_frames=10, directory=Path('./profiles')):
+        """
+        Creates a new Profiler.
+
+        Args:
+            targets: Names of event handlers, events (e.g.
+                     'on_new_training_data'), handler.event pairs or steps
+                     (e.g. 'download_and_check') to profile, or '*' for all
+            cprofile: Profile with cProfile (default: True)
+            memory: Take tracemalloc snapshots (default: False)
+            memory_frames: Number of frames of the tracebacks of allocations
+                           (default: 10)
+            directory: Directory of the profiles (default: ./profiles)
+        """
+
+        self.targets = set(targets)
+        self.cprofile = cprofile
+        self.memory = memory
+        self.memory_frames = memory_frames
+        self.directory = Path(directory)
+        self.memory_sessions = 0
+        self.memory_started = False
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, environ=None):
+        """
+        Creates a Profiler from the environment variables NUMERAUTO_PROFILE
+        (comma-separated targets) and NUMERAUTO_PROFILE_MEMORY (1 to take
+        tracemalloc snapshots), e.g.:
+            NUMERAUTO_PROFILE=model,download_and_check NUMERAUTO_PROFILE_MEMORY=1
+
+        Returns:
+            Profiler, or None if NUMERAUTO_PROFILE is not set.
+        """
+
+        environ = environ if environ is not None else os.environ
+        targets = [t.strip() for t in environ.get(PROFILE_ENV, '').split(',') if t.strip()]
+        if not targets:
+            return None
+
+        memory = environ.get(PROFILE_MEMORY_ENV, '') == '1'
+        logger.info('Profiler: Profiling %s%s', ', '.join(targets), ' with tracemalloc' if memory else '')
+        return cls(targets, memory=memory)
+
+    def __getstate__(self):
+        # Locks can not be pickled, a copy in another process (e.g. in a
+        # process pool) traces memory on its own
+        state = self.__dict__.copy()
+        state['memory_sessions'] = 0
+        state['memory_started'] = False
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def is_selected(self, name, event=None):
+        """
+        Check whether a call is selected for profiling.
+
+        Args:
+            name: Name of the event handler or step
+            event: Name of the event of event handler calls (default: None)
+        """
+
+        return ('*' in self.targets or name in self.targets or
+                (event is not None and (event in self.targets or '{}.{}'.format(name, event) in self.targets)))
+
+    def get_filename(self, round_number, name, event=None, tournament_id=None):
+        """ Get the filename (without extension) of the profile of a call """
+
+        directory = self.directory / ('round_{}'.format(round_number) if round_number is not None else 'no_round')
+        if tournament_id is not None:
+            name = '{}-{}'.format(name, tournament_id)
+        if event is not None:
+            name = '{}.{}'.format(name, event)
+        return directory / name
+
+    @contextlib.contextmanager
+    def profile(self, round_number, name, event=None, tournament_id=None):
+        """
+        Context manager that profiles the code it wraps if the call is
+        selected (see is_selected), and writes the profiles when it ends.
+
+        Args:
+            round_number: Round number, or None for calls outside a round
+            name: Name of the event handler or step
+            event: Name of the event of event handler calls (default: None)
+            tournament_id: Tournament id of per-tournament calls (default: None)
+        """
+
+        if not self.is_selected(name, event):
+            yield
+            return
+
+        filename = self.get_filename(round_number, name, event, tournament_id)
+        filename.parent.mkdir(parents=True, exist_ok=True)
+
+        profile = None
+        if self.cprofile:
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError as e:
+                # Only one profiler can be active at a time in some Python versions
+                logger.warning('Profiler: Not profiling %s with cProfile: %s', filename.name, e)
+                profile = None
+
+        if self.memory:
+            self.start_memory()
+
+        try:
+            yield
+        finally:
+            if profile is not None:
+                profile.disable()
+                profile.dump_stats(str(filename) + '.prof')
+                logger.info('Profiler: Wrote %s.prof', filename)
+
+            if self.memory:
+                try:
+                    self.write_snapshot(filename)
+                finally:
+                    self.stop_memory()
+
+    def start_memory(self):
+        """ Start tracing memory allocations, unless they are traced already """
+
+        with self.lock:
+            if self.memory_sessions == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start(self.memory_frames)
+                self.memory_started = True
+            self.memory_sessions += 1
+
+    def stop_memory(self):
+        """ Stop tracing memory allocations after the last profiled call, if they were started by this profiler """
+
+        with self.lock:
+            self.memory_sessions -= 1
+            if self.memory_sessions == 0 and self.memory_started:
+                tracemalloc.stop()
+                self.memory_started = False
+
+    def write_snapshot(self, filename):
+        """ Take a tracemalloc snapshot and write it with a summary of the top allocating lines """
+
+        current, peak = tracemalloc.get_traced_memory()
+        snapshot = tracemalloc.take_snapshot()
+        snapshot.dump(str(filename) + '.tracemalloc')
+
+        snapshot = snapshot.filter_traces([tracemalloc.Filter(False, tracemalloc.__file__),
+                                           tracemalloc.Filter(False, '<frozen importlib._bootstrap>')])
+        with open(str(filename) + '.tracemalloc.txt', 'w') as fp:
+            fp.write('Traced memory: {:.1f} MiB, peak {:.1f} MiB\n\n'.format(current / 2**20, peak / 2**20))
+            for stat in snapshot.statistics('lineno')[:MEMORY_TOP_LINES]:
+                fp.write('{}\n'.format(stat))
+        logger.info('Profiler: Wrote %s.tracemalloc', filename)
+
+
+def profile_call(profiler, round_number, name, event, tournament_id, func, *args):
+    """
+    Calls a function under a profiler, in the thread (or process) that runs
+    it, e.g. an event handler in an executor.
+
+    Returns:
+        Return value of the function
+    """
+
+    with profiler.profile(round_number, name, event=event, tournament_id=tournament_id):
+        return func(*args)
@@ -2,20 +2,57 @@
 Module containing a robust implementation of NumerAPI.
 """
 
+import os
+import re
+import json
+import time
+import zipfile
+import threading
 import logging
 
 import requests
+from requests.adapters import HTTPAdapter
 from requests.exceptions import RequestException
 
 import numerapi
+from numerapi.utils import ensure_directory_exists
 
 from .utils import wait_for_retry
+from .download import Downloader, DownloadError, DOWNLOAD_WORKERS, remove_download_state
+from .instrumentation import Instrumentation
 
 logger = logging.getLogger(__name__)
 
 
 API_TOURNAMENT_URL = 'https://api-tournament.numer.ai'
 
+# Default (connect, read) timeout of requests in seconds
+DEFAULT_TIMEOUT = (10, 60)
+
+# Name of the first field of a GraphQL query, used to name API calls
+QUERY_NAME = re.compile(r'\{\s*(\w+)')
+
+
+def create_session(pool_maxsize=10):
+    """
+    Creates a requests Session with a connection pool. Connections are kept
+    alive between requests, so repeated requests to the same host do not need
+    a new TCP and TLS handshake.
+
+    Args:
+        pool_maxsize: Maximum number of connections kept per host.
+
+    Returns:
+        requests.Session
+    """
+
+    session = requests.Session()
+    # Retries are handled by RobustNumerAPI
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_maxsize, max_retries=0)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
 
 class NumerAPIAuthorizationError(Exception):
     """ Error that is raised if authorization using the Numerai API fails. """
@@ -33,13 +70,228 @@ class NumerAPIError(Exception):
         super().__init__(message)
         self.errors = errors
 
+# Default time to live of cached query results in seconds, by query
+DEFAULT_CACHE_TTLS = {'tournaments': 86400,
+                      'round_details': 3600}
+
+# Minimum time to live in seconds of the cached query results that are
+# persisted. Shorter-lived results (e.g. round details, which are refreshed on
+# every poll while waiting for a new round) are kept in memory only.
+PERSIST_MIN_TTL = 86400
+
+
+class MetadataCache:
+    """
+    Cache of Numerai API query results that rarely change, such as the list of
+    tournaments and the details of the current round.
+
+    Each entry expires after the time to live of its query. Concurrent
+    requests for the same entry are coalesced: only one thread queries the
+    API while the others wait for its result. Optionally, the entries of
+    queries with a time to live of at least persist_min_ttl seconds are
+    persisted to a JSON file so they survive restarts. The file is only
+    written when such an entry is stored.
+
+    Attributes:
+        filename: Filename the cache is persisted to (None if not persisted)
+        ttls: Dictionary of query name to time to live in seconds
+        persist_min_ttl: Minimum time to live of persisted entries in seconds
+        entries: Dictionary of key to (expiry timestamp, value)
+        persisted_keys: Keys of the entries that are persisted
+    """
+
+    def __init__(self, filename=None, ttls=None, persist_min_ttl=PERSIST_MIN_TTL):
+        """
+        Creates a new MetadataCache.
+
+        Args:
+            filename: Filename to persist the cache to (default: None, i.e.
+                      keep the cache in memory only)
+            ttls: Dictionary of query name to time to live in seconds, to
+                  override DEFAULT_CACHE_TTLS
+            persist_min_ttl: Minimum time to live of the entries that are
+                             persisted, in seconds (default: 86400)
+        """
+
+        self.filename = filename
+        self.ttls = dict(DEFAULT_CACHE_TTLS)
+        if ttls is not None:
+            self.ttls.update(ttls)
+
+        self.persist_min_ttl = persist_min_ttl
+        self.entries = {}
+        self.persisted_keys = set()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+
+        if filename is not None:
+            self.load()
+
+    def get(self, query, key, fetch, refresh=False):
+        """
+        Get an entry from the cache, or fetch it if it is not cached or has
+        expired.
+
+        Args:
+            query: Name of the query (determines the time to live)
+            key: Key of the entry
+            fetch: Function without arguments that fetches the value
+            refresh: Fetch the value even if it is cached (default: False)
+
+        Returns:
+            The cached or fetched value
+        """
+
+        while True:
+            with self.lock:
+                entry = self.entries.get(key)
+                if not refresh and entry is not None and entry[0] > time.time():
+                    return entry[1]
+
+                event = self.in_flight.get(key)
+                fetching = event is None
+                if fetching:
+                    event = self.in_flight[key] = threading.Event()
+
+            if not fetching:
+                # Another thread is fetching this entry, use its result
+                event.wait()
+                refresh = False
+                continue
+
+            try:
+                value = fetch()
+                self.put(query, key, value)
+                return value
+            finally:
+                with self.lock:
+                    del self.in_flight[key]
+                event.set()
+
+    def put(self, query, key, value):
+        """ Store a value in the cache """
+
+        ttl = self.ttls.get(query, 0)
+        persist = ttl >= self.persist_min_ttl
+        with self.lock:
+            self.entries[key] = (time.time() + ttl, value)
+            if persist:
+                self.persisted_keys.add(key)
+
+        if self.filename is not None and persist:
+            self.save()
+
+    def invalidate(self, key):
+        """ Remove an entry from the cache """
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.persisted_keys.discard(key)
+
+    def load(self):
+        """ Load the cache from file, ignoring expired entries """
+
+        try:
+            with open(self.filename, 'r') as fp:
+                entries = json.load(fp)
+        except FileNotFoundError:
+            return
+        except ValueError:
+            logger.warning('MetadataCache: Could not parse %s', self.filename)
+            return
+
+        now = time.time()
+        with self.lock:
+            self.entries = {k: tuple(v) for k, v in entries.items() if v[0] > now}
+            self.persisted_keys = set(self.entries)
+
+    def save(self):
+        """ Save the cache to file """
+
+        with self.lock:
+            entries = {k: v for k, v in self.entries.items() if k in self.persisted_keys}
+
+        ensure_directory_exists(os.path.dirname(os.path.abspath(str(self.filename))))
+        tmp_filename = '{}.tmp'.format(self.filename)
+        with open(tmp_filename, 'w') as fp:
+            json.dump(entries, fp)
+        os.replace(tmp_filename, str(self.filename))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['in_flight'] = {}
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+
 class RobustNumerAPI(numerapi.NumerAPI):
     """
     Robust implementation of NumerAPI.
 
     Checks for failure of requests and retries the requests until they succeed.
+    All requests (queries, dataset downloads and prediction uploads) go through
+    one pooled requests Session with keep-alive, and have a timeout.
+
+    The list of tournaments and the round details are cached in a
+    MetadataCache. Only get_current_round and get_current_round_details with
+    refresh=True always query the API (and refresh the cached round details).
+
+    Attributes:
+        session: requests Session used for all requests
+        timeout: Timeout of requests in seconds, or a (connect, read) tuple
+        cache: MetadataCache for query results
+        downloader: Downloader for dataset files
+        api_url: URL of the Numerai GraphQL API
+        instrumentation: Instrumentation that measures API calls and counts
+                         retries
     """
 
+    def __init__(self, public_id=None, secret_key=None, verbosity='INFO',
+                 show_progress_bars=True, session=None, timeout=DEFAULT_TIMEOUT, cache=None,
+                 download_workers=DOWNLOAD_WORKERS, api_url=API_TOURNAMENT_URL, instrumentation=None,
+                 scheduler=None):
+        """
+        Creates a RobustNumerAPI instance.
+
+        Args:
+            public_id: Numerai public API key (optional)
+            secret_key: Numerai secret API key (optional)
+            verbosity: Log level of NumerAPI
+            show_progress_bars: Flag to turn off NumerAPI progress bars
+            session: requests Session to use, e.g. to share a connection pool
+                     with another instance (default: None, i.e. create a new
+                     session)
+            timeout: Timeout of requests in seconds, or a (connect, read)
+                     tuple (default: (10, 60))
+            cache: MetadataCache to use, e.g. to share it with another
+                   instance (default: None, i.e. create a new in-memory cache)
+            download_workers: Number of parts of a file that are downloaded
+                              in parallel (default: 4)
+            api_url: URL of the Numerai GraphQL API, e.g. of a local stand-in
+                     for testing (default: API_TOURNAMENT_URL)
+            instrumentation: Instrumentation that measures API calls, e.g.
+                             that of a Numerauto instance (default: None,
+                             i.e. a new Instrumentation that writes no reports)
+            scheduler: Scheduler that retries of failed requests wait on, e.g.
+                       that of a Numerauto instance (default: None, i.e. the
+                       default scheduler)
+        """
+
+        super().__init__(public_id=public_id, secret_key=secret_key, verbosity=verbosity,
+                         show_progress_bars=show_progress_bars)
+        self.session = session if session is not None else create_session()
+        self.timeout = timeout
+        self.cache = cache if cache is not None else MetadataCache()
+        self.downloader = Downloader(self.session, timeout=self.timeout, workers=download_workers)
+        self.api_url = api_url
+        self.instrumentation = (instrumentation if instrumentation is not None
+                                else Instrumentation(directory=None))
+        self.scheduler = scheduler
+
     def __raw_query_patched(self, query, variables=None, authorization=False):
         """
         NumerAPI raw_query modified to not raise ValueErrors. Instead,
@@ -57,7 +309,7 @@ class RobustNumerAPI(numerapi.NumerAPI):
                     'Token {}${}'.format(public_id, secret_key)
             else:
                 raise NumerAPIAuthorizationError("API keys required for this action.")
-        r = requests.post(API_TOURNAMENT_URL, json=body, headers=headers)
+        r = self.session.post(self.api_url, json=body, headers=headers, timeout=self.timeout)
         
         # Ensure any 4xx and 5xx return codes raise an HTTPError
         r.raise_for_status()
@@ -73,21 +325,91 @@ class RobustNumerAPI(numerapi.NumerAPI):
     def raw_query(self, query, variables=None, authorization=False):
         """
         Robust implementation of raw_query. Will retry the query if a
-        RequestException is intercepted.
+        RequestException is intercepted. Every attempt is measured, under the
+        name of the first field of the query (e.g. 'rounds').
         """
 
+        match = QUERY_NAME.search(query)
+        name = match.group(1) if match else 'query'
+
         attempt_number = 0
         while True:
             try:
-                return self.__raw_query_patched(query, variables=variables,
-                                                authorization=authorization)
+                with self.instrumentation.measure('api', name):
+                    return self.__raw_query_patched(query, variables=variables,
+                                                    authorization=authorization)
             except RequestException as e:
                 logger.error('Request failed: %s', e)
-                wait_for_retry(attempt_number)
+                self.instrumentation.count_retry('api', name)
+                wait_for_retry(attempt_number, self.scheduler)
                 attempt_number += 1
 
                 # TODO: See if we need to re-raise some request exceptions
 
+    def get_dataset_url_once(self, tournament=1):
+        """
+        Get the URL of the current dataset with a single request that is not
+        retried, e.g. to probe the dataset while polling for a new round.
+
+        Args:
+            tournament: ID of the tournament (default: 1)
+
+        Returns:
+            URL of the dataset
+
+        Raises:
+            RequestException, NumerAPIError: The request failed
+        """
+
+        query = '''
+            query($tournament: Int!) {
+                dataset(tournament: $tournament)
+            }
+            '''
+        return self.__raw_query_patched(query, {'tournament': tournament})['data']['dataset']
+
+    def __upload_predictions_patched(self, file_path, tournament=1):
+        """
+        NumerAPI upload_predictions modified to upload through the session of
+        this instance, and to raise an HTTPError if the upload fails.
+        """
+
+        logger.info('Uploading predictions: %s', file_path)
+
+        auth_query = '''
+            query($filename: String!
+                  $tournament: Int!) {
+                submission_upload_auth(filename: $filename
+                                       tournament: $tournament) {
+                    filename
+                    url
+                }
+            }
+            '''
+        arguments = {'filename': os.path.basename(str(file_path)),
+                     'tournament': tournament}
+        submission_resp = self.raw_query(auth_query, arguments, authorization=True)
+        submission_auth = submission_resp['data']['submission_upload_auth']
+
+        with open(file_path, 'rb') as fp:
+            r = self.session.put(submission_auth['url'], data=fp.read(), timeout=self.timeout)
+        r.raise_for_status()
+
+        create_query = '''
+            mutation($filename: String!
+                     $tournament: Int!) {
+                create_submission(filename: $filename
+                                  tournament: $tournament) {
+                    id
+                }
+            }
+            '''
+        arguments = {'filename': submission_auth['filename'],
+                     'tournament': tournament}
+        create = self.raw_query(create_query, arguments, authorization=True)
+        self.submission_id = create['data']['create_submission']['id']
+        return self.submission_id
+
     def upload_predictions(self, file_path, tournament=1):
         """
         Robust implementation of upload_predictions. Will retry the upload if a
@@ -97,21 +419,88 @@ class RobustNumerAPI(numerapi.NumerAPI):
         attempt_number = 0
         while True:
             try:
-                return super().upload_predictions(file_path, tournament=tournament)
+                with self.instrumentation.measure('api', 'upload_predictions'):
+                    return self.__upload_predictions_patched(file_path, tournament=tournament)
             except RequestException as e:
                 logger.error('Upload request failed: %s', e)
-                wait_for_retry(attempt_number)
+                self.instrumentation.count_retry('api', 'upload_predictions')
+                wait_for_retry(attempt_number, self.scheduler)
                 attempt_number += 1
 
                 # TODO: See if we need to re-raise some request exceptions
 
-    def get_current_round_details(self, tournament=1):
+    def get_tournaments(self, only_active=True):
+        """
+        Cached implementation of get_tournaments.
+
+        Args:
+            only_active: Only return active tournaments (default: True)
+
+        Returns:
+            List of tournament dictionaries.
+        """
+
+        tournaments = self.cache.get('tournaments', 'tournaments', self.__get_tournaments)
+        if only_active:
+            tournaments = [t for t in tournaments if t['active']]
+        return tournaments
+
+    def __get_tournaments(self):
         """
-        Requests time details about the current round.
+        Uncached implementation of get_tournaments, which returns all
+        tournaments (queried directly, as not all NumerAPI versions accept
+        the only_active argument).
+        """
+
+        query = '''
+            query {
+              tournaments {
+                id
+                name
+                tournament
+                active
+              }
+            }
+        '''
+
+        raw = self.raw_query(query)
+
+        if raw is None:
+            logger.error('get_tournaments returned None')
+            raise RuntimeError('get_tournaments returned None')
+
+        return raw['data']['tournaments']
+
+    def get_current_round(self, tournament=1):
+        """
+        Requests the number of the current round. Always queries the API, and
+        refreshes the cached round details.
+
+        Returns:
+            Current round number.
+        """
+
+        return self.get_current_round_details(tournament=tournament, refresh=True)['number']
+
+    def get_current_round_details(self, tournament=1, refresh=False):
+        """
+        Requests time details about the current round. The details are cached,
+        use refresh to poll for a new round.
+
+        Args:
+            tournament: ID of the tournament (default: 1)
+            refresh: Query the API even if the details are cached (default: False)
 
         Returns:
             Dictionary containing round details.
         """
+
+        return self.cache.get('round_details', 'round_details_{}'.format(tournament),
+                              lambda: self.__get_current_round_details(tournament), refresh=refresh)
+
+    def __get_current_round_details(self, tournament):
+        """ Uncached implementation of get_current_round_details """
+
         query = '''
             query($tournament: Int!) {
               rounds(tournament: $tournament
@@ -134,3 +523,95 @@ class RobustNumerAPI(numerapi.NumerAPI):
             raise RuntimeError('get_current_round_details returned None')
 
         return raw['data']['rounds'][0]
+
+    def download_file(self, url, filename):
+        """
+        Downloads a file through the session of this instance, using parallel
+        range requests (see download.Downloader). The file is written under a
+        temporary name and renamed when the download is complete and
+        verified, so an interrupted download never leaves a partial file
+        under the final name. An interrupted download is resumed by the next
+        call, and the transfer is skipped if the file exists and the remote
+        file did not change.
+
+        Args:
+            url: URL of the file
+            filename: Destination filename
+
+        Returns:
+            True if the file was transferred, False if it was unchanged.
+        """
+
+        logger.debug('download_file(%s)', filename)
+        return self.downloader.download(url, filename)
+
+    def download_current_dataset(self, dest_path='.', dest_filename=None, unzip=True, tournament=1):
+        """
+        NumerAPI download_current_dataset modified to download through the
+        session of this instance with download_file, retrying failed
+        downloads. The zip file is verified after it is transferred. If the
+        dataset exists and did not change, it is not downloaded again.
+
+        Args:
+            dest_path: Destination directory (default: .)
+            dest_filename: Filename of the dataset (default: None, i.e.
+                           numerai_dataset_<round number>.zip)
+            unzip: Whether to unzip the dataset (default: True)
+            tournament: ID of the tournament (default: 1)
+
+        Returns:
+            Path of the downloaded dataset
+        """
+
+        if dest_filename is None:
+            dest_filename = 'numerai_dataset_{}.zip'.format(self.get_current_round(tournament))
+        elif unzip and not dest_filename.endswith('.zip'):
+            dest_filename += '.zip'
+        dataset_path = os.path.join(str(dest_path), dest_filename)
+
+        ensure_directory_exists(str(dest_path))
+
+        attempt_number = 0
+        while True:
+            try:
+                # Request the URL for every attempt, as it may expire
+                url = self.get_dataset_url(tournament)
+                with self.instrumentation.measure('download', 'dataset'):
+                    transferred = self.download_file(url, dataset_path)
+                break
+            except RequestException as e:
+                logger.error('Download failed: %s', e)
+                self.instrumentation.count_retry('download', 'dataset')
+                wait_for_retry(attempt_number, self.scheduler)
+                attempt_number += 1
+
+        if transferred:
+            verify_zip(dataset_path)
+
+        unzip_path = os.path.join(str(dest_path), dest_filename[:-4])
+        if unzip and (transferred or not os.path.isdir(unzip_path)):
+            with zipfile.ZipFile(dataset_path, 'r') as z:
+                z.extractall(unzip_path)
+
+        return dataset_path
+
+
+def verify_zip(filename):
+    """
+    Verifies the CRC checksums of all files in a zip file. If the zip file is
+    corrupt, it is removed so it is downloaded again.
+
+    Raises:
+        DownloadError: The zip file is corrupt
+    """
+
+    try:
+        with zipfile.ZipFile(filename, 'r') as z:
+            bad_member = z.testzip()
+    except zipfile.BadZipFile as e:
+        bad_member = e
+
+    if bad_member is not None:
+        os.remove(filename)
+        remove_download_state(filename)
+        raise DownloadError('Corrupt zip file {}: {}'.format(filename, bad_member))
@@ -0,0 +1,413 @@
+"""
+Scheduler for timed waits and jobs.
+
+The Scheduler keeps a queue of timed jobs (e.g. periodic cleanup or
+pre-warming tasks) that run in a background thread, which sleeps until the
+next deadline instead of waking up periodically. Threads can wait until a
+point in time with Scheduler.wait_until, and asyncio coroutines with
+Scheduler.async_wait_until. Waits and jobs stop at once when a
+stop is requested (e.g. by a SIGINT/SIGTERM handler), after which waits raise
+InterruptedException.
+
+Time is read from a clock object, so the scheduler can be driven by a clock
+other than the system clock (e.g. an AcceleratedClock for simulations).
+"""
+
+import heapq
+import asyncio
+import time
+import datetime
+import itertools
+import threading
+import logging
+
+import pytz
+
+
+logger = logging.getLogger(__name__)
+
+
+# Maximum time in seconds that is slept at once, so long waits follow changes
+# of the system time
+MAX_SLEEP = 600
+
+
+class InterruptedException(Exception):
+    """ Exception that is raised by waits after a stop has been requested. """
+    pass
+
+
+class SystemClock:
+    """ Clock that follows the system time """
+
+    def now(self):
+        """ Returns the current time as a timezone-aware UTC datetime """
+        return datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+
+    def sleep(self, event, seconds):
+        """
+        Sleeps for a number of seconds, or until an event is set.
+
+        Returns:
+            True if the event was set, False otherwise.
+        """
+        return event.wait(seconds)
+
+
+class AcceleratedClock:
+    """
+    Clock that runs faster than the system time, to simulate days of daemon
+    behaviour (e.g. against a local stand-in of the Numerai API) in seconds.
+
+    Time runs speed times faster than real time while any thread sleeps on
+    the clock, and at real time otherwise. Waiting (e.g. for the next round
+    or a retry) is compressed, while the time spent on actual work (downloads,
+    training) is measured as it is, so the latency from the start of a round
+    to the upload of predictions is measured realistically.
+
+    Attributes:
+        speed: Factor by which sleeps are compressed
+        start: Time of the clock when it was created
+    """
+
+    def __init__(self, speed=1000, start=None):
+        """
+        Creates a new AcceleratedClock.
+
+        Args:
+            speed: Factor by which sleeps are compressed (default: 1000)
+            start: Timezone-aware datetime at which the clock starts
+                   (default: None, i.e. the current system time)
+        """
+
+        self.speed = speed
+        self.start = start if start is not None else SystemClock().now()
+        self.lock = threading.Lock()
+        self.started = time.monotonic()
+        # Real seconds during which at least one thread slept
+        self.sleeping_time = 0
+        self.sleepers = 0
+        self.sleeping_since = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def now(self):
+        """ Returns the current time of the clock as a timezone-aware UTC datetime """
+
+        with self.lock:
+            real = time.monotonic()
+            sleeping = self.sleeping_time
+            if self.sleepers > 0:
+                sleeping += real - self.sleeping_since
+
+        elapsed = (real - self.started) + sleeping * (self.speed - 1)
+        return self.start + datetime.timedelta(seconds=elapsed)
+
+    def sleep(self, event, seconds):
+        """
+        Sleeps for a number of seconds of clock time, or until an event is set.
+
+        Returns:
+            True if the event was set, False otherwise.
+        """
+
+        with self.lock:
+            if self.sleepers == 0:
+                self.sleeping_since = time.monotonic()
+            self.sleepers += 1
+
+        try:
+            return event.wait(seconds / self.speed)
+        finally:
+            with self.lock:
+                self.sleepers -= 1
+                if self.sleepers == 0:
+                    self.sleeping_time += time.monotonic() - self.sleeping_since
+
+
+class Job:
+    """
+    A function scheduled on a Scheduler.
+
+    Attributes:
+        func: Function without arguments that is called
+        deadline: datetime of the next call
+        interval: Seconds between calls of a recurring job (None for a
+                  one-time job)
+        name: Name of the job, used in log messages
+        cancelled: Whether the job was cancelled
+    """
+
+    def __init__(self, func, deadline, interval=None, name=None):
+        self.func = func
+        self.deadline = deadline
+        self.interval = interval
+        self.name = name if name is not None else getattr(func, '__name__', repr(func))
+        self.cancelled = False
+
+    def cancel(self):
+        """ Cancels the job. A call that is already running is not interrupted. """
+        self.cancelled = True
+
+
+class Scheduler:
+    """
+    Timer queue that runs scheduled jobs and implements interruptible waits.
+
+    Attributes:
+        clock: Clock that is used to read and sleep
+    """
+
+    def __init__(self, clock=None):
+        """
+        Creates a new Scheduler.
+
+        Args:
+            clock: Clock to use (default: None, i.e. SystemClock)
+        """
+
+        self.clock = clock if clock is not None else SystemClock()
+        self.queue = []
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.wakeup_event = threading.Event()
+        # Functions that are called when a stop is requested (see async_wait_until)
+        self.stop_callbacks = []
+        self.thread = None
+
+    def __getstate__(self):
+        # A copy of the scheduler in another process starts without jobs
+        return {'clock': self.clock}
+
+    def __setstate__(self, state):
+        self.__init__(clock=state['clock'])
+
+    def now(self):
+        """ Returns the current time of the clock of this scheduler """
+        return self.clock.now()
+
+    def schedule(self, func, at=None, delay=None, interval=None, name=None):
+        """
+        Schedules a function to run in the scheduler thread. Jobs should be
+        short, or hand off their work to another thread. Exceptions raised by
+        a job are logged.
+
+        Args:
+            func: Function without arguments to call
+            at: datetime of the first call (default: None, i.e. use delay)
+            delay: Seconds until the first call (default: None, i.e.
+                   interval, or immediately for one-time jobs)
+            interval: Seconds between calls, for a recurring job (default:
+                      None, i.e. call once)
+            name: Name of the job, used in log messages
+
+        Returns:
+            Job, which can be cancelled.
+        """
+
+        if at is None:
+            if delay is None:
+                delay = interval if interval is not None else 0
+            at = self.now() + datetime.timedelta(seconds=delay)
+
+        job = Job(func, at, interval=interval, name=name)
+        logger.debug('Scheduler: Scheduling %s at %s', job.name, at)
+
+        with self.lock:
+            heapq.heappush(self.queue, (job.deadline, next(self.counter), job))
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.run_jobs, name='numerauto-scheduler', daemon=True)
+                self.thread.start()
+
+        # Wake up the scheduler thread, the new job may be due first
+        self.wakeup_event.set()
+        return job
+
+    def run_jobs(self):
+        """ Scheduler thread: runs jobs as they become due, until a stop is requested """
+
+        while not self.stop_event.is_set():
+            self.wakeup_event.clear()
+
+            with self.lock:
+                # Remove cancelled jobs
+                while self.queue and self.queue[0][2].cancelled:
+                    heapq.heappop(self.queue)
+
+                if not self.queue:
+                    self.thread = None
+                    return
+
+                deadline, _, job = self.queue[0]
+                remaining = (deadline - self.now()).total_seconds()
+                if remaining <= 0:
+                    heapq.heappop(self.queue)
+
+            if remaining > 0:
+                # Sleep until the next deadline, a new job, or a stop request
+                self.clock.sleep(self.wakeup_event, min(remaining, MAX_SLEEP))
+                continue
+
+            try:
+                job.func()
+            except Exception:
+                logger.exception('Scheduler: Job %s failed', job.name)
+
+            if job.interval is not None and not job.cancelled:
+                # Recurring jobs are scheduled relative to their deadline, so they do not drift
+                job.deadline = max(deadline + datetime.timedelta(seconds=job.interval), self.now())
+                with self.lock:
+                    heapq.heappush(self.queue, (job.deadline, next(self.counter), job))
+
+        with self.lock:
+            self.thread = None
+
+    def wait(self, seconds):
+        """
+        Waits for a number of seconds.
+
+        Raises:
+            InterruptedException: A stop was requested
+        """
+
+        self.wait_until(self.now() + datetime.timedelta(seconds=seconds))
+
+    def wait_until(self, timestamp):
+        """
+        Waits until a point in time. The waiting thread sleeps until the
+        deadline, and wakes up at once if a stop is requested.
+
+        Args:
+            timestamp: Timezone-aware datetime to wait until
+
+        Raises:
+            InterruptedException: A stop was requested
+        """
+
+        while True:
+            if self.stop_event.is_set():
+                raise InterruptedException()
+
+            remaining = (timestamp - self.now()).total_seconds()
+            if remaining <= 0:
+                return
+
+            self.clock.sleep(self.stop_event, min(remaining, MAX_SLEEP))
+
+    async def async_wait(self, seconds):
+        """
+        Asynchronous version of wait, for use in asyncio coroutines.
+
+        Raises:
+            InterruptedException: A stop was requested
+        """
+
+        await self.async_wait_until(self.now() + datetime.timedelta(seconds=seconds))
+
+    async def async_wait_until(self, timestamp):
+        """
+        Asynchronous version of wait_until, for use in asyncio coroutines. A
+        job of this scheduler ends the wait at the deadline, so the wait
+        follows the clock of the scheduler without blocking the event loop.
+        The wait can also be interrupted by cancelling the task.
+
+        Args:
+            timestamp: Timezone-aware datetime to wait until
+
+        Raises:
+            InterruptedException: A stop was requested
+        """
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(exception=None):
+            if not future.done():
+                if exception is None:
+                    future.set_result(None)
+                else:
+                    future.set_exception(exception)
+
+        def wake():
+            loop.call_soon_threadsafe(resolve)
+
+        def interrupt():
+            loop.call_soon_threadsafe(resolve, InterruptedException())
+
+        with self.lock:
+            self.stop_callbacks.append(interrupt)
+
+        job = None
+        try:
+            if self.stop_event.is_set():
+                raise InterruptedException()
+            job = self.schedule(wake, at=timestamp, name='async_wait_until')
+            await future
+        finally:
+            if job is not None:
+                job.cancel()
+            with self.lock:
+                self.stop_callbacks.remove(interrupt)
+
+    def request_stop(self):
+        """
+        Requests all waits and the scheduler thread to stop. Signal handlers
+        should call this from another thread (see Numerauto.handle_signal),
+        as it acquires locks that the interrupted thread may hold.
+        """
+
+        self.stop_event.set()
+        self.wakeup_event.set()
+
+        with self.lock:
+            callbacks = list(self.stop_callbacks)
+        for callback in callbacks:
+            callback()
+
+    def stop_requested(self):
+        """ Returns whether a stop was requested """
+        return self.stop_event.is_set()
+
+    def reset(self):
+        """ Clears a stop request, so waits can be used again """
+
+        self.stop_event.clear()
+        with self.lock:
+            if self.queue and (self.thread is None or not self.thread.is_alive()):
+                self.thread = threading.Thread(target=self.run_jobs, name='numerauto-scheduler', daemon=True)
+                self.thread.start()
+
+
+# Scheduler used by utils.wait and utils.wait_until
+_default_scheduler = None
+_default_scheduler_lock = threading.Lock()
+
+
+def get_default_scheduler():
+    """ Returns the process-wide default Scheduler, creating it on first use """
+
+    global _default_scheduler
+    with _default_scheduler_lock:
+        if _default_scheduler is None:
+            _default_scheduler = Scheduler()
+        return _default_scheduler
+
+
+def set_default_scheduler(scheduler):
+    """
+    Replaces the process-wide default Scheduler, e.g. with a Scheduler that
+    uses an AcceleratedClock, so the waits of utils.wait and utils.wait_until
+    follow that clock.
+    """
+
+    global _default_scheduler
+    with _default_scheduler_lock:
+        _default_scheduler = scheduler
@@ -4,25 +4,485 @@ Utilities for Numerauto
 
 import os
 import logging
-import time
-import datetime
+import itertools
+import json
 
+import numpy
 import pandas
-import pytz
+
+from .scheduler import get_default_scheduler
 
 
 logger = logging.getLogger(__name__)
 
 
-def check_dataset(filename_old, filename_new, data_type=None):
+DATASET_CHUNKSIZE = 100000
+
+# Version of the fingerprint manifest format. Bump this when the row digest
+# changes, so manifests written by older versions are ignored.
+FINGERPRINT_VERSION = 1
+
+
+def read_dataset_chunks(filename, data_type=None, chunksize=DATASET_CHUNKSIZE):
+    """
+    Reads a Numerai dataset in chunks of rows, so that the full dataset never
+    has to be kept in memory. Optionally only rows with a specified data_type
+    are returned.
+
+    Args:
+        filename: Filename (or file-like object) of the dataset
+        data_type: Data type of the rows to return (default: None, i.e. all rows)
+        chunksize: Number of rows read per chunk
+
+    Returns:
+        Generator of pandas DataFrames
+    """
+
+    for chunk in pandas.read_csv(filename, chunksize=chunksize):
+        if data_type is not None:
+            chunk = chunk[chunk['data_type'] == data_type]
+        yield chunk
+
+
+def hash_rows(chunk):
+    """
+    Computes a 64-bit digest for every row of a dataset chunk. Numeric columns
+    are hashed as float64, so the digest does not depend on the dtype pandas
+    happens to infer for a particular chunk. Changes of the dtypes of the
+    columns are detected separately (see merge_dtypes).
+
+    Args:
+        chunk: pandas DataFrame
+
+    Returns:
+        numpy uint64 array with one digest per row
+    """
+
+    numeric_columns = chunk.select_dtypes(include=['number', 'bool']).columns
+    if len(numeric_columns) > 0:
+        chunk = chunk.astype({c: numpy.float64 for c in numeric_columns})
+
+    return pandas.util.hash_pandas_object(chunk, index=False).values
+
+
+def merge_dtypes(dtypes, chunk):
+    """
+    Merges the dtypes of the columns of a dataset chunk with those of the
+    previous chunks, like pandas does when it reads a whole file: numeric
+    dtypes are promoted (e.g. a column with missing values in some chunks is
+    float64), other mixed dtypes become object.
+
+    Args:
+        dtypes: List of dtype names of the previous chunks, or None for the
+                first chunk
+        chunk: pandas DataFrame
+
+    Returns:
+        List of dtype names, one per column
+    """
+
+    chunk_dtypes = list(chunk.dtypes)
+    if dtypes is None:
+        return [str(dtype) for dtype in chunk_dtypes]
+
+    merged = []
+    for name, dtype in zip(dtypes, chunk_dtypes):
+        if name == str(dtype):
+            merged.append(name)
+        elif pandas.api.types.pandas_dtype(name).kind in 'iuf' and dtype.kind in 'iuf':
+            merged.append(str(numpy.result_type(name, dtype)))
+        else:
+            merged.append('object')
+    return merged
+
+
+class DatasetDigest:
+    """
+    Order-independent digest of a set of dataset rows. Two datasets that
+    contain the same rows, in any order, have the same digest.
+
+    Attributes:
+        rows: Number of rows added to the digest
+        sum: Sum of the row digests (modulo 2^64)
+        xor: Exclusive or of the row digests
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.sum = 0
+        self.xor = 0
+
+    def update(self, row_hashes):
+        """
+        Add rows to the digest.
+
+        Args:
+            row_hashes: numpy uint64 array of row digests (see hash_rows)
+        """
+
+        if len(row_hashes) == 0:
+            return
+
+        self.rows += len(row_hashes)
+        self.sum = (self.sum + int(row_hashes.sum(dtype=numpy.uint64))) & 0xffffffffffffffff
+        self.xor ^= int(numpy.bitwise_xor.reduce(row_hashes))
+
+    def hexdigest(self):
+        """ Returns the digest as a hexadecimal string """
+        return '{:016x}{:016x}'.format(self.sum, self.xor)
+
+    @classmethod
+    def from_dict(cls, d):
+        """ Creates a digest from a dictionary created by to_dict """
+        digest = cls()
+        digest.rows = d['rows']
+        digest.sum = int(d['digest'][:16], 16)
+        digest.xor = int(d['digest'][16:], 16)
+        return digest
+
+    def to_dict(self):
+        """ Returns the digest as a JSON serializable dictionary """
+        return {'rows': self.rows, 'digest': self.hexdigest()}
+
+    def __eq__(self, other):
+        return (self.rows, self.sum, self.xor) == (other.rows, other.sum, other.xor)
+
+
+class DatasetFingerprint:
+    """
+    Fingerprint of a Numerai dataset file: its columns, and an
+    order-independent digest of all rows, of the rows of each data_type and of
+    the rows of each era. Optionally, the id and digest of every row are kept
+    as well (see write_row_hashes).
+
+    Attributes:
+        columns: List of column names
+        dtypes: List of dtype names of the columns (None if unknown)
+        digest: DatasetDigest of all rows
+        partitions: Dictionary of data_type to DatasetDigest
+        eras: Dictionary of era to DatasetDigest
+        row_ids: List of arrays of row ids (None if rows are not kept)
+        row_hashes: List of arrays of row digests (None if rows are not kept)
+    """
+
+    def __init__(self, columns=None, keep_rows=False, dtypes=None):
+        self.columns = columns
+        self.dtypes = dtypes
+        self.digest = DatasetDigest()
+        self.partitions = {}
+        self.eras = {}
+        self.row_ids = [] if keep_rows else None
+        self.row_hashes = [] if keep_rows else None
+
+    @classmethod
+    def from_file(cls, filename, chunksize=DATASET_CHUNKSIZE, keep_rows=False):
+        """
+        Computes the fingerprint of a dataset file in a single streaming pass.
+
+        Args:
+            filename: Filename of the dataset
+            chunksize: Number of rows read per chunk
+            keep_rows: Keep the id and digest of every row (default: False)
+
+        Returns:
+            DatasetFingerprint
+        """
+
+        logger.debug('DatasetFingerprint.from_file(%s)', filename)
+
+        fingerprint = cls(keep_rows=keep_rows)
+        for chunk in read_dataset_chunks(filename, chunksize=chunksize):
+            fingerprint.update(chunk)
+        return fingerprint
+
+    @classmethod
+    def from_dict(cls, d):
+        """ Creates a fingerprint from a dictionary created by to_dict """
+        # Manifests written before dtypes were added have none
+        fingerprint = cls(d['columns'], dtypes=d.get('dtypes'))
+        fingerprint.digest = DatasetDigest.from_dict(d)
+        fingerprint.partitions = {k: DatasetDigest.from_dict(v) for k, v in d['partitions'].items()}
+        # Manifests written before era digests were added have none
+        fingerprint.eras = {k: DatasetDigest.from_dict(v) for k, v in d.get('eras', {}).items()}
+        return fingerprint
+
+    def to_dict(self):
+        """ Returns the fingerprint as a JSON serializable dictionary """
+        d = self.digest.to_dict()
+        d['columns'] = self.columns
+        d['dtypes'] = self.dtypes
+        d['partitions'] = {k: v.to_dict() for k, v in self.partitions.items()}
+        d['eras'] = {k: v.to_dict() for k, v in self.eras.items()}
+        return d
+
+    def update(self, chunk):
+        """
+        Add a chunk of rows to the fingerprint.
+
+        Args:
+            chunk: pandas DataFrame
+        """
+
+        if self.columns is None:
+            self.columns = list(chunk.columns)
+        self.dtypes = merge_dtypes(self.dtypes, chunk)
+
+        row_hashes = hash_rows(chunk)
+        self.digest.update(row_hashes)
+
+        if 'data_type' in chunk:
+            data_types = chunk['data_type'].values
+            for data_type in pandas.unique(data_types):
+                if not isinstance(data_type, str):
+                    continue
+                self.partitions.setdefault(data_type, DatasetDigest()).update(
+                    row_hashes[data_types == data_type])
+
+        if 'era' in chunk:
+            eras = chunk['era'].values
+            for era in pandas.unique(eras):
+                if not isinstance(era, str):
+                    continue
+                self.eras.setdefault(era, DatasetDigest()).update(row_hashes[eras == era])
+
+        if self.row_ids is not None and 'id' in chunk:
+            self.row_ids.append(numpy.asarray(chunk['id'], dtype=str))
+            self.row_hashes.append(row_hashes)
+
+    def get_digest(self, data_type=None):
+        """
+        Returns the digest of all rows, or of the rows with a given data_type.
+        """
+
+        if data_type is None:
+            return self.digest
+        return self.partitions.get(data_type, DatasetDigest())
+
+    def dtypes_changed(self, old):
+        """
+        Checks whether the dtypes of the columns differ from those of an older
+        fingerprint. Fingerprints without dtypes are assumed to be equal.
+        """
+
+        return self.dtypes is not None and old.dtypes is not None and self.dtypes != old.dtypes
+
+    def changed(self, old, data_type=None):
+        """
+        Checks whether this (new) fingerprint differs from an older one, with
+        the same result check_dataset would give for the underlying files.
+
+        Args:
+            old: DatasetFingerprint of the old dataset
+            data_type: Data type of the rows to check (default: None, i.e. all rows)
+
+        Returns:
+            True if the datasets differ, False otherwise.
+        """
+
+        if self.columns != old.columns:
+            logger.debug('DatasetFingerprint.changed: Columns changed')
+            return True
+
+        if self.dtypes_changed(old):
+            logger.debug('DatasetFingerprint.changed: Column dtypes changed')
+            return True
+
+        if self.get_digest(data_type) != old.get_digest(data_type):
+            logger.debug('DatasetFingerprint.changed: Rows changed')
+            return True
+
+        return False
+
+
+def write_fingerprint_manifest(filename, fingerprints):
+    """
+    Writes a fingerprint manifest (JSON) for a set of dataset files. The file
+    is written atomically, so a crash never leaves a partial manifest.
+
+    Args:
+        filename: Filename of the manifest
+        fingerprints: Dictionary of dataset filename (without directory) to
+                      DatasetFingerprint
+    """
+
+    logger.debug('write_fingerprint_manifest(%s)', filename)
+
+    manifest = {'version': FINGERPRINT_VERSION,
+                'files': {k: v.to_dict() for k, v in fingerprints.items()}}
+
+    tmp_filename = '{}.tmp'.format(filename)
+    with open(tmp_filename, 'w') as fp:
+        json.dump(manifest, fp, indent=1)
+    os.replace(tmp_filename, filename)
+
+
+def load_fingerprint_manifest(filename):
+    """
+    Loads a fingerprint manifest written by write_fingerprint_manifest.
+
+    Args:
+        filename: Filename of the manifest
+
+    Returns:
+        Dictionary of dataset filename to DatasetFingerprint, or None if the
+        manifest does not exist or was written by an incompatible version.
+    """
+
+    try:
+        with open(filename, 'r') as fp:
+            manifest = json.load(fp)
+    except FileNotFoundError:
+        return None
+    except ValueError:
+        logger.warning('load_fingerprint_manifest: Could not parse %s', filename)
+        return None
+
+    if manifest.get('version') != FINGERPRINT_VERSION:
+        logger.info('load_fingerprint_manifest: Ignoring manifest %s with version %s',
+                    filename, manifest.get('version'))
+        return None
+
+    return {k: DatasetFingerprint.from_dict(v) for k, v in manifest['files'].items()}
+
+
+def write_row_hashes(filename, fingerprint):
+    """
+    Writes the ids and digests of the rows of a dataset (see
+    DatasetFingerprint with keep_rows) to a compressed numpy file, so the
+    rows that changed between rounds can be determined later (see
+    DatasetDelta).
+
+    Args:
+        filename: Filename of the row hashes file (.npz)
+        fingerprint: DatasetFingerprint that was created with keep_rows
+    """
+
+    logger.debug('write_row_hashes(%s)', filename)
+
+    ids = numpy.concatenate(fingerprint.row_ids) if fingerprint.row_ids else numpy.empty(0, dtype=str)
+    hashes = (numpy.concatenate(fingerprint.row_hashes) if fingerprint.row_hashes
+              else numpy.empty(0, dtype=numpy.uint64))
+
+    # numpy appends .npz to filenames without it, so write to a file object
+    tmp_filename = '{}.tmp'.format(filename)
+    with open(tmp_filename, 'wb') as fp:
+        numpy.savez_compressed(fp, ids=ids, hashes=hashes)
+    os.replace(tmp_filename, filename)
+
+
+def load_row_hashes(filename):
+    """
+    Loads the row hashes written by write_row_hashes.
+
+    Returns:
+        Tuple of (ids, hashes) numpy arrays, or None if the file does not exist.
+    """
+
+    try:
+        with numpy.load(str(filename)) as data:
+            return data['ids'], data['hashes']
+    except FileNotFoundError:
+        return None
+
+
+class DatasetDelta:
+    """
+    Difference between the datasets of two rounds, by era and (if the row
+    hashes of both rounds are available) by row id.
+
+    Attributes:
+        round_old: Round number of the old dataset
+        round_new: Round number of the new dataset
+        columns_changed: Whether the columns (e.g. the features) or their
+                         dtypes changed. If they did, the old data can not
+                         be reused.
+        added_eras: Eras that are only in the new dataset
+        removed_eras: Eras that are only in the old dataset
+        changed_eras: Eras with different rows in both datasets
+        unchanged_eras: Eras with the same rows in both datasets
+        added_ids: Ids of rows that are only in the new dataset (None if the
+                   row hashes are not available)
+        removed_ids: Ids of rows that are only in the old dataset (None if the
+                     row hashes are not available)
+        changed_ids: Ids of rows with different values in both datasets (None
+                     if the row hashes are not available)
+    """
+
+    def __init__(self, round_old, round_new, fingerprint_old, fingerprint_new, rows_old=None, rows_new=None):
+        """
+        Computes the difference between two datasets.
+
+        Args:
+            round_old: Round number of the old dataset
+            round_new: Round number of the new dataset
+            fingerprint_old: DatasetFingerprint of the old dataset
+            fingerprint_new: DatasetFingerprint of the new dataset
+            rows_old: (ids, hashes) of the old dataset (see load_row_hashes)
+            rows_new: (ids, hashes) of the new dataset (see load_row_hashes)
+        """
+
+        self.round_old = round_old
+        self.round_new = round_new
+        self.columns_changed = (fingerprint_old.columns != fingerprint_new.columns or
+                                fingerprint_new.dtypes_changed(fingerprint_old))
+
+        eras_old = fingerprint_old.eras
+        eras_new = fingerprint_new.eras
+        self.added_eras = sorted(set(eras_new) - set(eras_old))
+        self.removed_eras = sorted(set(eras_old) - set(eras_new))
+        self.changed_eras = sorted(e for e in set(eras_old) & set(eras_new) if eras_old[e] != eras_new[e])
+        self.unchanged_eras = sorted(e for e in set(eras_old) & set(eras_new) if eras_old[e] == eras_new[e])
+
+        self.added_ids = None
+        self.removed_ids = None
+        self.changed_ids = None
+        if rows_old is not None and rows_new is not None:
+            hashes_old = pandas.Series(rows_old[1], index=rows_old[0])
+            hashes_new = pandas.Series(rows_new[1], index=rows_new[0])
+            common = hashes_new.index.intersection(hashes_old.index)
+            self.added_ids = numpy.asarray(hashes_new.index.difference(hashes_old.index), dtype=str)
+            self.removed_ids = numpy.asarray(hashes_old.index.difference(hashes_new.index), dtype=str)
+            self.changed_ids = numpy.asarray(common[hashes_new[common].values != hashes_old[common].values],
+                                             dtype=str)
+
+    @property
+    def changed(self):
+        """ Whether the datasets differ """
+        return self.columns_changed or bool(self.added_eras or self.removed_eras or self.changed_eras)
+
+    @property
+    def new_eras(self):
+        """ Eras with rows that were added or changed """
+        return sorted(self.added_eras + self.changed_eras)
+
+    def __repr__(self):
+        return ('DatasetDelta(round {} -> {}: columns_changed={}, {} added, {} removed, '
+                '{} changed, {} unchanged eras)'.format(
+                    self.round_old, self.round_new, self.columns_changed, len(self.added_eras),
+                    len(self.removed_eras), len(self.changed_eras), len(self.unchanged_eras)))
+
+
+def check_dataset(filename_old, filename_new, data_type=None, chunksize=DATASET_CHUNKSIZE):
     """
     Checks whether two Numerai datasets are the same. Optionally it can check
     only rows with a specified data_type.
 
+    Both datasets are streamed in chunks and reduced to order-independent
+    digests of their rows, so memory use does not depend on the size of the
+    datasets. Rows are identified by their (unique) id: as soon as a row with
+    the same id is found in the same position of both files with different
+    values, the check stops early.
+
     Args:
         filename_old: Filename of the first (old) dataset
         filename_new: Filename of the second (new) dataset
         data_type: Data type of the rows to check (default: None, i.e. all rows)
+        chunksize: Number of rows read per chunk
+
+    Returns:
+        True if the new dataset differs from the old dataset (or if there is
+        no old dataset), False if no change was detected or if the new
+        dataset could not be loaded.
     """
 
     logger.debug('check_dataset(%s, %s)', filename_old, filename_new)
@@ -38,72 +498,495 @@ def check_dataset(filename_old, filename_new, data_type=None):
 
     logger.info('check_dataset: Checking %s vs %s', filename_old, filename_new)
 
-    # Read datasets
-    old_dataset = pandas.read_csv(filename_old)
-    new_dataset = pandas.read_csv(filename_new)
+    # If the columns are not the same, the data is different
+    old_columns = list(pandas.read_csv(filename_old, nrows=0).columns)
+    new_columns = list(pandas.read_csv(filename_new, nrows=0).columns)
+    if old_columns != new_columns:
+        logger.debug('check_dataset: Columns changed')
+        return True
+
+    old_digest = DatasetDigest()
+    new_digest = DatasetDigest()
+    old_dtypes = None
+    new_dtypes = None
 
-    if data_type is not None:
-        # Filter only data_type from datasets
-        old_dataset = old_dataset[old_dataset['data_type'] == data_type]
-        new_dataset = new_dataset[new_dataset['data_type'] == data_type]
+    for old_chunk, new_chunk in itertools.zip_longest(
+            read_dataset_chunks(filename_old, data_type, chunksize),
+            read_dataset_chunks(filename_new, data_type, chunksize)):
+        old_hashes = hash_rows(old_chunk) if old_chunk is not None else numpy.empty(0, numpy.uint64)
+        new_hashes = hash_rows(new_chunk) if new_chunk is not None else numpy.empty(0, numpy.uint64)
+
+        # A row with the same id in the same position but a different digest
+        # means the data has changed, no need to read further
+        n = min(len(old_hashes), len(new_hashes))
+        if n > 0:
+            same_id = old_chunk['id'].values[:n] == new_chunk['id'].values[:n]
+            if numpy.any(same_id & (old_hashes[:n] != new_hashes[:n])):
+                logger.debug('check_dataset: Values of existing rows changed')
+                return True
+
+        old_digest.update(old_hashes)
+        new_digest.update(new_hashes)
+        if old_chunk is not None:
+            old_dtypes = merge_dtypes(old_dtypes, old_chunk)
+        if new_chunk is not None:
+            new_dtypes = merge_dtypes(new_dtypes, new_chunk)
 
     # If the number of elements is not the same, the data is different
-    if old_dataset.shape != new_dataset.shape:
+    if old_digest.rows != new_digest.rows:
         logger.debug('check_dataset: Number of elements changed')
         return True
 
-    # Fix dataset indexing
-    old_dataset.index = old_dataset.id
-    new_dataset.index = new_dataset.id
-
-    old_dataset = old_dataset.sort_index()
-    new_dataset = new_dataset.sort_index()
-
     # Check if values are the not same
-    if not new_dataset.equals(old_dataset):
+    if old_digest != new_digest:
         logger.debug('check_dataset: new dataset does not equal old dataset')
         return True
 
+    # The digests do not depend on the dtypes, so compare those separately
+    if old_dtypes != new_dtypes:
+        logger.debug('check_dataset: Column dtypes changed')
+        return True
+
     # Data does not appear to have changed
     logger.debug('check_dataset: No change detected')
     return False
 
 
 
+# Non-feature, non-target columns of a Numerai dataset
+META_COLUMNS = ['id', 'era', 'data_type']
+
+# Supported precisions of feature matrices. 'uint8' stores quantized features
+# as integer codes together with a scale (feature value = code / scale).
+FEATURE_PRECISIONS = ('float64', 'float32', 'float16', 'uint8')
+
+
+def get_target_columns(columns):
+    """ Returns the target columns from a list of dataset columns """
+    return [c for c in columns if c[0:7] == 'target_']
+
+
+def get_feature_columns(columns):
+    """ Returns the feature columns from a list of dataset columns """
+    return [c for c in columns if c not in META_COLUMNS and c[0:7] != 'target_']
+
+
+class NumeraiDataset:
+    """
+    Numerai dataset split into numpy arrays. The arrays can be in memory or
+    memory-mapped from a columnar store; in both cases they should be
+    treated as read-only.
+
+    Attributes:
+        ids: Array of row ids
+        eras: Array of row eras
+        data_types: Array of row data types
+        features: Feature matrix (rows x features)
+        targets: Target matrix (rows x targets)
+        feature_names: List of feature column names
+        target_names: List of target column names
+        feature_scale: Scale of quantized (uint8) features, None otherwise
+    """
+
+    def __init__(self, ids, eras, data_types, features, targets, feature_names, target_names,
+                 feature_scale=None):
+        self.ids = ids
+        self.eras = eras
+        self.data_types = data_types
+        self.features = features
+        self.targets = targets
+        self.feature_names = feature_names
+        self.target_names = target_names
+        self.feature_scale = feature_scale
+
+    def __len__(self):
+        return len(self.ids)
+
+    def get_target(self, tournament_name):
+        """
+        Get the target vector of a tournament.
+
+        Args:
+            tournament_name: Name of the tournament (e.g. 'bernie')
+
+        Returns:
+            Target vector
+        """
+
+        return self.targets[:, self.target_names.index('target_' + tournament_name)]
+
+    def get_feature_matrix(self, start=None, stop=None):
+        """
+        Get (a range of rows of) the feature matrix as floating point values.
+        Quantized features are decoded to float32, other features are
+        returned without copying.
+
+        Args:
+            start: First row (default: None, i.e. the first row)
+            stop: Row after the last row (default: None, i.e. up to the last row)
+
+        Returns:
+            Feature matrix
+        """
+
+        return decode_features(self.features[start:stop], self.feature_scale)
+
+    def get_feature_rows(self, rows):
+        """
+        Get a selection of rows of the feature matrix as floating point
+        values. Only the selected rows are read from a memory-mapped matrix.
+
+        Args:
+            rows: Array of row indices
+
+        Returns:
+            Feature matrix of the selected rows
+        """
+
+        return decode_features(self.features[rows], self.feature_scale)
+
+
+def decode_features(features, feature_scale=None):
+    """ Decodes quantized (uint8) features to float32, other features are returned as is """
+
+    if feature_scale is None:
+        return features
+    return features.astype(numpy.float32) / numpy.float32(feature_scale)
+
+
+class FeatureQuantizationError(ValueError):
+    """ Error that is raised if features can not be stored as uint8 codes. """
+    pass
+
+
+class FeatureEncoder:
+    """
+    Converts chunks of feature values to a compact precision. For 'uint8',
+    the scale is detected from the first chunk and every later chunk must be
+    quantized with the same scale.
+
+    Attributes:
+        precision: Precision of the encoded features (see FEATURE_PRECISIONS)
+        scale: Scale of quantized features (uint8 precision only)
+    """
+
+    def __init__(self, precision='float32'):
+        """
+        Creates a new FeatureEncoder.
+
+        Args:
+            precision: Precision of the encoded features (see FEATURE_PRECISIONS)
+        """
+
+        if precision not in FEATURE_PRECISIONS:
+            raise ValueError('Unknown feature precision: {}'.format(precision))
+
+        self.precision = precision
+        self.scale = None
+
+    @property
+    def dtype(self):
+        """ numpy dtype of the encoded features """
+        return numpy.dtype(self.precision)
+
+    @property
+    def parse_dtype(self):
+        """ numpy dtype the features should be parsed with """
+        if self.precision == 'float64':
+            return numpy.dtype(numpy.float64)
+        return numpy.dtype(numpy.float32)
+
+    def encode(self, features):
+        """
+        Encode a chunk of feature values.
+
+        Args:
+            features: Floating point feature matrix
+
+        Returns:
+            Feature matrix in the precision of the encoder
+        """
+
+        if self.precision != 'uint8':
+            return features.astype(self.dtype, copy=False)
+
+        if self.scale is None:
+            self.scale = find_feature_scale(features)
+            if self.scale is None:
+                raise FeatureQuantizationError('Features are not quantized')
+
+        codes = numpy.rint(features * numpy.float32(self.scale))
+        if (codes.size > 0 and
+                (codes.min() < 0 or codes.max() > 255 or
+                 numpy.abs(features * numpy.float32(self.scale) - codes).max() > 1e-4 * self.scale)):
+            raise FeatureQuantizationError('Features are not quantized with scale {}'.format(self.scale))
+
+        return codes.astype(numpy.uint8)
+
+
+def find_feature_scale(features, max_code=255):
+    """
+    Finds the smallest integer scale for which all feature values multiplied
+    by the scale are integer codes between 0 and max_code.
+
+    Args:
+        features: Floating point feature matrix
+        max_code: Largest allowed code
+
+    Returns:
+        The scale, or None if the features are not quantized.
+    """
+
+    features = numpy.asarray(features, dtype=numpy.float64)
+    if features.size == 0 or numpy.isnan(features).any() or features.min() < 0:
+        return None
+
+    for scale in range(1, max_code + 1):
+        scaled = features * scale
+        if scaled.max() > max_code:
+            break
+        if numpy.abs(scaled - numpy.rint(scaled)).max() <= 1e-4 * scale:
+            return scale
+
+    return None
+
+
+def load_dataset(filename, precision='float32', chunksize=DATASET_CHUNKSIZE):
+    """
+    Loads a Numerai dataset CSV file with a compact feature matrix. Feature
+    columns are parsed directly to the requested precision, chunk by chunk,
+    so no float64 copy of the full dataset is made. If 'uint8' is requested
+    but the features are not quantized, float32 is used instead.
+
+    Args:
+        filename: Filename of the dataset
+        precision: Precision of the feature matrix (see FEATURE_PRECISIONS)
+        chunksize: Number of rows read per chunk
+
+    Returns:
+        NumeraiDataset with read-only arrays
+    """
+
+    logger.debug('load_dataset(%s, %s)', filename, precision)
+
+    columns = list(pandas.read_csv(filename, nrows=0).columns)
+    feature_names = get_feature_columns(columns)
+    target_names = get_target_columns(columns)
+
+    encoder = FeatureEncoder(precision)
+    parse_dtypes = {c: encoder.parse_dtype for c in feature_names}
+    parse_dtypes.update({c: numpy.float32 for c in target_names})
+
+    ids, eras, data_types, features, targets = [], [], [], [], []
+    try:
+        for chunk in pandas.read_csv(filename, dtype=parse_dtypes, chunksize=chunksize):
+            ids.append(numpy.asarray(chunk['id'], dtype=str))
+            eras.append(numpy.asarray(chunk['era'], dtype=str))
+            data_types.append(numpy.asarray(chunk['data_type'], dtype=str))
+            features.append(encoder.encode(chunk[feature_names].values))
+            targets.append(chunk[target_names].values)
+    except FeatureQuantizationError as e:
+        logger.warning('load_dataset: %s, loading %s as float32', e, filename)
+        return load_dataset(filename, precision='float32', chunksize=chunksize)
+
+    dataset = NumeraiDataset(_concatenate(ids, str),
+                             _concatenate(eras, str),
+                             _concatenate(data_types, str),
+                             _concatenate(features, encoder.dtype, len(feature_names)),
+                             _concatenate(targets, numpy.float32, len(target_names)),
+                             feature_names, target_names, feature_scale=encoder.scale)
+
+    for array in [dataset.ids, dataset.eras, dataset.data_types, dataset.features, dataset.targets]:
+        array.flags.writeable = False
+
+    return dataset
+
+
+def _concatenate(arrays, dtype, columns=None):
+    if len(arrays) == 0:
+        return numpy.empty((0, columns) if columns is not None else 0, dtype=dtype)
+    return numpy.concatenate(arrays)
+
+
+
+def format_probabilities(probabilities):
+    """
+    Formats probabilities with 8 decimals, like '%.8f' but vectorized: the
+    probabilities are rounded to integers of 1e-8 and the integer and
+    fractional digits are formatted separately. Probabilities close to a
+    rounding tie, where the rounding of probabilities * 1e8 can differ from
+    the exact decimal rounding of '%.8f', are formatted with '%.8f', so the
+    output is the same as that of '%.8f'.
+
+    Args:
+        probabilities: Array of probabilities
+
+    Returns:
+        numpy array of strings
+    """
+
+    probabilities = numpy.asarray(probabilities, dtype=numpy.float64)
+    if not numpy.all((probabilities >= 0) & (probabilities <= 1)):
+        # Fall back to regular formatting for values that are not probabilities (or NaN)
+        return numpy.char.mod('%.8f', probabilities)
+
+    scaled = probabilities * 1e8
+    fixed = numpy.rint(scaled).astype(numpy.int64)
+    integer_part = (fixed // 100000000).astype(str)
+    fraction_part = numpy.char.zfill((fixed % 100000000).astype(str), 8)
+    formatted = numpy.char.add(numpy.char.add(integer_part, '.'), fraction_part)
+
+    # The error of scaled is below 1e-7, so rint only rounds differently from
+    # '%.8f' when the fraction of scaled is within that distance of one half
+    ties = numpy.abs(scaled - numpy.floor(scaled) - 0.5) < 1e-6
+    if numpy.any(ties):
+        formatted[ties] = numpy.char.mod('%.8f', probabilities[ties])
+    return formatted
+
+
+class PredictionWriter:
+    """
+    Writes a predictions CSV file (id and probability columns) in chunks of
+    rows, so the predictions never have to be kept in memory at once. The file
+    is written under a temporary name and renamed when it is closed, so an
+    incomplete predictions file is never uploaded.
+    """
+
+    def __init__(self, filename, column):
+        """
+        Creates a new PredictionWriter and writes the header.
+
+        Args:
+            filename: Filename of the predictions file
+            column: Name of the probability column (e.g. 'probability_bernie')
+        """
+
+        self.filename = str(filename)
+        self.tmp_filename = self.filename + '.tmp'
+        self.fp = open(self.tmp_filename, 'w', newline='')
+        self.fp.write('id,{}\n'.format(column))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, ids, probabilities):
+        """
+        Append rows to the predictions file.
+
+        Args:
+            ids: Array of row ids
+            probabilities: Array of probabilities
+        """
+
+        if len(ids) == 0:
+            return
+
+        rows = numpy.char.add(numpy.char.add(numpy.asarray(ids, dtype=str), ','),
+                              format_probabilities(probabilities))
+        self.fp.write('\n'.join(rows.tolist()))
+        self.fp.write('\n')
+
+    def close(self):
+        """ Finish writing and move the file into place """
+
+        self.fp.close()
+        os.replace(self.tmp_filename, self.filename)
+
+    def abort(self):
+        """ Stop writing and remove the temporary file """
+
+        self.fp.close()
+        os.remove(self.tmp_filename)
+
+
 def wait(seconds):
     """
-    Helper function that waits for a given number of seconds while checking
-    the exit_requested attribute. If exit_requested is set to True, this
-    function will return.
+    Helper function that waits for a given number of seconds, using the
+    default scheduler (see scheduler.get_default_scheduler).
 
     Args:
         seconds: Number of seconds to wait.
+
+    Raises:
+        InterruptedException: A stop was requested (e.g. by SIGINT/SIGTERM)
     """
 
     logger.debug('wait(%d)', seconds)
-    dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc) + datetime.timedelta(seconds=seconds)
-    wait_until(dt_now)
-    
+    get_default_scheduler().wait(seconds)
+
 
 def wait_until(timestamp):
     """
     Helper function that waits until a given datetime timestamp is reached,
-    while checking the exit_requested attribute. If exit_requested is set
-    to True, this function will return.
+    using the default scheduler (see scheduler.get_default_scheduler). The
+    thread sleeps until the timestamp, and wakes up at once if a stop is
+    requested.
 
     Args:
         timestamp: datetime object indicating the date and time that should
                    be waited until.
+
+    Raises:
+        InterruptedException: A stop was requested (e.g. by SIGINT/SIGTERM)
     """
     logger.debug('wait_until(%s)', timestamp)
-    dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
+    get_default_scheduler().wait_until(timestamp)
+
+
+async def async_wait(seconds):
+    """
+    Asynchronous version of wait, for use in asyncio coroutines, using the
+    default scheduler (see scheduler.Scheduler.async_wait_until). Other tasks
+    of the event loop keep running while waiting.
+
+    Args:
+        seconds: Number of seconds to wait.
+
+    Raises:
+        InterruptedException: A stop was requested (e.g. by SIGINT/SIGTERM)
+    """
+
+    logger.debug('async_wait(%d)', seconds)
+    await get_default_scheduler().async_wait(seconds)
+
+
+async def async_wait_until(timestamp):
+    """
+    Asynchronous version of wait_until, for use in asyncio coroutines, using
+    the default scheduler (see scheduler.Scheduler.async_wait_until). The
+    wait can also be interrupted by cancelling the task.
+
+    Args:
+        timestamp: datetime object indicating the date and time that should
+                   be waited until.
+
+    Raises:
+        InterruptedException: A stop was requested (e.g. by SIGINT/SIGTERM)
+    """
+    logger.debug('async_wait_until(%s)', timestamp)
+    await get_default_scheduler().async_wait_until(timestamp)
 
-    while (timestamp - dt_now).total_seconds() > 0:
-        time.sleep(min(1,(timestamp - dt_now).total_seconds()))
-        dt_now = datetime.datetime.utcnow().replace(tzinfo=pytz.utc)
 
+def wait_for_retry(attempt_number, scheduler=None):
+    """
+    Waits before the next attempt of a failed request, following a fixed
+    schedule of increasing waits.
+
+    Args:
+        attempt_number: Number of the attempt that failed (starting at 0)
+        scheduler: Scheduler to wait on (default: None, i.e. the default
+                   scheduler, see scheduler.get_default_scheduler)
 
-def wait_for_retry(attempt_number):
+    Raises:
+        RuntimeError: The request failed too many times
+        InterruptedException: A stop was requested (e.g. by SIGINT/SIGTERM)
+    """
     logger.debug('wait_for_retry(%d)', attempt_number)
 
     # Hardcoded retry schedule:
@@ -116,4 +999,7 @@ def wait_for_retry(attempt_number):
     if attempt_number >= len(waiting_schedule):
         raise RuntimeError('Request failed too many times')
 
-    wait(waiting_schedule[attempt_number])
+    if scheduler is not None:
+        scheduler.wait(waiting_schedule[attempt_number])
+    else:
+        wait(waiting_schedule[attempt_number])